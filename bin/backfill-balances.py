@@ -0,0 +1,14 @@
+"""Fill in balances_at for every year (or, with --monthly, month) so far.
+"""
+from __future__ import print_function
+
+import sys
+
+from gratipay.billing.ledger import backfill
+from gratipay.wireup import db, env
+
+db = db(env())
+
+if __name__ == '__main__':
+    closed = backfill(db, monthly='--monthly' in sys.argv[1:])
+    print("Closed balances at {} boundaries.".format(len(closed)))
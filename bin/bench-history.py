@@ -0,0 +1,143 @@
+"""Time the history page for a participant with lots of events.
+
+    python bin/bench-history.py [nevents [nnoise]]
+
+We give a scratch participant ``nevents`` exchanges, transfers, and payments
+(10,000 by default) spread over last year, and others ``nnoise`` events
+(100,000 by default) so that a sequential scan costs what it would in
+production. Then we time :py:func:`~gratipay.utils.history.iter_payday_events`
+for last year, and print the plans of its queries, which should use the
+``(participant, timestamp)``-style indexes. We commit the scratch rows, so
+that the code under test gets a real database to query, and delete them when
+we're done, so this is safe to run against a database with real data in it.
+
+"""
+from __future__ import print_function
+
+import sys
+import time
+from datetime import datetime
+
+from gratipay.utils.history import iter_payday_events, year_bounds
+from gratipay.wireup import db, env
+
+db = db(env())
+
+NRUNS = 5
+
+SETUP = """
+    INSERT INTO participants (username, username_lower)
+         VALUES ('bench-alice', 'bench-alice')
+              , ('bench-bob', 'bench-bob')
+              , ('bench-carol', 'bench-carol');
+
+    INSERT INTO teams (slug, slug_lower, name, homepage, product_or_service, onboarding_url,
+                       owner, is_approved, is_closed, available)
+         VALUES ('bench-team', 'bench-team', 'Bench Team', '', '', '', 'bench-bob',
+                 true, false, 0);
+
+    INSERT INTO exchange_routes (participant, network, address, error)
+         SELECT id, 'braintree-cc', 'bench', ''
+           FROM participants
+          WHERE username IN ('bench-alice', 'bench-carol');
+
+    INSERT INTO exchanges (timestamp, participant, amount, fee, status, route)
+         SELECT %(start)s::timestamptz + (i / %(n)s) * (%(end)s::timestamptz - %(start)s)
+              , 'bench-alice'
+              , CASE WHEN i %% 2 = 0 THEN 10.00 ELSE -5.00 END
+              , 0
+              , 'succeeded'
+              , (SELECT r.id FROM exchange_routes r JOIN participants p ON p.id = r.participant
+                  WHERE p.username = 'bench-alice')
+           FROM generate_series(0, %(n)s - 1) i;
+
+    INSERT INTO transfers (timestamp, tipper, tippee, amount, context)
+         SELECT %(start)s::timestamptz + (i / %(n)s) * (%(end)s::timestamptz - %(start)s)
+              , CASE WHEN i %% 2 = 0 THEN 'bench-alice' ELSE 'bench-bob' END
+              , CASE WHEN i %% 2 = 0 THEN 'bench-bob' ELSE 'bench-alice' END
+              , 1.00
+              , 'tip'
+           FROM generate_series(0, %(n)s - 1) i;
+
+    INSERT INTO payments (timestamp, participant, team, amount, direction)
+         SELECT %(start)s::timestamptz + (i / %(n)s) * (%(end)s::timestamptz - %(start)s)
+              , 'bench-alice'
+              , 'bench-team'
+              , 1.00
+              , CASE WHEN i %% 2 = 0 THEN 'to-team' ELSE 'to-participant' END::payment_direction
+           FROM generate_series(0, %(n)s - 1) i;
+
+    INSERT INTO exchanges (timestamp, participant, amount, fee, status, route)
+         SELECT %(start)s::timestamptz + (i / %(nnoise)s) * (%(end)s::timestamptz - %(start)s)
+              , 'bench-carol', 10.00, 0, 'succeeded'
+              , (SELECT r.id FROM exchange_routes r JOIN participants p ON p.id = r.participant
+                  WHERE p.username = 'bench-carol')
+           FROM generate_series(0, %(nnoise)s - 1) i;
+
+    INSERT INTO transfers (timestamp, tipper, tippee, amount, context)
+         SELECT %(start)s::timestamptz + (i / %(nnoise)s) * (%(end)s::timestamptz - %(start)s)
+              , 'bench-carol', 'bench-bob', 1.00, 'tip'
+           FROM generate_series(0, %(nnoise)s - 1) i;
+
+    INSERT INTO payments (timestamp, participant, team, amount, direction)
+         SELECT %(start)s::timestamptz + (i / %(nnoise)s) * (%(end)s::timestamptz - %(start)s)
+              , 'bench-carol', 'bench-team', 1.00, 'to-team'
+           FROM generate_series(0, %(nnoise)s - 1) i;
+
+    ANALYZE exchanges;
+    ANALYZE transfers;
+    ANALYZE payments;
+"""
+
+TEARDOWN = """
+    DELETE FROM payments WHERE team = 'bench-team';
+    DELETE FROM transfers WHERE tipper LIKE 'bench-%' OR tippee LIKE 'bench-%';
+    DELETE FROM exchanges WHERE participant LIKE 'bench-%';
+    DELETE FROM exchange_routes
+     WHERE participant IN (SELECT id FROM participants WHERE username LIKE 'bench-%');
+    DELETE FROM teams WHERE slug = 'bench-team';
+    DELETE FROM participants WHERE username LIKE 'bench-%';
+"""
+
+PLANS = [ ('exchanges', "SELECT * FROM exchanges WHERE participant = %(username)s "
+                        "AND timestamp >= %(start)s AND timestamp < %(end)s")
+        , ('payments', "SELECT * FROM payments WHERE participant = %(username)s "
+                       "AND timestamp >= %(start)s AND timestamp < %(end)s")
+        , ('transfers', "SELECT * FROM transfers WHERE (tipper = %(username)s "
+                        "OR tippee = %(username)s) "
+                        "AND timestamp >= %(start)s AND timestamp < %(end)s")
+         ]
+
+
+def main(nevents=10000, nnoise=100000):
+    year = datetime.utcnow().year - 1
+    start, end = year_bounds(year)
+    params = dict(n=float(nevents), nnoise=float(nnoise), start=start, end=end)
+    print("Setting up {:,} events (and {:,} for others) ...".format(nevents, nnoise))
+    db.run(SETUP, params)
+    try:
+        alice = db.one("SELECT participants.*::participants FROM participants "
+                       "WHERE username='bench-alice'")
+
+        timings = []
+        for i in range(NRUNS):
+            _start = time.time()
+            nrows = len(list(iter_payday_events(db, alice, year)))
+            timings.append(time.time() - _start)
+        timings.sort()
+        print("History for {} ({:,} rows): best {:.3f}s, median {:.3f}s over {} runs."
+              .format(year, nrows, timings[0], timings[len(timings) // 2], NRUNS))
+
+        for name, sql in PLANS:
+            print()
+            print(name)
+            print('-' * len(name))
+            plan = db.all("EXPLAIN ANALYZE " + sql,
+                          dict(username=alice.username, start=start, end=end))
+            print('\n'.join(plan))
+    finally:
+        db.run(TEARDOWN)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
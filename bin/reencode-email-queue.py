@@ -0,0 +1,11 @@
+"""Convert pickled email contexts that are still queued to the versioned format.
+"""
+from __future__ import print_function
+
+from gratipay.email import reencode_pickled_contexts
+from gratipay.wireup import db, env
+
+db = db(env())
+
+if __name__ == '__main__':
+    print("Converted {} queued messages.".format(reencode_pickled_contexts(db)))
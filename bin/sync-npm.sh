@@ -30,4 +30,4 @@ pip install -e .
 # Sync with npm.
 # ==============
 
-curl https://registry.npmjs.com/-/all | sync-npm serialize | sync-npm upsert
+curl https://registry.npmjs.com/-/all | sync-npm run --prune
@@ -4,9 +4,11 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import psycopg2.extras
 
 from . import email, utils
+from .billing import counters
 from .cron import Cron
 from .models import GratipayDB
 from .payday_runner import PaydayRunner
+from .utils.payday_cache import PaydayCache
 from .website import Website
 
 
@@ -43,6 +45,8 @@ class Application(object):
 
         website.init_even_more()                # TODO Fold this into Website.__init__
         self.email_queue = email.Queue(env, db, tell_sentry, website.project_root)
+        self.cache = wireup.cache(env)
+        self.payday_cache = PaydayCache(db, self.cache)
         self.install_periodic_jobs(website, env, db)
         self.website = website
         self.payday_runner = PaydayRunner(self)
@@ -52,6 +56,7 @@ class Application(object):
         cron = Cron(website)
         cron(env.update_cta_every, lambda: utils.update_cta(website))
         cron(env.check_db_every, db.self_check, True)
+        cron(env.reconcile_counters_every, lambda: counters.reconcile(db), True)
         cron(env.email_queue_flush_every, self.email_queue.flush, True)
 
 
@@ -0,0 +1,117 @@
+"""Reconcile the cached giving, receiving, and taking counters.
+
+:py:meth:`~gratipay.models.participant.Participant.set_payment_instruction`
+keeps ``participants.giving``, ``ngiving_to``, ``taking``, and
+``teams.receiving``, ``nreceiving_from``, and ``distributing`` up to date by
+adding the change in one instruction, rather than adding up all of them again.
+Other changes, like a team being approved, don't update them at all. So every
+so often we check the counters against a full recomputation, and fix any that
+have drifted.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from aspen import log
+
+
+# Each query gives the expected values (as ``expected_*``) next to the actual
+# ones for every row whose counters are off, or for just the row with id
+# ``%(id)s``, if it's off.
+
+GIVING = """
+    SELECT p.id
+         , p.giving, COALESCE(e.giving, 0) AS expected_giving
+         , p.ngiving_to, COALESCE(e.ngiving_to, 0) AS expected_ngiving_to
+      FROM participants p
+ LEFT JOIN ( SELECT participant_id, sum(amount) AS giving, count(amount) AS ngiving_to
+               FROM current_payment_instructions cpi
+               JOIN teams t ON t.id = cpi.team_id
+              WHERE amount > 0
+                AND is_funded
+                AND t.is_approved
+                AND (%(id)s IS NULL OR participant_id = %(id)s)
+           GROUP BY participant_id
+           ) e ON e.participant_id = p.id
+     WHERE (%(id)s IS NULL OR p.id = %(id)s)
+       AND (p.giving, p.ngiving_to) <> (COALESCE(e.giving, 0), COALESCE(e.ngiving_to, 0))
+"""
+
+RECEIVING = """
+    SELECT t.id
+         , t.receiving, COALESCE(e.receiving, 0) AS expected_receiving
+         , t.nreceiving_from, COALESCE(e.nreceiving_from, 0) AS expected_nreceiving_from
+         , t.distributing, COALESCE(e.receiving, 0) AS expected_distributing
+      FROM teams t
+ LEFT JOIN ( SELECT team_id, sum(amount) AS receiving, count(*) AS nreceiving_from
+               FROM current_payment_instructions cpi
+               JOIN participants p ON p.id = cpi.participant_id
+              WHERE p.is_suspicious IS NOT true
+                AND amount > 0
+                AND is_funded
+                AND (%(id)s IS NULL OR team_id = %(id)s)
+           GROUP BY team_id
+           ) e ON e.team_id = t.id
+     WHERE (%(id)s IS NULL OR t.id = %(id)s)
+       AND (t.receiving, t.nreceiving_from, t.distributing)
+        <> (COALESCE(e.receiving, 0), COALESCE(e.nreceiving_from, 0), COALESCE(e.receiving, 0))
+"""
+
+TAKING = """
+    SELECT p.id
+         , p.taking, COALESCE(e.taking, 0) AS expected_taking
+         , p.ntaking_from, COALESCE(e.ntaking_from, 0) AS expected_ntaking_from
+      FROM participants p
+ LEFT JOIN ( SELECT owner, sum(receiving) AS taking, count(*) AS ntaking_from
+               FROM teams
+           GROUP BY owner
+           ) e ON e.owner = p.username
+     WHERE (%(id)s IS NULL OR p.id = %(id)s)
+       AND (p.taking, p.ntaking_from) <> (COALESCE(e.taking, 0), COALESCE(e.ntaking_from, 0))
+"""
+
+# Taking adds up receiving, so fix receiving first.
+COUNTERS = [ ('participants', ('giving', 'ngiving_to'), GIVING)
+           , ('teams', ('receiving', 'nreceiving_from', 'distributing'), RECEIVING)
+           , ('participants', ('taking', 'ntaking_from'), TAKING)
+            ]
+
+
+def find_drift(db):
+    """Return a list of ``(table, id, {column: (actual, expected)})`` for every
+    row with counters that don't match a full recomputation.
+    """
+    out = []
+    for table, columns, sql in COUNTERS:
+        for row in db.all(sql, dict(id=None), back_as=dict):
+            out.append((table, row['id'], _diff(row, columns)))
+    return out
+
+
+def reconcile(db):
+    """Fix every counter that doesn't match a full recomputation, and return
+    how many rows we fixed.
+
+    We fix each row in its own transaction, after locking it and checking it
+    again, so that we neither hold up nor undo the updates in
+    ``set_payment_instruction``.
+
+    """
+    nfixed = 0
+    for table, columns, sql in COUNTERS:
+        for row in db.all(sql, dict(id=None), back_as=dict):
+            with db.get_cursor(back_as=dict) as cursor:
+                cursor.run("SELECT id FROM {} WHERE id = %s FOR UPDATE".format(table), (row['id'],))
+                row = cursor.one(sql, dict(id=row['id']))
+                if row is None:
+                    continue  # it was only out of date
+                cursor.run("UPDATE {} SET {} WHERE id = %(id)s".format(
+                    table, ', '.join('{0} = %(expected_{0})s'.format(c) for c in columns)
+                ), row)
+            log("Fixed drifted counters on {} {}: {}.".format(table, row['id'], _diff(row, columns)))
+            nfixed += 1
+    return nfixed
+
+
+def _diff(row, columns):
+    return {c: (row[c], row['expected_' + c]) for c in columns
+                                              if row[c] != row['expected_' + c]}
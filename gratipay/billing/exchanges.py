@@ -2,15 +2,19 @@
 """
 from __future__ import unicode_literals
 
+import time
 from decimal import Decimal, ROUND_UP
 
 import balanced
 import braintree
+from braintree.exceptions import DownForMaintenanceError, ServerError
+from braintree.exceptions.http import ConnectionError, TimeoutError
 
 from aspen import log
 from aspen.utils import typecheck
 from gratipay.exceptions import NegativeBalance, NotWhitelisted
 from gratipay.models.exchange_route import ExchangeRoute
+from gratipay.utils.timer import Latencies
 
 
 # Balanced has a $0.50 minimum. We go even higher to avoid onerous
@@ -35,6 +39,36 @@ def upcharge(amount):
 assert upcharge(MINIMUM_CHARGE) == (Decimal('10.00'), Decimal('0.59'))
 
 
+# Braintree calls are timed here, so that payday can report on them.
+
+braintree_latencies = Latencies()
+
+# When Braintree is down for maintenance it hasn't acted on our request, so we
+# can safely try again. Voiding a hold is idempotent, so we also retry that on
+# errors where we can't tell whether Braintree got the request.
+
+BRAINTREE_TRIES = 3
+BRAINTREE_BACKOFF = 0.5  # seconds, doubled after each failed try
+SAFE_TO_RETRY = (DownForMaintenanceError,)
+SAFE_TO_RETRY_IDEMPOTENT = SAFE_TO_RETRY + (ConnectionError, ServerError, TimeoutError)
+
+
+def call_braintree(name, func, *args, **kw):
+    """Call a Braintree API function, timing it and retrying with exponential
+    backoff on errors listed in ``retry_on``.
+    """
+    retry_on = kw.pop('retry_on', SAFE_TO_RETRY)
+    for i in range(BRAINTREE_TRIES):
+        try:
+            with braintree_latencies.timing(name):
+                return func(*args, **kw)
+        except retry_on as e:
+            if i + 1 == BRAINTREE_TRIES:
+                raise
+            log("Braintree {} failed ({}), retrying.".format(name, repr(e)))
+            time.sleep(BRAINTREE_BACKOFF * 2 ** i)
+
+
 def repr_exception(e):
     if isinstance(e, balanced.exc.HTTPError):
         return '%s %s, %s' % (e.status_code, e.status, e.description)
@@ -76,7 +110,7 @@ def create_card_hold(db, participant, amount):
     error = ""
     ref = None
     try:
-        result = braintree.Transaction.sale({
+        result = call_braintree('sale', braintree.Transaction.sale, {
             'amount': str(cents/100.0),
             'customer_id': route.participant.braintree_customer_id,
             'payment_method_token': route.address,
@@ -128,7 +162,9 @@ def capture_card_hold(db, participant, amount, hold):
 
     error = ''
     try:
-        result = braintree.Transaction.submit_for_settlement(ref, str(cents/100.00))
+        result = call_braintree( 'submit_for_settlement', braintree.Transaction.submit_for_settlement
+                               , ref, str(cents/100.00)
+                                )
         assert result.is_success
         if result.transaction.status != 'submitted_for_settlement':
             error = result.transaction.status
@@ -146,7 +182,9 @@ def capture_card_hold(db, participant, amount, hold):
 def cancel_card_hold(hold):
     """Cancel the previously created hold on the participant's credit card.
     """
-    result = braintree.Transaction.void(hold.id)
+    result = call_braintree( 'void', braintree.Transaction.void, hold.id
+                           , retry_on=SAFE_TO_RETRY_IDEMPOTENT
+                            )
     assert result.is_success
 
     amount = hold.amount
@@ -0,0 +1,188 @@
+"""Keep ``balances_at`` filled in, so that history never works out balances.
+
+``balances_at`` holds every participant's balance as of the first instant of
+each year (and, with ``LEDGER_MONTHLY``, of each month). We "close" a boundary
+by adding up everyone's balance changes since the boundary before it in one
+pass over ``exchanges``, ``transfers``, and ``payments``, and record that in
+``balances_at_closings``. We only store non-zero balances, so once a boundary
+is closed a missing row means zero.
+
+``bin/backfill-balances.py`` closes every boundary from the beginning of time,
+and payday closes any that have gone by since.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from datetime import datetime
+from decimal import Decimal
+
+from aspen import log
+
+
+# Balance changes per participant (by username) in [start, end). Leave
+# username NULL for everyone.
+DELTAS = """
+    SELECT participant, sum(delta) AS delta
+      FROM (
+            SELECT participant, amount AS delta
+              FROM exchanges
+             WHERE amount > 0
+               AND (status IS NULL OR status = 'succeeded')
+               AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
+               AND (%(username)s IS NULL OR participant = %(username)s)
+         UNION ALL
+            SELECT participant, amount - fee
+              FROM exchanges
+             WHERE amount < 0
+               AND (status IS NULL OR status <> 'failed')
+               AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
+               AND (%(username)s IS NULL OR participant = %(username)s)
+         UNION ALL
+            SELECT tipper, -amount
+              FROM transfers
+             WHERE "timestamp" >= %(start)s AND "timestamp" < %(end)s
+               AND (%(username)s IS NULL OR tipper = %(username)s)
+         UNION ALL
+            SELECT tippee, amount
+              FROM transfers
+             WHERE "timestamp" >= %(start)s AND "timestamp" < %(end)s
+               AND (%(username)s IS NULL OR tippee = %(username)s)
+         UNION ALL
+            SELECT participant
+                 , CASE WHEN direction = 'to-participant' THEN amount ELSE -amount END
+              FROM payments
+             WHERE "timestamp" >= %(start)s AND "timestamp" < %(end)s
+               AND (%(username)s IS NULL OR participant = %(username)s)
+           ) deltas
+  GROUP BY participant
+"""
+
+
+def boundaries(start, end, monthly=False):
+    """Yield the first instants of the years (or months) after ``start`` up to
+    and including ``end``, as naive UTC datetimes.
+    """
+    year, month = start.year, start.month
+    while True:
+        if monthly and month < 12:
+            month += 1
+        else:
+            year, month = year + 1, 1
+        boundary = datetime(year, month, 1)
+        if boundary > end.replace(tzinfo=None):
+            return
+        yield boundary
+
+
+def close(cursor, at):
+    """Record everyone's balance as of ``at``.
+
+    We build on the latest boundary closed before ``at``, so close boundaries
+    in order.
+
+    """
+    prev_at = cursor.one("SELECT max(at) FROM balances_at_closings WHERE at < %s", (at,))
+    cursor.run("DELETE FROM balances_at WHERE at = %s", (at,))
+    cursor.run("DELETE FROM balances_at_closings WHERE at = %s", (at,))
+    n = cursor.one("""
+        WITH closed AS (
+            INSERT INTO balances_at (participant, at, balance)
+                 SELECT p.id
+                      , %(at)s
+                      , COALESCE(prev.balance, 0) + COALESCE(d.delta, 0)
+                   FROM participants p
+              LEFT JOIN balances_at prev ON prev.participant = p.id AND prev.at = %(prev_at)s
+              LEFT JOIN ({}) d ON d.participant = p.username
+                  WHERE COALESCE(prev.balance, 0) + COALESCE(d.delta, 0) <> 0
+              RETURNING 1
+        )
+        SELECT count(*) FROM closed
+    """.format(DELTAS), dict(at=at, prev_at=prev_at, start=prev_at or '-infinity', end=at,
+                             username=None))
+    cursor.run("INSERT INTO balances_at_closings (at) VALUES (%s)", (at,))
+    return n
+
+
+def close_due(cursor, now, monthly=False):
+    """Close the boundaries that have gone by since the last one we closed.
+
+    If we've never closed one, just close the latest, from the beginning of
+    time; :py:func:`backfill` fills in the rest.
+
+    """
+    last = cursor.one("SELECT max(at) FROM balances_at_closings")
+    if last is None:
+        due = list(boundaries(datetime(now.year - 1, 12, 1), now, monthly))[-1:]
+    else:
+        due = list(boundaries(last, now, monthly))
+    for at in due:
+        n = close(cursor, at)
+        log("Closed balances at {} ({} participants).".format(at, n))
+    return due
+
+
+def backfill(db, monthly=False, now=None):
+    """Close every boundary from the first money movement until ``now``, each
+    in its own transaction.
+    """
+    now = now or datetime.utcnow()
+    first = db.one("""
+        SELECT min(ts) FROM (
+            SELECT min("timestamp") AS ts FROM exchanges
+             UNION ALL
+            SELECT min("timestamp") FROM transfers
+             UNION ALL
+            SELECT min("timestamp") FROM payments
+        ) _
+    """)
+    db.run("DELETE FROM balances_at_closings")
+    if first is None:
+        return []
+    due = list(boundaries(first, now, monthly))
+    for at in due:
+        with db.get_cursor() as cursor:
+            n = close(cursor, at)
+        log("Closed balances at {} ({} participants).".format(at, n))
+    return due
+
+
+def get_delta(db, username, start, end):
+    """Return the change in ``username``'s balance over [start, end).
+    """
+    return db.one( "SELECT delta FROM ({}) d".format(DELTAS)
+                 , dict(username=username, start=start, end=end)
+                 , default=Decimal('0.00')
+                  )
+
+
+def get_balance_at(db, participant, at):
+    """Return ``participant``'s balance as of ``at``, a boundary.
+
+    If we haven't closed ``at`` yet (say, it's the first week of January and
+    payday hasn't run), work back from the current balance, which is one
+    indexed pass over the changes since ``at``.
+
+    """
+    balance, is_closed = db.one("""
+        SELECT ( SELECT balance
+                   FROM balances_at
+                  WHERE participant = %(id)s
+                    AND at = %(at)s
+               ) AS balance
+             , EXISTS ( SELECT 1
+                          FROM balances_at_closings
+                         WHERE at = %(at)s
+                       ) AS is_closed
+    """, dict(id=participant.id, at=at), back_as=tuple)
+    if balance is not None:
+        return balance
+    if is_closed:
+        return Decimal('0.00')
+    return db.one("""
+        SELECT p.balance - COALESCE(d.delta, 0)
+          FROM participants p
+     LEFT JOIN ({}) d ON d.participant = p.username
+         WHERE p.id = %(id)s
+    """.format(DELTAS), dict( id=participant.id, start=at, end='infinity'
+                            , username=participant.username
+                             ))
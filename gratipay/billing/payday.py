@@ -4,9 +4,10 @@ Exchanges (moving money between Gratipay and the outside world) and transfers
 (moving money amongst Gratipay users) happen within an isolated event called
 payday. This event has duration (it's not punctiliar).
 
-Payday is designed to be crash-resistant. Everything that can be rolled back
-happens inside a single DB transaction. Exchanges cannot be rolled back, so they
-immediately affect the participant's balance.
+Payday is designed to be crash-resistant. Payin is broken into steps, each of
+which commits its work in a single DB transaction together with a checkpoint,
+so that a crashed payday resumes at the step that failed. Exchanges cannot be
+rolled back, so they immediately affect the participant's balance.
 
 """
 from __future__ import unicode_literals
@@ -18,18 +19,274 @@ import braintree
 
 import aspen.utils
 from aspen import log
+from gratipay.billing import ledger
 from gratipay.billing.exchanges import (
-    cancel_card_hold, capture_card_hold, create_card_hold, upcharge, MINIMUM_CHARGE,
+    braintree_latencies, cancel_card_hold, capture_card_hold, create_card_hold, upcharge,
+    MINIMUM_CHARGE,
 )
 from gratipay.exceptions import NegativeBalance
 from gratipay.models import check_db
-from gratipay.utils.threaded_map import threaded_map
+from gratipay.utils.threaded_map import threaded_map, threaded_pipeline
 
 
 with open(os.path.join(os.path.dirname(__file__), '../../sql/payday.sql')) as f:
     PAYDAY = f.read()
 
 
+# The takes to process this payday. Trigger-based processing depends on the
+# order in which rows land in payday_takes, so both engines sort by (team_id,
+# amount, ctime).
+
+TAKES = """
+    SELECT team_id, participant_id, amount, ctime
+      FROM ( SELECT DISTINCT ON (team_id, participant_id)
+                    team_id, participant_id, amount, ctime
+               FROM takes
+              WHERE mtime < %(ts_start)s
+           ORDER BY team_id, participant_id, mtime DESC
+           ) t
+     WHERE t.amount > 0
+       AND t.team_id IN (SELECT id FROM payday_teams)
+       AND t.participant_id IN (SELECT id FROM payday_participants)
+       AND ( SELECT ppd.id
+               FROM payday_payments_done ppd
+               JOIN participants ON participants.id = t.participant_id
+               JOIN teams ON teams.id = t.team_id
+              WHERE participants.username = ppd.participant
+                AND teams.slug = ppd.team
+                AND direction = 'to-participant'
+           ) IS NULL
+"""
+
+
+# Set-based engine
+# ================
+# These statements reproduce what the pay, park, process_payment_instruction,
+# process_take, and process_draw functions in sql/payday.sql do row by row,
+# including the order in which rows are written to events and payday_payments.
+
+SET_BASED_PAYMENT_INSTRUCTIONS = """
+
+    -- A participant funds their instructions in order, and each one is funded
+    -- if it fits in what's left of their balance (or if they have a card hold).
+    -- Instructions that don't fit are skipped, so this is a greedy walk rather
+    -- than a plain running sum; we step through every participant at once.
+
+    DROP TABLE IF EXISTS payday_funding;
+    CREATE TABLE payday_funding AS
+        WITH RECURSIVE instructions AS (
+                 SELECT ppi.id
+                      , ppi.participant_id
+                      , ppi.team_id
+                      , (ppi.amount + ppi.due) AS amount
+                      , p.card_hold_ok
+                      , p.has_credit_card
+                      , p.new_balance
+                      , row_number() OVER ( PARTITION BY ppi.participant_id
+                                                ORDER BY ppi.ctime, ppi.id
+                                           ) AS n
+                      , row_number() OVER (ORDER BY p.claimed_time, ppi.ctime, ppi.id) AS ord
+                   FROM payday_payment_instructions ppi
+                   JOIN payday_participants p ON p.id = ppi.participant_id
+             )
+           , funding AS (
+                 SELECT i.*
+                      , (i.amount <= i.new_balance OR i.card_hold_ok) AS is_funded
+                      , i.new_balance - CASE WHEN i.amount <= i.new_balance OR i.card_hold_ok
+                                             THEN i.amount ELSE 0
+                                        END AS balance
+                   FROM instructions i
+                  WHERE i.n = 1
+              UNION ALL
+                 SELECT i.*
+                      , (i.amount <= f.balance OR i.card_hold_ok) AS is_funded
+                      , f.balance - CASE WHEN i.amount <= f.balance OR i.card_hold_ok
+                                         THEN i.amount ELSE 0
+                                    END AS balance
+                   FROM funding f
+                   JOIN instructions i ON i.participant_id = f.participant_id
+                                      AND i.n = f.n + 1
+             )
+        SELECT id, participant_id, team_id, amount, is_funded, has_credit_card, ord
+          FROM funding;
+
+    ALTER TABLE payday_payment_instructions DISABLE TRIGGER process_payment_instruction;
+    UPDATE payday_payment_instructions ppi
+       SET is_funded = true
+      FROM payday_funding f
+     WHERE f.id = ppi.id
+       AND f.is_funded;
+
+    UPDATE payday_participants p
+       SET new_balance = (new_balance - f.amount)
+      FROM ( SELECT participant_id, sum(amount) AS amount
+               FROM payday_funding
+              WHERE is_funded
+           GROUP BY participant_id
+           ) f
+     WHERE p.id = f.participant_id;
+
+    UPDATE payday_teams t
+       SET balance = (balance + f.amount)
+      FROM ( SELECT team_id, sum(amount) AS amount
+               FROM payday_funding
+              WHERE is_funded
+           GROUP BY team_id
+           ) f
+     WHERE t.id = f.team_id;
+
+    UPDATE payment_instructions pi
+       SET due = CASE WHEN f.is_funded THEN 0 ELSE f.amount END
+      FROM payday_funding f
+      JOIN current_payment_instructions cpi ON cpi.participant_id = f.participant_id
+                                           AND cpi.team_id = f.team_id
+     WHERE pi.id = cpi.id
+       AND ( (f.is_funded AND cpi.due > 0) OR (NOT f.is_funded AND f.has_credit_card) );
+
+    INSERT INTO events (type, payload)
+         SELECT 'payday'
+              , ( CASE WHEN is_funded
+                       THEN '{"action":"pay","participant_id":"' || participant_id
+                            || '", "team_id":"' || team_id || '", "amount":' || amount || '}'
+                       ELSE '{"action":"due","participant_id":"' || participant_id
+                            || '", "team_id":"' || team_id || '", "due":' || amount || '}'
+                  END )::json
+           FROM payday_funding
+          WHERE is_funded OR has_credit_card
+       ORDER BY ord;
+
+    INSERT INTO payday_payments (participant, team, amount, direction)
+         SELECT p.username, t.slug, f.amount, 'to-team'
+           FROM payday_funding f
+           JOIN participants p ON p.id = f.participant_id
+           JOIN teams t ON t.id = f.team_id
+          WHERE f.is_funded
+       ORDER BY f.ord;
+
+"""
+
+SET_BASED_TAKES = """
+
+    -- Takes are honored smallest first until the team runs out of what it can
+    -- distribute today, so each take gets what's left after the ones before it.
+
+    DROP TABLE IF EXISTS payday_take_payments;
+    CREATE TABLE payday_take_payments AS
+        SELECT team_id
+             , participant_id
+             , GREATEST(0, LEAST( t.amount
+                                , t.available_today - t.taken_before
+                                 ))::numeric(35,2) AS amount
+             , ord
+          FROM ( SELECT t.*
+                      , pt.available_today
+                      , COALESCE(sum(t.amount) OVER ( PARTITION BY t.team_id
+                                                          ORDER BY t.amount, t.ctime
+                                                      ROWS BETWEEN UNBOUNDED PRECEDING
+                                                               AND 1 PRECEDING
+                                                     ), 0) AS taken_before
+                      , row_number() OVER (ORDER BY t.team_id, t.amount, t.ctime) AS ord
+                   FROM ({}) t
+                   JOIN payday_teams pt ON pt.id = t.team_id
+               ) t;
+
+    DELETE FROM payday_take_payments WHERE amount = 0;
+
+    UPDATE payday_teams t
+       SET available_today = (available_today - tp.amount)
+         , balance = (balance - tp.amount)
+      FROM ( SELECT team_id, sum(amount) AS amount
+               FROM payday_take_payments
+           GROUP BY team_id
+           ) tp
+     WHERE t.id = tp.team_id;
+
+    UPDATE payday_participants p
+       SET new_balance = (new_balance + tp.amount)
+      FROM ( SELECT participant_id, sum(amount) AS amount
+               FROM payday_take_payments
+           GROUP BY participant_id
+           ) tp
+     WHERE p.id = tp.participant_id;
+
+    UPDATE payment_instructions pi
+       SET due = 0
+      FROM payday_take_payments tp
+      JOIN current_payment_instructions cpi ON cpi.participant_id = tp.participant_id
+                                           AND cpi.team_id = tp.team_id
+     WHERE pi.id = cpi.id
+       AND cpi.due > 0;
+
+    INSERT INTO payday_payments (participant, team, amount, direction)
+         SELECT p.username, t.slug, tp.amount, 'to-participant'
+           FROM payday_take_payments tp
+           JOIN participants p ON p.id = tp.participant_id
+           JOIN teams t ON t.id = tp.team_id
+       ORDER BY tp.ord;
+
+""".format(TAKES)
+
+SET_BASED_REMAINDER = """
+
+    DROP TABLE IF EXISTS payday_draws;
+    CREATE TABLE payday_draws AS
+        SELECT pt.id AS team_id
+             , (SELECT id FROM participants WHERE username = pt.owner) AS participant_id
+             , pt.balance AS amount
+          FROM payday_teams pt
+         WHERE pt.balance <> 0
+           AND pt.is_drained IS NOT true;
+
+    UPDATE payday_participants p
+       SET new_balance = (new_balance + d.amount)
+      FROM ( SELECT participant_id, sum(amount) AS amount
+               FROM payday_draws
+           GROUP BY participant_id
+           ) d
+     WHERE p.id = d.participant_id;
+
+    UPDATE payment_instructions pi
+       SET due = 0
+      FROM payday_draws d
+      JOIN current_payment_instructions cpi ON cpi.participant_id = d.participant_id
+                                           AND cpi.team_id = d.team_id
+     WHERE pi.id = cpi.id
+       AND cpi.due > 0;
+
+    -- Like pay(), this fails loudly if an owner isn't in payday_participants.
+    INSERT INTO payday_payments (participant, team, amount, direction)
+         SELECT ( SELECT p.username
+                    FROM participants p
+                    JOIN payday_participants p2 ON p.id = p2.id
+                   WHERE p2.id = d.participant_id )
+              , t.slug
+              , d.amount
+              , 'to-participant'
+           FROM payday_draws d
+           JOIN teams t ON t.id = d.team_id
+       ORDER BY d.team_id;
+
+    -- process_draw cancels the update that fires it, so is_drained stays as it was.
+    UPDATE payday_teams t
+       SET balance = (balance - d.amount)
+      FROM payday_draws d
+     WHERE t.id = d.team_id;
+
+"""
+
+
+# The steps of payin, in order. We checkpoint after each one.
+
+PAYIN_STEPS = ( 'prepare'
+              , 'holds'
+              , 'payment_instructions'
+              , 'takes'
+              , 'remainder'
+              , 'settle'
+              , 'balances'
+               )
+
+
 class NoPayday(Exception):
     __str__ = lambda self: "No payday found where one was expected."
 
@@ -55,8 +312,15 @@ class Payday(object):
                 update_balances
                 take_over_balances
             update_stats
+                update_team_stats
+            close_balances
             end
 
+    By default money moves through the per-row triggers defined in
+    ``sql/payday.sql``. Set ``PAYDAY_SET_BASED`` (or pass ``--set-based`` to
+    the ``payday`` script) to use the set-based engine instead, which computes
+    the same payments and events in a handful of bulk statements.
+
     """
 
 
@@ -64,6 +328,9 @@ class Payday(object):
         self.runner = runner
         self.app = runner.app
         self.db = runner.app.db
+        self.threads = runner.app.env.payday_threads
+        self.set_based = runner.app.env.payday_set_based
+        self.payin_step = ''
 
 
     def run(self):
@@ -84,6 +351,7 @@ class Payday(object):
             self.mark_stage_done()
         if self.stage < 2:
             self.update_stats()
+            self.close_balances()
             self.mark_stage_done()
 
         self.end()
@@ -98,30 +366,86 @@ class Payday(object):
     def payin(self):
         """The first stage of payday where we charge credit cards and transfer
         money internally between participants.
+
+        Payin is broken into the steps listed in :py:data:`PAYIN_STEPS`. Each
+        step commits its work along with a checkpoint in ``paydays.payin_step``,
+        so a payday that crashes picks up at the step that failed. The
+        intermediate state lives in the ``payday_*`` tables, which are only
+        rebuilt by the ``prepare`` step.
+
         """
-        with self.db.get_cursor() as cursor:
-            self.prepare(cursor)
-            holds = self.create_card_holds(cursor)
-            self.process_payment_instructions(cursor)
-            self.process_takes(cursor, self.ts_start)
-            self.process_remainder(cursor)
-            _payments_for_debugging = cursor.all("""
-                SELECT * FROM payments WHERE "timestamp" > %s
-            """, (self.ts_start,))
-            try:
-                self.settle_card_holds(cursor, holds)
-                self.update_balances(cursor)
-                check_db(cursor)
-            except:
-                # Dump payments for debugging
-                import csv
-                from time import time
-                with open('%s_payments.csv' % time(), 'wb') as f:
-                    csv.writer(f).writerows(_payments_for_debugging)
-                raise
+        if self.payin_step:
+            log("Resuming payin after the %s step." % self.payin_step)
+
+        if not self.payin_step_done('prepare'):
+            with self.db.get_cursor() as cursor:
+                self.prepare(cursor)
+                self.mark_payin_step_done(cursor, 'prepare')
+
+        if not self.payin_step_done('holds'):
+            with self.db.get_cursor() as cursor:
+                holds = self.create_card_holds(cursor)
+                self.mark_payin_step_done(cursor, 'holds')
+        elif not self.payin_step_done('settle'):
+            holds = self.fetch_card_holds(set(self.db.all("""
+                SELECT id FROM payday_participants WHERE card_hold_ok
+            """)))
+
+        for step, process in ( ('payment_instructions', self.process_payment_instructions)
+                             , ('takes', lambda c: self.process_takes(c, self.ts_start))
+                             , ('remainder', self.process_remainder)
+                              ):
+            if not self.payin_step_done(step):
+                with self.db.get_cursor() as cursor:
+                    process(cursor)
+                    self.mark_payin_step_done(cursor, step)
+
+        _payments_for_debugging = self.db.all("""
+            SELECT * FROM payments WHERE "timestamp" > %s
+        """, (self.ts_start,))
+        try:
+            if not self.payin_step_done('settle'):
+                with self.db.get_cursor() as cursor:
+                    self.settle_card_holds(cursor, holds)
+                    self.mark_payin_step_done(cursor, 'settle')
+            if not self.payin_step_done('balances'):
+                with self.db.get_cursor() as cursor:
+                    self.update_balances(cursor)
+                    check_db(cursor)
+                    self.mark_payin_step_done(cursor, 'balances')
+        except:
+            # Dump payments for debugging, out of the way of the working tree
+            import csv
+            from tempfile import gettempdir
+            from time import time
+            path = os.path.join(gettempdir(), '%s_payments.csv' % time())
+            with open(path, 'wb') as f:
+                csv.writer(f).writerows(_payments_for_debugging)
+            log('Dumped payments to %s for debugging.' % path)
+            raise
         self.take_over_balances()
 
 
+    def payin_step_done(self, step):
+        """Return a boolean indicating whether the given payin step has been
+        completed for this payday.
+        """
+        if not self.payin_step:
+            return False
+        return PAYIN_STEPS.index(step) <= PAYIN_STEPS.index(self.payin_step)
+
+
+    def mark_payin_step_done(self, cursor, step):
+        self.payin_step = cursor.one("""\
+
+            UPDATE paydays
+               SET payin_step = %s
+             WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
+         RETURNING payin_step
+
+        """, (step,), default=NoPayday)
+
+
     @staticmethod
     def prepare(cursor):
         """Prepare the DB: we need temporary tables with indexes and triggers.
@@ -130,21 +454,29 @@ class Payday(object):
         log('Prepared the DB.')
 
 
-    @staticmethod
-    def fetch_card_holds(participant_ids):
+    def fetch_card_holds(self, participant_ids):
+        """Return a dict of the existing card holds we can reuse, and cancel
+        the rest.
+
+        Braintree's search results come in pages, so we cancel the holds we
+        don't need from a pool of threads while we keep paging.
+
+        """
         log('Fetching card holds.')
         holds = {}
         existing_holds = braintree.Transaction.search(
             braintree.TransactionSearch.status == 'authorized'
         )
-        for hold in existing_holds.items:
-            log_amount = hold.amount
-            p_id = int(hold.custom_fields['participant_id'])
-            if p_id in participant_ids:
-                log('Reusing a ${:.2f} hold for {}.'.format(log_amount, p_id))
-                holds[p_id] = hold
-            else:
-                cancel_card_hold(hold)
+        def unneeded():
+            for hold in existing_holds.items:
+                log_amount = hold.amount
+                p_id = int(hold.custom_fields['participant_id'])
+                if p_id in participant_ids:
+                    log('Reusing a ${:.2f} hold for {}.'.format(log_amount, p_id))
+                    holds[p_id] = hold
+                else:
+                    yield hold
+        threaded_pipeline(cancel_card_hold, unneeded(), self.threads)
         return holds
 
 
@@ -161,6 +493,8 @@ class Payday(object):
         if not participants:
             return {}
 
+        braintree_latencies.reset()
+
         # Fetch existing holds
         participant_ids = set(p.id for p in participants)
         holds = self.fetch_card_holds(participant_ids)
@@ -187,7 +521,8 @@ class Payday(object):
                     return 1
                 else:
                     holds[p.id] = hold
-        threaded_map(f, participants)
+        threaded_map(f, participants, self.threads)
+        self.log_latencies()
 
         # Update the values of card_hold_ok in our temporary table
         if not holds:
@@ -201,52 +536,42 @@ class Payday(object):
         return holds
 
 
-    @staticmethod
-    def process_payment_instructions(cursor):
+    def process_payment_instructions(self, cursor):
         """Trigger the process_payment_instructions function for each row in
-        payday_payment_instructions.
+        payday_payment_instructions, or fund them all at once if
+        :py:attr:`set_based` is on.
         """
         log("Processing payment instructions.")
-        cursor.run("UPDATE payday_payment_instructions SET is_funded=true;")
+        if self.set_based:
+            cursor.run(SET_BASED_PAYMENT_INSTRUCTIONS)
+        else:
+            cursor.run("UPDATE payday_payment_instructions SET is_funded=true;")
 
 
-    @staticmethod
-    def process_takes(cursor, ts_start):
+    def process_takes(self, cursor, ts_start):
         log("Processing takes.")
-        cursor.run("""
+        cursor.run("UPDATE payday_teams SET available_today = LEAST(available, balance);")
+        if self.set_based:
+            cursor.run(SET_BASED_TAKES, dict(ts_start=ts_start))
+        else:
+            cursor.run("""
 
-        UPDATE payday_teams SET available_today = LEAST(available, balance);
-
-        INSERT INTO payday_takes
-             SELECT team_id, participant_id, amount
-               FROM ( SELECT DISTINCT ON (team_id, participant_id)
-                             team_id, participant_id, amount, ctime
-                        FROM takes
-                       WHERE mtime < %(ts_start)s
-                    ORDER BY team_id, participant_id, mtime DESC
-                    ) t
-              WHERE t.amount > 0
-                AND t.team_id IN (SELECT id FROM payday_teams)
-                AND t.participant_id IN (SELECT id FROM payday_participants)
-                AND ( SELECT ppd.id
-                        FROM payday_payments_done ppd
-                        JOIN participants ON participants.id = t.participant_id
-                        JOIN teams ON teams.id = t.team_id
-                       WHERE participants.username = ppd.participant
-                         AND teams.slug = ppd.team
-                         AND direction = 'to-participant'
-                    ) IS NULL
-           ORDER BY t.team_id, t.amount ASC;
-
-        """, dict(ts_start=ts_start))
+            INSERT INTO payday_takes
+                 SELECT team_id, participant_id, amount
+                   FROM ({}) t
+               ORDER BY t.team_id, t.amount ASC, t.ctime ASC;
 
+            """.format(TAKES), dict(ts_start=ts_start))
 
-    @staticmethod
-    def process_remainder(cursor):
+
+    def process_remainder(self, cursor):
         """Send whatever remains after processing takes to the team owner.
         """
         log("Processing remainder.")
-        cursor.run("UPDATE payday_teams SET is_drained=true;")
+        if self.set_based:
+            cursor.run(SET_BASED_REMAINDER)
+        else:
+            cursor.run("UPDATE payday_teams SET is_drained=true;")
 
 
     def settle_card_holds(self, cursor, holds):
@@ -263,13 +588,21 @@ class Payday(object):
         def capture(p):
             amount = -p.new_balance
             capture_card_hold(self.db, p, amount, holds.pop(p.id))
-        threaded_map(capture, participants)
+        braintree_latencies.reset()
+        threaded_map(capture, participants, self.threads)
         log("Captured %i card holds." % len(participants))
 
         log("Canceling card holds.")
         # Cancel the remaining holds
-        threaded_map(cancel_card_hold, holds.values())
+        threaded_map(cancel_card_hold, holds.values(), self.threads)
         log("Canceled %i card holds." % len(holds))
+        self.log_latencies()
+
+
+    @staticmethod
+    def log_latencies():
+        for line in braintree_latencies.summarize():
+            log("Braintree " + line)
 
 
     @staticmethod
@@ -408,9 +741,57 @@ class Payday(object):
            WHERE id=%(payday)s
 
         """, {'payday': self.id})
+        self.update_team_stats()
         log("Updated payday stats.")
 
 
+    def update_team_stats(self):
+        """Recompute ``payday_team_stats`` for this payday and the one before it.
+
+        Each payday's row counts the payments to a team from when that payday
+        started until the next one did, so out-of-band payments made since the
+        last payday land on it, and the last payday's row is only final now.
+
+        """
+        self.db.run("""
+
+            DELETE FROM payday_team_stats
+                  WHERE payday IN ( SELECT id
+                                      FROM paydays
+                                     WHERE id <= %(payday)s
+                                  ORDER BY id DESC
+                                     LIMIT 2
+                                   );
+
+            INSERT INTO payday_team_stats (payday, team_id, nreceiving_from, receipts)
+                 SELECT pd.id, t.id, count(*), sum(p.amount)
+                   FROM ( SELECT id
+                               , ts_start
+                               , lead(ts_start) OVER (ORDER BY id) AS ts_next
+                            FROM paydays
+                        ) pd
+                   JOIN payments p ON p.timestamp >= pd.ts_start
+                                  AND (pd.ts_next IS NULL OR p.timestamp < pd.ts_next)
+                   JOIN teams t ON t.slug = p.team
+                  WHERE pd.id IN ( SELECT id
+                                     FROM paydays
+                                    WHERE id <= %(payday)s
+                                 ORDER BY id DESC
+                                    LIMIT 2
+                                  )
+                    AND p.direction = 'to-team'
+               GROUP BY pd.id, t.id;
+
+        """, {'payday': self.id})
+
+
+    def close_balances(self):
+        """Close any ``balances_at`` boundaries that went by since last payday.
+        """
+        with self.db.get_cursor() as cursor:
+            ledger.close_due(cursor, self.ts_start, self.app.env.ledger_monthly)
+
+
     def end(self):
         self.ts_end = self.db.one("""\
 
@@ -420,20 +801,62 @@ class Payday(object):
          RETURNING ts_end AT TIME ZONE 'UTC'
 
         """, default=NoPayday).replace(tzinfo=aspen.utils.utc)
+        self.app.payday_cache.invalidate()
 
 
     def notify_participants(self):
         log("Notifying participants.")
-        ts_start, ts_end = self.ts_start, self.ts_end
         exchanges = self.db.all("""
-            SELECT e.id, amount, fee, note, status, p.*::participants AS participant
-              FROM exchanges e
-              JOIN participants p ON e.participant = p.username
-             WHERE "timestamp" >= %(ts_start)s
-               AND "timestamp" < %(ts_end)s
-               AND amount > 0
-               AND p.notify_charge > 0
-        """, locals())
+            WITH charged AS (
+                     SELECT e.id, e.amount, e.fee, e.note, e.status
+                          , p.*::participants AS participant
+                          , p.id AS participant_id
+                       FROM exchanges e
+                       JOIN participants p ON e.participant = p.username
+                      WHERE "timestamp" >= %(ts_start)s
+                        AND "timestamp" < %(ts_end)s
+                        AND amount > 0
+                        AND p.notify_charge > 0
+                 )
+               , tippees AS (
+                     SELECT s.participant_id, t.slug, s.amount
+                       FROM ( SELECT DISTINCT ON (participant_id, team_id)
+                                     participant_id, team_id, amount
+                                FROM payment_instructions
+                               WHERE mtime < %(ts_start)s
+                                 AND participant_id IN (SELECT participant_id FROM charged)
+                            ORDER BY participant_id, team_id, mtime DESC
+                            ) s
+                       JOIN teams t ON s.team_id = t.id
+                       JOIN participants p ON t.owner = p.username
+                      WHERE s.amount > 0
+                        AND t.is_approved IS true
+                        AND t.is_closed IS NOT true
+                        AND EXISTS ( SELECT 1
+                                       FROM current_exchange_routes er
+                                      WHERE er.participant = p.id
+                                        AND network = 'paypal'
+                                        AND error = ''
+                                   )
+                 )
+               , nteams AS (
+                     SELECT participant_id, count(*) AS nteams
+                       FROM tippees
+                   GROUP BY participant_id
+                 )
+               , top_teams AS (
+                     SELECT DISTINCT ON (participant_id) participant_id, slug AS top_team
+                       FROM tippees
+                   ORDER BY participant_id, amount DESC
+                 )
+            SELECT c.id, c.amount, c.fee, c.note, c.status, c.participant
+                 , COALESCE(n.nteams, 0) AS nteams
+                 , tt.top_team
+              FROM charged c
+         LEFT JOIN nteams n ON n.participant_id = c.participant_id
+         LEFT JOIN top_teams tt ON tt.participant_id = c.participant_id
+        """, dict(ts_start=self.ts_start, ts_end=self.ts_end))
+        messages = []
         for e in exchanges:
             if e.status not in ('failed', 'succeeded'):
                 log('exchange %s has an unexpected status: %s' % (e.id, e.status))
@@ -442,43 +865,12 @@ class Payday(object):
             p = e.participant
             if p.notify_charge & i == 0:
                 continue
-            participant_id = p.id
-            nteams, top_team = self.db.one("""
-                WITH tippees AS (
-                         SELECT t.slug, amount
-                           FROM ( SELECT DISTINCT ON (team_id) team_id, amount
-                                    FROM payment_instructions
-                                   WHERE mtime < %(ts_start)s
-                                     AND participant_id = %(participant_id)s
-                                ORDER BY team_id, mtime DESC
-                                ) s
-                           JOIN teams t ON s.team_id = t.id
-                           JOIN participants p ON t.owner = p.username
-                          WHERE s.amount > 0
-                            AND t.is_approved IS true
-                            AND t.is_closed IS NOT true
-                            AND (SELECT count(*)
-                                   FROM current_exchange_routes er
-                                  WHERE er.participant = p.id
-                                    AND network = 'paypal'
-                                    AND error = ''
-                                ) > 0
-                     )
-                SELECT ( SELECT count(*) FROM tippees ) AS nteams
-                     , ( SELECT slug
-                           FROM tippees
-                       ORDER BY amount DESC
-                          LIMIT 1
-                       ) AS top_team
-            """, locals())
-            self.app.email_queue.put(
-                p,
-                'charge_'+e.status,
+            messages.append((p, 'charge_'+e.status, dict(
                 exchange=dict(id=e.id, amount=e.amount, fee=e.fee, note=e.note),
-                nteams=nteams,
-                top_team=top_team,
-                _user_initiated=False
-            )
+                nteams=e.nteams,
+                top_team=e.top_team,
+            )))
+        self.app.email_queue.put_all(messages, _user_initiated=False)
 
 
     def mark_stage_done(self):
@@ -0,0 +1,171 @@
+"""Simulate payday to find out how long it will take and what it will move.
+
+A simulated payday runs the same payin steps as a real one, but all inside a
+single database transaction that is rolled back at the end, and with a
+stand-in for Braintree: we assume that every card hold we ask for succeeds and
+that every capture goes through.
+
+The transaction takes row locks on ``participants`` for as long as the
+simulation runs, so point it at a copy of the production database (see
+``bin/restore-dump``) rather than at production itself.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+import aspen.utils
+from aspen import log
+from gratipay.billing.exchanges import MINIMUM_CHARGE, _prep_hit, upcharge
+from gratipay.billing.payday import Payday
+from gratipay.models import check_db
+
+
+class PaydayInProgress(Exception):
+    __str__ = lambda self: "Can't simulate a payday while a real one is in progress."
+
+
+class SimulatedPayday(Payday):
+    """Run payin without committing anything or calling out to Braintree.
+    """
+
+    def __init__(self, runner):
+        super(SimulatedPayday, self).__init__(runner)
+        self.timings = []
+        self.ncaptures = 0
+        self.capture_volume = 0
+        self.ncancels = 0
+
+
+    def simulate(self):
+        """Run a simulated payin and return a report about it.
+
+        :returns: a ``dict`` with ``timings``, a list of ``(step, seconds)``
+            tuples in the order the steps ran, and ``counts``, a ``dict`` of row
+            counts and money totals
+
+        """
+        with self.db.get_cursor() as cursor:
+            cursor.run("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            if cursor.one("""
+                SELECT id FROM paydays WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
+            """):
+                raise PaydayInProgress
+            d = cursor.one("""
+                INSERT INTO paydays DEFAULT VALUES
+                RETURNING id, (ts_start AT TIME ZONE 'UTC') AS ts_start
+            """)
+            self.id = d.id
+            self.ts_start = d.ts_start.replace(tzinfo=aspen.utils.utc)
+            log("Simulating payday.")
+
+            self.timed('prepare', self.prepare, cursor)
+            holds = self.timed('holds', self.create_card_holds, cursor)
+            self.timed('payment_instructions', self.process_payment_instructions, cursor)
+            self.timed('takes', self.process_takes, cursor, self.ts_start)
+            self.timed('remainder', self.process_remainder, cursor)
+            self.timed('settle', self.settle_card_holds, cursor, holds)
+            self.timed('balances', self.update_balances, cursor)
+            self.timed('check_db', check_db, cursor)
+
+            report = dict(timings=self.timings, counts=self.count(cursor))
+            cursor.connection.rollback()
+
+        log("Rolled back the simulated payday.")
+        return report
+
+
+    def timed(self, step, func, *args):
+        start = time.time()
+        out = func(*args)
+        self.timings.append((step, time.time() - start))
+        return out
+
+
+    def create_card_holds(self, cursor):
+        """Pretend that every card hold we would ask for succeeds.
+
+        :returns: a ``dict`` mapping participant ids to hold amounts
+
+        """
+        holds = cursor.all("""
+            UPDATE payday_participants
+               SET card_hold_ok = true
+             WHERE old_balance < giving_today
+               AND has_credit_card
+               AND is_suspicious IS false
+               AND giving_today - old_balance >= %s
+         RETURNING id, giving_today - old_balance AS amount
+        """, (MINIMUM_CHARGE,))
+        return dict((p_id, upcharge(amount)[0]) for p_id, amount in holds)
+
+
+    def settle_card_holds(self, cursor, holds):
+        """Pretend to capture the holds we need and cancel the rest.
+
+        Captures are recorded as exchanges inside our doomed transaction, so
+        that balances come out the way they would for real.
+
+        """
+        participants = cursor.all("""
+            SELECT *
+              FROM payday_participants
+             WHERE new_balance < 0
+        """)
+        participants = [p for p in participants if p.id in holds]
+        for p in participants:
+            cents, amount_str, charge_amount, fee = _prep_hit(-p.new_balance)
+            amount = charge_amount - fee
+            cursor.run("""
+                INSERT INTO exchanges
+                            (amount, fee, participant, status, route, note, ref)
+                     VALUES ( %(amount)s, %(fee)s, %(username)s, 'succeeded'
+                            , ( SELECT id
+                                  FROM current_exchange_routes
+                                 WHERE participant = %(id)s
+                                   AND network = 'braintree-cc'
+                               )
+                            , 'simulated', NULL
+                             );
+                UPDATE participants SET balance = (balance + %(amount)s) WHERE id = %(id)s;
+            """, dict(amount=amount, fee=fee, username=p.username, id=p.id))
+            self.capture_volume += charge_amount
+        self.ncaptures = len(participants)
+        self.ncancels = len(holds) - len(participants)
+
+
+    def count(self, cursor):
+        counts = cursor.one("""
+            SELECT ( SELECT count(*) FROM payday_participants ) AS nparticipants
+                 , ( SELECT count(*) FROM payday_teams ) AS nteams
+                 , ( SELECT count(*) FROM payday_payment_instructions ) AS ninstructions
+                 , ( SELECT count(*)
+                       FROM payday_payment_instructions
+                      WHERE is_funded
+                   ) AS nfunded
+                 , ( SELECT count(*)
+                       FROM payday_participants
+                      WHERE card_hold_ok
+                   ) AS nholds
+                 , ( SELECT count(*)
+                       FROM payday_payments
+                      WHERE direction = 'to-team'
+                   ) AS npayments_to_teams
+                 , ( SELECT COALESCE(sum(amount), 0)
+                       FROM payday_payments
+                      WHERE direction = 'to-team'
+                   ) AS volume_to_teams
+                 , ( SELECT count(*)
+                       FROM payday_payments
+                      WHERE direction = 'to-participant'
+                   ) AS npayments_to_participants
+                 , ( SELECT COALESCE(sum(amount), 0)
+                       FROM payday_payments
+                      WHERE direction = 'to-participant'
+                   ) AS volume_to_participants
+        """)._asdict()
+        counts.update( ncaptures=self.ncaptures
+                     , capture_volume=self.capture_volume
+                     , ncancels=self.ncancels
+                      )
+        return counts
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys
+import time
+
+from gratipay.application import Application
+
+
+def benchmark(queue, n=1000, cold=False):
+    """Render (but don't send) up to ``n`` messages from the email queue.
+
+    :param Queue queue: the email queue to render from
+    :param bool cold: whether to forget memoized helpers and base renderings
+        before each message
+
+    :returns: a ``(nrendered, seconds)`` tuple
+
+    """
+    with queue.db.get_cursor() as cursor:
+        messages = cursor.all("""
+            SELECT *
+              FROM email_queue
+             WHERE not dead
+          ORDER BY id ASC
+             LIMIT %s
+        """, (n,))
+        start = time.time()
+        participants = queue._load_participants(cursor, messages) if messages else {}
+        for rec in messages:
+            if cold:
+                queue.clear_render_caches()
+            queue._prepare_email_message_for_ses(rec, participants[rec.participant])
+        return len(messages), time.time() - start
+
+
+def main(_argv=sys.argv, _print=print, _app=None):
+    """This is a script to measure how fast we render queued email messages.
+
+    Usage: bench-email-render [N] [--cold]
+
+    It renders the first ``N`` messages in the queue (1000 by default) without
+    sending them, and prints how many messages per second it managed. Pass
+    ``--cold`` to render each message from scratch, for comparison. Queue up
+    some messages first (``queue-branch-email`` against a local database is
+    handy for that).
+
+    """
+    app = _app or Application()
+    args = [arg for arg in _argv[1:] if not arg.startswith('--')]
+    n = int(args[0]) if args else 1000
+    nrendered, seconds = benchmark(app.email_queue, n, cold='--cold' in _argv[1:])
+    rate = nrendered / seconds if seconds else 0
+    _print("Rendered {} messages in {:.3f}s ({:.1f} messages/sec).".format(nrendered, seconds, rate))
@@ -1,15 +1,41 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import sys
+
 from gratipay.application import Application
 
 
-def main():
+def main(_argv=sys.argv, _print=print):
+    """This is a script to run payday.
+
+    Pass ``--simulate`` to run payin inside a transaction that is rolled back,
+    with a stand-in for Braintree, and print how long each step took and what
+    it would have moved. Pass ``--set-based`` to run (or simulate) with the
+    set-based engine whatever ``PAYDAY_SET_BASED`` says.
+
+    """
     try:
-        Application().payday_runner.run_payday()
+        runner = Application().payday_runner
+        set_based = True if '--set-based' in _argv[1:] else None
+        if '--simulate' in _argv[1:]:
+            report = runner.simulate_payday(set_based=set_based)
+            print_report(report, _print)
+        else:
+            runner.run_payday(set_based=set_based)
     except KeyboardInterrupt:
         pass
     except:
         import aspen
         import traceback
         aspen.log(traceback.format_exc())
+
+
+def print_report(report, _print=print):
+    _print("Timings:")
+    for step, seconds in report['timings']:
+        _print("  {:<24} {:>10.3f}s".format(step, seconds))
+    _print("  {:<24} {:>10.3f}s".format('total', sum(s for _, s in report['timings'])))
+    _print("Counts:")
+    for key, value in sorted(report['counts'].items()):
+        _print("  {:<28} {:>14}".format(key, value))
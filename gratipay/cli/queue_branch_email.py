@@ -82,8 +82,10 @@ def main(_argv=sys.argv, _input=raw_input, _print=print, _app=None):
     if username == 'all':
         prompt("But really actually tho? I mean, ... seriously?")
 
+    n = app.email_queue.put_many(participants, 'branch', include_unsubscribe=False,
+                                 _user_initiated=False)
     for i, p in enumerate(participants, start=1):
-        _print( "{:>4} queuing for {} ({}={})".format(i, p.email_address, p.username, p.id)
+        _print( "{:>4} queued for {} ({}={})".format(i, p.email_address, p.username, p.id)
               , file=sys.stderr
                )
-        app.email_queue.put(p, 'branch', include_unsubscribe=False, _user_initiated=False)
+    _print("Queued {} of {}.".format(n, N))
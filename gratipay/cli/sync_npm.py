@@ -7,18 +7,32 @@ import sys
 import argparse
 
 from gratipay import wireup
-from gratipay.sync_npm import serialize, upsert
+from gratipay.sync_npm import bench, changes, run, serialize, upsert
 
 
 def parse_args(argv):
     p = argparse.ArgumentParser()
-    p.add_argument('command', choices=['serialize', 'upsert'])
-    p.add_argument('path', help='the path to the input file', nargs='?', default='/dev/stdin')
-    return p.parse_args(argv)
+    p.add_argument('command', choices=['serialize', 'upsert', 'run', 'changes', 'bench'])
+    p.add_argument('path', help='the path to the input file', nargs='?')
+    p.add_argument('-j', '--jobs', type=int, default=0,
+                   help='serialize using this many worker processes')
+    p.add_argument('--binary', action='store_true',
+                   help="use Postgres's binary COPY format instead of CSV")
+    p.add_argument('--prune', action='store_true',
+                   help='given a full dump, delete packages that are missing from it')
+    p.add_argument('--packages', type=int, default=10000,
+                   help='how many packages to put in the synthetic dump for bench')
+    args = p.parse_args(argv)
+    if args.path is None and args.command != 'bench':
+        args.path = changes.REGISTRY_CHANGES_URL if args.command == 'changes' else '/dev/stdin'
+    return args
 
 
 subcommands = { 'serialize': serialize.main
               , 'upsert': upsert.main
+              , 'run': run.main
+              , 'changes': changes.main
+              , 'bench': bench.main
                }
 
 
@@ -28,9 +42,16 @@ def main(argv=sys.argv):
 
     Usage::
 
-      sync-npm {serialize,upsert} {<filepath>}
+      sync-npm {serialize,upsert,run,changes,bench} {<filepath>} [--jobs N] [--binary]
+                                                     [--prune] [--packages N]
 
-    ``<filepath>`` defaults to stdin.
+    ``<filepath>`` defaults to stdin, except for ``changes``, where it's a URL
+    or file for npm's changes feed, and defaults to npm's replication endpoint.
+    ``run`` does ``serialize`` and ``upsert`` in one process, merging as it
+    goes. ``--jobs`` applies to ``serialize`` and ``run``, ``--binary`` to
+    ``serialize``, ``upsert`` and ``run`` (use it for both ends of a pipe), and
+    ``--prune`` to ``upsert`` and ``run``. ``bench`` times the others against
+    a synthetic dump of ``--packages`` packages, or against ``<filepath>``.
 
     .. note:: Sphinx is expanding ``sys.argv`` in the parameter list. Sorry. :-/
 
@@ -1,21 +1,29 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import json
 import os
 import pickle
 import sys
-from time import sleep
+import threading
+import traceback
+from datetime import date, datetime
+from decimal import Decimal
 
 import boto3
 from aspen import log_dammit
 from aspen.simplates.pagination import parse_specline, split_and_escape
 from aspen_jinja2_renderer import SimplateLoader
+from dateutil.parser import parse as parse_datetime
 from jinja2 import Environment
 from markupsafe import escape as htmlescape
+from psycopg2 import Binary
 
 from gratipay.exceptions import Throttled
 from gratipay.models.participant import Participant
 from gratipay.utils import find_files, i18n
+from gratipay.utils.threaded_map import threaded_map
+from gratipay.utils.timer import SharedTokenBucket
 
 
 class Queue(object):
@@ -36,7 +44,8 @@ class Queue(object):
 
         self.db = db
         self.tell_sentry = tell_sentry
-        self.sleep_for = env.email_queue_sleep_for
+        self.rate_limiter = SharedTokenBucket(db, 'email_queue', env.email_queue_send_rate)
+        self.threads = env.email_queue_threads
         self.allow_up_to = env.email_queue_allow_up_to
 
         templates = {}
@@ -47,6 +56,9 @@ class Queue(object):
             base_name = spt[i:-4]
             templates[base_name] = compile_email_spt(spt)
         self._email_templates = templates
+        self._helpers = {}
+        self._rendered_base = {}
+        self._render_caches_lock = threading.Lock()  # flush renders from many threads
 
 
     def _have_ses(self, env):
@@ -78,7 +90,7 @@ class Queue(object):
                 INSERT INTO email_queue
                             (participant, spt_name, context, user_initiated)
                      VALUES (%s, %s, %s, %s)
-            """, (to.id, template, pickle.dumps(context), _user_initiated))
+            """, (to.id, template, encode_context(context), _user_initiated))
             if _user_initiated:
                 n = cursor.one('SELECT count(*) FROM email_queue '
                                'WHERE participant=%s AND user_initiated', (to.id,))
@@ -86,52 +98,215 @@ class Queue(object):
                     raise Throttled()
 
 
-    def flush(self):
-        """Load messages queued for sending, and send them.
+    def put_all(self, messages, _user_initiated=True):
+        """Put a batch of email messages on the queue in one go.
+
+        :param messages: an iterable of ``(to, template, context)`` tuples,
+            with the same meanings as the arguments to :py:meth:`put`
+        :param bool _user_initiated: as for :py:meth:`put`
+
+        User-initiated messages that would put a participant over the throttling
+        limit are dropped rather than raising :py:exc:`Throttled`, so that one
+        participant can't sink the whole batch.
+
+        :returns: the number of messages queued
+
         """
-        fetch_messages = lambda: self.db.all("""
-            SELECT *
+        rows = [ (to.id, template, encode_context(context), _user_initiated)
+                 for to, template, context in messages
+                ]
+        return self._put_rows(rows, _user_initiated)
+
+
+    def put_many(self, participants, template, _user_initiated=True, **context):
+        """Put the same email message on the queue for many participants.
+
+        :param participants: an iterable of :py:class:`Participant` objects
+        :param unicode template: as for :py:meth:`put`
+        :param bool _user_initiated: as for :py:meth:`put_all`
+        :param dict context: the values to use when rendering the template,
+            shared by every message
+
+        This is :py:meth:`put_all`, except that the context is only encoded
+        once.
+
+        :returns: the number of messages queued
+
+        """
+        context = encode_context(context)
+        rows = [(p.id, template, context, _user_initiated) for p in participants]
+        return self._put_rows(rows, _user_initiated)
+
+
+    def _put_rows(self, rows, _user_initiated):
+        with self.db.get_cursor() as cursor:
+            if _user_initiated:
+                rows = self._drop_throttled(cursor, rows)
+            self._insert(cursor, rows)
+        return len(rows)
+
+
+    def _drop_throttled(self, cursor, rows):
+        queued = dict(cursor.all("""
+            SELECT participant, count(*)
               FROM email_queue
-             WHERE not dead
-          ORDER BY id ASC
-             LIMIT 60
-        """)
+             WHERE participant = ANY(%s)
+               AND user_initiated
+          GROUP BY participant
+        """, (list(set(row[0] for row in rows)),)))
+        out = []
+        for row in rows:
+            n = queued.get(row[0], 0) + 1
+            if n > self.allow_up_to:
+                continue
+            queued[row[0]] = n
+            out.append(row)
+        return out
+
+
+    @staticmethod
+    def _insert(cursor, rows, chunk_size=1000):
+        """Insert ``(participant, spt_name, context, user_initiated)`` rows into
+        the queue with multi-row INSERTs.
+        """
+        for i in range(0, len(rows), chunk_size):
+            values = b', '.join( cursor.mogrify(b'(%s, %s, %s, %s)', row)
+                                 for row in rows[i:i+chunk_size]
+                                )
+            cursor.run(b"""
+                INSERT INTO email_queue
+                            (participant, spt_name, context, user_initiated)
+                     VALUES """ + values)
+
+
+    def flush(self, batch_size=60):
+        """Load messages queued for sending, and send them.
+
+        :param int batch_size: the number of messages to claim at a time
+
+        Each batch is sent by a pool of ``EMAIL_QUEUE_THREADS`` threads, paced
+        to ``EMAIL_QUEUE_SEND_RATE`` messages per second across every process
+        that's flushing, and then deleted from the queue in one go. If some
+        messages in a batch fail to send, we still send the rest, mark the
+        failures as dead letters, and then re-raise the first exception.
+
+        It's safe to flush from more than one process at once. See
+        :py:meth:`_claim`.
+
+        :returns: the number of messages sent
+
+        """
         nsent = 0
         while True:
-            messages = fetch_messages()
-            if not messages:
-                break
-            for rec in messages:
-                try:
-                    r = self._flush_one(rec)
-                except:
-                    self.db.run("UPDATE email_queue SET dead=true WHERE id = %s", (rec.id,))
-                    raise
-                self.db.run("DELETE FROM email_queue WHERE id = %s", (rec.id,))
-                if r == 1:
-                    sleep(self.sleep_for)
-                nsent += r
+            with self.db.get_cursor() as cursor:
+                messages = self._claim(cursor, batch_size)
+                if not messages:
+                    break
+                participants = self._load_participants(cursor, messages)
+                flush_one = lambda rec: self._try_to_flush_one(rec, participants[rec.participant])
+                results = threaded_map(flush_one, messages, self.threads)
+                done = [rec.id for rec, (r, error) in zip(messages, results) if error is None]
+                dead = [rec.id for rec, (r, error) in zip(messages, results) if error]
+                cursor.run("DELETE FROM email_queue WHERE id = ANY(%s)", (done,))
+                if dead:
+                    cursor.run("UPDATE email_queue SET dead=true WHERE id = ANY(%s)", (dead,))
+                nsent += sum(r for r, error in results)
+            errors = [error for r, error in results if error]
+            if errors:
+                print(errors[0][1])
+                raise errors[0][0]
         return nsent
 
 
-    def _flush_one(self, rec):
+    def _claim(self, cursor, batch_size):
+        """Claim up to ``batch_size`` messages for the current transaction.
+
+        We'd use ``FOR UPDATE SKIP LOCKED`` here, but that needs Postgres 9.5.
+        Instead we take a transaction-level advisory lock on each message id
+        (namespaced by the table's oid), skipping the ones another flusher
+        already holds. The locks go away when the transaction ends, so a
+        flusher that dies mid-batch leaves its messages for the next one.
+
+        The advisory locks are taken in the inner query's snapshot, which can
+        include messages that another flusher sent and deleted after we
+        started. We lock first and then load, so that the second statement's
+        snapshot filters those out.
+
+        :returns: a list of records from the ``email_queue`` table
+
+        """
+        ids = cursor.all("""
+            SELECT id
+              FROM ( SELECT id
+                       FROM email_queue
+                      WHERE not dead
+                   ORDER BY id ASC
+                      LIMIT %s
+                    ) candidates
+             WHERE pg_try_advisory_xact_lock('email_queue'::regclass::oid::int, id)
+             LIMIT %s
+        """, (batch_size * 10, batch_size))
+        if not ids:
+            return []
+        return cursor.all("""
+            SELECT *
+              FROM email_queue
+             WHERE id = ANY(%s)
+               AND not dead
+          ORDER BY id ASC
+        """, (ids,))
+
+
+    @staticmethod
+    def _load_participants(cursor, messages):
+        """Load the recipients of a batch of messages with one query.
+
+        :returns: a ``dict`` mapping participant ids to :py:class:`Participant`
+            objects
+
+        """
+        participants = cursor.all("""
+            SELECT p.*::participants
+              FROM participants p
+             WHERE id = ANY(%s)
+        """, (list(set(rec.participant for rec in messages)),))
+        return dict((p.id, p) for p in participants)
+
+
+    def _try_to_flush_one(self, rec, to=None):
+        """Call :py:meth:`_flush_one`, catching any exception.
+
+        :returns: a ``(nsent, error)`` tuple, where ``error`` is ``None`` or an
+            ``(exception, traceback)`` tuple
+
+        """
+        try:
+            return self._flush_one(rec, to), None
+        except Exception as e:
+            return 0, (e, traceback.format_exc())
+
+
+    def _flush_one(self, rec, to=None):
         """Send an email message using the underlying ``_mailer``.
 
         :param Record rec: a database record from the ``email_queue`` table
+        :param Participant to: the recipient, if we've already loaded them
         :return int: the number of emails sent (0 or 1)
 
         """
-        message = self._prepare_email_message_for_ses(rec)
+        message = self._prepare_email_message_for_ses(rec, to)
         if message is None:
             return 0 # Not sent
+        self.rate_limiter.take()
         self._mailer.send_email(**message)
         return 1 # Sent
 
 
-    def _prepare_email_message_for_ses(self, rec):
+    def _prepare_email_message_for_ses(self, rec, to=None):
         """Prepare an email message for delivery via Amazon SES.
 
         :param Record rec: a database record from the ``email_queue`` table
+        :param Participant to: the recipient; we load them if not given
 
         :returns: ``None`` if we can't find an email address to send to
         :returns: ``dict`` if we can find an email address to send to
@@ -142,9 +317,9 @@ class Queue(object):
         #. ``participant.email_address``.
 
         """
-        to = Participant.from_id(rec.participant)
+        to = to or Participant.from_id(rec.participant)
         spt = self._email_templates[rec.spt_name]
-        context = pickle.loads(rec.context)
+        context = decode_context(rec.context)
 
         context['participant'] = to
         context['username'] = to.username
@@ -159,14 +334,11 @@ class Queue(object):
             return None
         langs = i18n.parse_accept_lang(to.email_lang or 'en')
         locale = i18n.match_lang(langs)
-        i18n.add_helpers_to_context(self.tell_sentry, context, locale)
-        context['escape'] = lambda s: s
         context_html = dict(context)
-        i18n.add_helpers_to_context(self.tell_sentry, context_html, locale)
-        context_html['escape'] = htmlescape
-        base_spt = self._email_templates['base']
+        self._add_helpers(context, locale, html=False)
+        self._add_helpers(context_html, locale, html=True)
         def render(t, context):
-            b = base_spt[t].render(context).strip()
+            b = self._render_base(t, context)
             return b.replace('$body', spt[t].render(context).strip())
 
         message = {}
@@ -187,6 +359,151 @@ class Queue(object):
         return message
 
 
+    def _add_helpers(self, context, locale, html):
+        """Add the i18n helpers for a locale to ``context``.
+
+        ``ngettext`` hands the context it's bound to to ``tell_sentry`` when a
+        translation is broken, so we bind it to ``context`` itself, so that
+        Sentry hears about the message we were rendering.
+
+        """
+        context.update(self._get_helpers(locale, html))
+        context['ngettext'] = \
+            lambda *a, **kw: i18n.n_get_text(self.tell_sentry, context, locale, *a, **kw)
+
+
+    def _get_helpers(self, locale, html):
+        """Return the i18n helpers for a locale, building them the first time.
+
+        The other helpers only look at the context they're bound to for
+        ``escape``, so we bind them to a ``dict`` of their own and share that
+        between messages.
+
+        """
+        key = (locale, html)
+        with self._render_caches_lock:
+            helpers = self._helpers.get(key)
+            if helpers is None:
+                helpers = {}
+                i18n.add_helpers_to_context(self.tell_sentry, helpers, locale)
+                helpers['escape'] = htmlescape if html else (lambda s: s)
+                self._helpers[key] = helpers
+        return helpers
+
+
+    def _render_base(self, content_type, context):
+        """Render the ``base`` template, or reuse an earlier rendering of it.
+
+        The base template only depends on the locale and on
+        ``include_unsubscribe``, so that's what we key renderings on. If you
+        add anything else to ``emails/base.spt``, add it to the key here too.
+
+        """
+        key = (content_type, context['locale'], bool(context['include_unsubscribe']))
+        with self._render_caches_lock:
+            base = self._rendered_base.get(key)
+            if base is None:
+                base = self._email_templates['base'][content_type].render(context).strip()
+                self._rendered_base[key] = base
+        return base
+
+
+    def clear_render_caches(self):
+        """Forget memoized i18n helpers and base template renderings.
+        """
+        with self._render_caches_lock:
+            self._helpers.clear()
+            self._rendered_base.clear()
+
+
+# Contexts
+# ========
+#
+# We store the context for each message as a version byte followed by the
+# encoded context. Version 1 is JSON, with Decimals and datetimes tagged so
+# that they come back as what they went in as. Rows queued before we had
+# versions are pickles, which never start with \x01.
+
+CONTEXT_V1 = b'\x01'
+
+
+def _encode_value(o):
+    if isinstance(o, Decimal):
+        return {'$decimal': str(o)}
+    if isinstance(o, datetime):
+        return {'$datetime': o.isoformat()}
+    if isinstance(o, date):
+        return {'$date': o.isoformat()}
+    raise TypeError("Can't put a {} in an email context.".format(type(o).__name__))
+
+
+def _decode_value(d):
+    if len(d) == 1:
+        if '$decimal' in d:
+            return Decimal(d['$decimal'])
+        if '$datetime' in d:
+            return parse_datetime(d['$datetime'])
+        if '$date' in d:
+            return parse_datetime(d['$date']).date()
+    return d
+
+
+def encode_context(context):
+    """Encode an email context for the ``email_queue.context`` column.
+
+    :param dict context: the values to use when rendering the template;
+        strings, numbers, booleans, ``None``, ``Decimal``, ``datetime`` and
+        ``date`` objects, and lists and dicts of those
+
+    :raises TypeError: if there's something else in ``context``
+
+    :returns: a :py:func:`psycopg2.Binary` wrapping the encoded context
+
+    """
+    encoded = json.dumps(context, default=_encode_value, separators=(',', ':'))
+    return Binary(CONTEXT_V1 + encoded.encode('ascii'))
+
+
+def decode_context(blob):
+    """Decode an email context from the ``email_queue.context`` column.
+
+    :param blob: the column value, as a ``buffer`` or ``bytes``
+    :returns: a ``dict``
+
+    """
+    blob = bytes(blob)
+    if blob[:1] == CONTEXT_V1:
+        return json.loads(blob[1:].decode('ascii'), object_hook=_decode_value)
+    return pickle.loads(blob)  # queued before we had versions
+
+
+def reencode_pickled_contexts(db, chunk_size=1000):
+    """Convert contexts queued before we had versions to the current version.
+
+    :returns: the number of messages converted
+
+    """
+    n = 0
+    while True:
+        with db.get_cursor() as cursor:
+            messages = cursor.all("""
+                SELECT id, context
+                  FROM email_queue
+                 WHERE get_byte(context, 0) <> 1
+              ORDER BY id ASC
+                 LIMIT %s
+                   FOR UPDATE
+            """, (chunk_size,))
+            for rec in messages:
+                cursor.run( "UPDATE email_queue SET context=%s WHERE id=%s"
+                          , (encode_context(decode_context(rec.context)), rec.id)
+                           )
+        if not messages:
+            break
+        n += len(messages)
+    return n
+
+
 jinja_env = Environment()
 jinja_env_html = Environment(autoescape=True, extensions=['jinja2.ext.autoescape'])
 
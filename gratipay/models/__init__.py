@@ -8,12 +8,14 @@ everything on Gratipay.
 """
 from contextlib import contextmanager
 
-from postgres import Postgres
+import psycopg2
+from postgres import Postgres, url_to_dsn
 
 from .account_elsewhere import AccountElsewhere
 from .community import Community
 from .country import Country
 from .exchange_route import ExchangeRoute
+from .package import Package
 from .participant import Participant
 from .team import Team
 
@@ -32,7 +34,11 @@ class GratipayDB(Postgres):
         ``.app``.
         """
         Postgres.__init__(self, *a, **kw)
-        for model in (AccountElsewhere, Community, Country, ExchangeRoute, Participant, Team):
+        url = kw['url'] if 'url' in kw else a[0]
+        self.dsn = url_to_dsn(url) if url.startswith('postgres://') else url
+        for model in ( AccountElsewhere, Community, Country, ExchangeRoute, Package, Participant
+                     , Team
+                      ):
             self.register_model(model)
             model.app = app
 
@@ -43,6 +49,22 @@ class GratipayDB(Postgres):
             return just_yield(cursor)
         return super(GratipayDB, self).get_cursor(**kw)
 
+    @contextmanager
+    def get_dedicated_connection(self):
+        """Yield a new connection of its own, outside of the pool, and close it
+        afterwards.
+
+        Use this for work that holds on to a connection for as long as a client
+        wants it, like streaming an export, so that slow clients can't use up
+        the pool that every request draws from.
+
+        """
+        connection = psycopg2.connect(self.dsn)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
     def self_check(self):
         with self.get_cursor() as cursor:
             check_db(cursor)
@@ -0,0 +1,119 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from postgres.orm import Model
+
+
+NPM = 'npm'  # We are starting with a single package manager. If we see
+             # traction we will expand.
+
+SEARCH_LIMIT = 100
+
+# pg_trgm can't pick trigrams out of anything shorter, so shorter queries only
+# match on name prefixes.
+SEARCH_TRIGRAM_MIN_LENGTH = 3
+
+
+def escape_like(s):
+    """Escape the ``LIKE`` wildcards in ``s``.
+    """
+    return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class Package(Model):
+    """Represent a package from a package manager (npm, for now).
+    """
+
+    typname = 'packages'
+
+    def __eq__(self, other):
+        if not isinstance(other, Package):
+            return False
+        return self.id == other.id
+
+    def __ne__(self, other):
+        if not isinstance(other, Package):
+            return True
+        return self.id != other.id
+
+
+    @property
+    def remote_human_url(self):
+        if self.package_manager == NPM:
+            return 'https://npmjs.com/package/{}'.format(self.name)
+        raise NotImplementedError()
+
+
+    @classmethod
+    def from_names(cls, package_manager, name):
+        """Return a :py:class:`Package` for the given names, or ``None``.
+        """
+        return cls.db.one("""
+            SELECT packages.*::packages
+              FROM packages
+             WHERE package_manager=%s
+               AND name=%s
+        """, (package_manager, name))
+
+
+    @classmethod
+    def search(cls, query, package_manager=NPM, limit=10):
+        """Find packages by name prefix, or by names or descriptions that look
+        like ``query``.
+
+        Exact matches come first, then names that start with ``query``, then
+        the rest by how similar their names are to ``query``. Matching on a
+        prefix and on a substring of the description is case-insensitive.
+        Queries shorter than :py:data:`SEARCH_TRIGRAM_MIN_LENGTH` only match
+        on name prefixes.
+
+        :database: One SELECT, up to ``limit`` rows. Longer queries use the
+            trigram GIN indexes on ``name`` and ``description``, though one
+            that matches much of the registry still ranks every match. Shorter
+            queries walk the btree on ``lower(name)`` in order, and stop at
+            ``limit``.
+
+        """
+        query = query.strip()
+        if not query:
+            return []
+        escaped = escape_like(query)
+        params = dict( package_manager=package_manager
+                     , query=query
+                     , prefix=escaped + '%'
+                     , substring='%' + escaped + '%'
+                     , limit=min(limit, SEARCH_LIMIT)
+                      )
+
+        if len(query) < SEARCH_TRIGRAM_MIN_LENGTH:
+            # An exact match is the shortest name with its prefix, so it sorts first.
+            return cls.db.all("""
+                SELECT p.*::packages
+                  FROM packages p
+                 WHERE package_manager = %(package_manager)s
+                   AND lower(name) COLLATE "C" LIKE lower(%(prefix)s)
+              ORDER BY lower(name) COLLATE "C"
+                 LIMIT %(limit)s
+            """, params)
+
+        return cls.db.all("""
+            SELECT p.*::packages
+              FROM packages p
+             WHERE package_manager = %(package_manager)s
+               AND ( name ILIKE %(prefix)s
+                  OR name %% %(query)s
+                  OR description ILIKE %(substring)s
+                   )
+          ORDER BY lower(name) = lower(%(query)s) DESC
+                 , name ILIKE %(prefix)s DESC
+                 , similarity(name, %(query)s) DESC
+                 , name
+             LIMIT %(limit)s
+        """, params)
+
+
+    def to_dict(self):
+        return { 'package_manager': self.package_manager
+               , 'name': self.name
+               , 'description': self.description
+               , 'url': self.remote_human_url
+                }
@@ -600,6 +600,11 @@ class Participant(Model, Email, Identity):
         The dict returned represents the row inserted in the payment_instructions
         table.
 
+        We update our ``giving`` and the team's ``receiving`` (and its owner's
+        ``taking``) by the difference this instruction makes, rather than adding
+        up all of the instructions again. :py:mod:`gratipay.billing.counters`
+        catches any drift.
+
         """
         assert self.is_claimed  # sanity check
 
@@ -625,24 +630,61 @@ class Participant(Model, Email, Identity):
 
         """
         args = dict(participant_id=self.id, team_id=team.id, amount=amount)
-        t = (cursor or self.db).one(NEW_PAYMENT_INSTRUCTION, args)
-        t_dict = t._asdict()
+        with self.db.get_cursor(cursor) as cursor:
 
-        if amount > 0:
-            # Carry over any existing due
-            self._update_due(t_dict['team_id'], t_dict['id'], cursor)
-        else:
-            self._reset_due(t_dict['team_id'], cursor=cursor)
-
-        if update_self:
-            # Update giving amount of participant
-            self.update_giving(cursor)
-        if update_team:
-            # Update receiving amount of team
-            team.update_receiving(cursor)
-        if team.slug == 'Gratipay':
-            # Update whether the participant is using Gratipay for free
-            self.update_is_free_rider(None if amount == 0 else False, cursor)
+            # Lock ourselves, so that nobody else changes our instruction
+            # between when we look up the old one and when we apply the change.
+            # Lock the team's owner, too, whose taking we'll change, in a
+            # consistent order so that we don't deadlock with their changes.
+            cursor.run("""
+                SELECT id
+                  FROM participants
+                 WHERE id=%s OR username=%s
+              ORDER BY id
+                   FOR UPDATE
+            """, (self.id, team.owner))
+            old = cursor.one("""
+                SELECT amount, is_funded
+                  FROM current_payment_instructions
+                 WHERE participant_id=%(participant_id)s
+                   AND team_id=%(team_id)s
+            """, args)
+
+            t = cursor.one(NEW_PAYMENT_INSTRUCTION, args)
+            t_dict = t._asdict()
+
+            if amount > 0:
+                # Carry over any existing due
+                self._update_due(t_dict['team_id'], t_dict['id'], cursor)
+            else:
+                self._reset_due(t_dict['team_id'], cursor=cursor)
+
+            is_funded, other_team_ids = t.is_funded, set()
+            if update_self:
+                updated = self._update_is_funded(cursor)
+                is_funded = t.id in [pi.id for pi in updated] or is_funded
+                other_team_ids = set(pi.team_id for pi in updated if pi.id != t.id)
+
+            if other_team_ids:
+                # Our card changed without our instructions hearing about it,
+                # so our other teams are off, too. Recompute everything.
+                self.update_giving(cursor)
+                for team_id in other_team_ids - {team.id}:
+                    Team.from_id(team_id).update_receiving(cursor)
+                if update_team:
+                    team.update_receiving(cursor)
+            else:
+                # Update giving amount of participant, and receiving amount of
+                # team (and so taking amount of its owner), by the difference
+                old_amount = old.amount if old and old.amount > 0 and old.is_funded else 0
+                new_amount = amount if is_funded else 0
+                if update_self:
+                    self._add_to_giving(team, old_amount, new_amount, cursor)
+                if update_team:
+                    team.add_to_receiving(self, old_amount, new_amount, cursor)
+            if team.slug == 'Gratipay':
+                # Update whether the participant is using Gratipay for free
+                self.update_is_free_rider(None if amount == 0 else False, cursor)
 
         return t._asdict()
 
@@ -740,15 +782,10 @@ class Participant(Model, Email, Identity):
 
 
     def update_giving(self, cursor=None):
-        # Update is_funded on payment_instructions
-        has_credit_card = self.get_credit_card_error() == ''
-        updated = (cursor or self.db).all("""
-            UPDATE payment_instructions
-               SET is_funded = %(has_credit_card)s
-             WHERE participant_id = %(participant_id)s
-               AND is_funded <> %(has_credit_card)s
-         RETURNING *
-        """, dict(participant_id=self.id, has_credit_card=has_credit_card))
+        """Recompute ``giving`` and ``ngiving_to`` from all of our current
+        payment instructions, and return the ones whose ``is_funded`` changed.
+        """
+        updated = self._update_is_funded(cursor)
 
         r = (cursor or self.db).one("""
         WITH pi AS (
@@ -770,6 +807,39 @@ class Participant(Model, Email, Identity):
 
         return updated
 
+    def _update_is_funded(self, cursor=None):
+        # Update is_funded on payment_instructions
+        has_credit_card = self.get_credit_card_error() == ''
+        return (cursor or self.db).all("""
+            UPDATE payment_instructions
+               SET is_funded = %(has_credit_card)s
+             WHERE participant_id = %(participant_id)s
+               AND is_funded <> %(has_credit_card)s
+         RETURNING *
+        """, dict(participant_id=self.id, has_credit_card=has_credit_card))
+
+    def _add_to_giving(self, team, old_amount, new_amount, cursor):
+        """Update ``giving`` and ``ngiving_to`` for our instruction to ``team``
+        changing from ``old_amount`` to ``new_amount`` (each zero if it isn't
+        funded).
+        """
+        if old_amount == new_amount:
+            return
+        r = cursor.one("""
+            UPDATE participants p
+               SET giving = giving + %(delta)s
+                 , ngiving_to = ngiving_to + %(ndelta)s
+             WHERE p.id = %(participant_id)s
+               AND (SELECT is_approved FROM teams WHERE id = %(team_id)s)
+         RETURNING giving, ngiving_to
+        """, dict( participant_id=self.id
+                 , team_id=team.id
+                 , delta=new_amount - old_amount
+                 , ndelta=(new_amount > 0) - (old_amount > 0)
+                  ))
+        if r:
+            self.set_attributes(giving=r.giving, ngiving_to=r.ngiving_to)
+
     def _update_due(self, team_id, id, cursor=None):
         """Transfer existing due value to newly inserted record
         """
@@ -306,6 +306,47 @@ class Team(Model, Available, Closing, Membership, Takes, TipMigration):
                            , ndistributing_to=r.ndistributing_to
                             )
 
+    def add_to_receiving(self, participant, old_amount, new_amount, cursor):
+        """Update ``receiving`` (and ``nreceiving_from``, ``distributing``, and
+        our owner's ``taking`` and ``ntaking_from``) for ``participant``'s instruction changing from
+        ``old_amount`` to ``new_amount`` (each zero if it isn't funded).
+
+        This is :py:meth:`update_receiving` for one instruction, without
+        adding up all of the others again.
+
+        """
+        if old_amount == new_amount:
+            return
+        r = cursor.one("""
+            WITH t AS (
+                UPDATE teams t
+                   SET receiving = receiving + %(delta)s
+                     , nreceiving_from = nreceiving_from + %(ndelta)s
+                     , distributing = distributing + %(delta)s
+                     , ndistributing_to = 1
+                 WHERE t.id = %(team_id)s
+                   AND (SELECT is_suspicious FROM participants WHERE id = %(participant_id)s)
+                       IS NOT true
+             RETURNING receiving, nreceiving_from, distributing, ndistributing_to, owner
+            ), o AS (
+                UPDATE participants
+                   SET taking = taking + %(delta)s
+                     , ntaking_from = (SELECT count(*) FROM teams WHERE owner = username)
+                 WHERE username = (SELECT owner FROM t)
+            )
+            SELECT receiving, nreceiving_from, distributing, ndistributing_to FROM t
+        """, dict( team_id=self.id
+                 , participant_id=participant.id
+                 , delta=new_amount - old_amount
+                 , ndelta=(new_amount > 0) - (old_amount > 0)
+                  ))
+        if r:
+            self.set_attributes( receiving=r.receiving
+                               , nreceiving_from=r.nreceiving_from
+                               , distributing=r.distributing
+                               , ndistributing_to=r.ndistributing_to
+                                )
+
     @property
     def status(self):
         return { None: 'unreviewed'
@@ -5,6 +5,7 @@ import aspen
 from psycopg2 import IntegrityError
 
 from gratipay.billing.payday import Payday
+from gratipay.billing.simulation import SimulatedPayday
 
 
 class PaydayRunner(object):
@@ -15,7 +16,7 @@ class PaydayRunner(object):
         self.app = app
 
 
-    def run_payday(self):
+    def run_payday(self, set_based=None):
         """Run Gratipay's weekly payday.
 
         If there is a Payday that hasn't finished yet, then the UNIQUE
@@ -23,20 +24,38 @@ class PaydayRunner(object):
         we load the existing Payday and work on it some more. We use the start
         time of the current Payday to synchronize our work.
 
+        :param set_based: whether to use the set-based engine; by default
+            ``PAYDAY_SET_BASED`` decides
+
+        """
+        payday = self._start_payday()
+        if set_based is not None:
+            payday.set_based = set_based
+        payday.run()
+
+
+    def simulate_payday(self, set_based=None):
+        """Simulate payin without committing anything or touching Braintree.
+
+        :returns: the report from :py:meth:`SimulatedPayday.simulate`
+
         """
-        self._start_payday().run()
+        payday = SimulatedPayday(self)
+        if set_based is not None:
+            payday.set_based = set_based
+        return payday.simulate()
 
 
     def _start_payday(self):
         try:
             d = self.app.db.one("""
                 INSERT INTO paydays DEFAULT VALUES
-                RETURNING id, (ts_start AT TIME ZONE 'UTC') AS ts_start, stage
+                RETURNING id, (ts_start AT TIME ZONE 'UTC') AS ts_start, stage, payin_step
             """, back_as=dict)
             aspen.log("Starting a new payday.")
         except IntegrityError:  # Collision, we have a Payday already.
             d = self.app.db.one("""
-                SELECT id, (ts_start AT TIME ZONE 'UTC') AS ts_start, stage
+                SELECT id, (ts_start AT TIME ZONE 'UTC') AS ts_start, stage, payin_step
                   FROM paydays
                  WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
             """, back_as=dict)
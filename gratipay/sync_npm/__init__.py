@@ -23,6 +23,19 @@ def log(*a, **kw):
         print(*a, file=sys.stderr, **kw)
 
 
+def batches(iterable, size):
+    """Yield lists of up to ``size`` items from ``iterable``.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 class sentry(object):
     """This is a context manager to log to sentry. You have to pass in an ``Environment``
     object with a ``sentry_dsn`` attribute.
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""Subcommand for benchmarking the other subcommands against a synthetic registry dump.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+from multiprocessing import Pipe, Process
+
+from gratipay import wireup
+
+from . import log, sentry
+from .serialize import BINARY_HEADER, BINARY_TRAILER, import_ijson, iter_serialized
+from .upsert import load
+
+
+WORDS = ( 'a', 'fast', 'tiny', 'simple', 'library', 'for', 'parsing', 'streams', 'of', 'JSON'
+        , 'the', 'with', 'and', 'promises', 'CLI', 'React', 'component', 'plugin', 'webpack'
+        , 'utility', 'to', 'lint', 'your', 'code', 'café', 'naïve', 'über', 'façade', '日本語'
+        , 'のための', 'ライブラリ', 'быстрый', 'парсер', '中文', '工具', '🚀', '✨'
+         )
+NAME_PARTS = ( 'json', 'stream', 'parse', 'util', 'is', 'get', 'react', 'vue', 'webpack'
+             , 'babel', 'plugin', 'loader', 'cli', 'core', 'lodash', 'async', 'fs', 'http'
+             , 'string', 'array', 'object', 'deep', 'merge', 'color', 'log'
+              )
+
+
+def fake_package(rand, name):
+    """Return a ``dict`` shaped like a package in npm's ``/-/all`` dump.
+    """
+    nmaintainers = rand.choice((1, 1, 1, 1, 2, 2, 3, 5))
+    maintainers = [ { 'name': '{}{}'.format(rand.choice(NAME_PARTS), i)
+                    , 'email': '{}{}@example.com'.format(rand.choice(NAME_PARTS), rand.randint(0, 10**6))
+                     } for i in range(nmaintainers)]
+    package = { 'name': name
+              , 'dist-tags': {'latest': '1.{}.{}'.format(rand.randint(0, 20), rand.randint(0, 9))}
+              , 'maintainers': maintainers
+              , 'time': {'modified': '2016-{:02}-{:02}T03:03:03.135Z'.format( rand.randint(1, 12)
+                                                                           , rand.randint(1, 28)
+                                                                            )}
+              , 'keywords': rand.sample(NAME_PARTS, rand.randint(0, 5))
+              , 'license': rand.choice(('MIT', 'ISC', 'BSD-3-Clause', 'Apache-2.0'))
+              , 'repository': { 'type': 'git'
+                              , 'url': 'git+https://github.com/{}/{}.git'.format(
+                                  maintainers[0]['name'], name)
+                               }
+               }
+    description = rand.random()
+    if description < 0.9:
+        package['description'] = ' '.join(rand.choice(WORDS) for i in range(rand.randint(3, 30)))
+    elif description < 0.95:
+        package['description'] = None
+    author = rand.random()
+    if author < 0.5:
+        package['author'] = {'name': maintainers[0]['name'], 'email': maintainers[0]['email']}
+    elif author < 0.7:
+        package['author'] = '{} <{}>'.format(maintainers[0]['name'], maintainers[0]['email'])
+    return package
+
+
+def generate(fp, npackages, seed=0):
+    """Write a synthetic registry dump with ``npackages`` packages to ``fp``.
+    """
+    dump = lambda o: json.dumps(o, ensure_ascii=False).encode('utf8')
+    rand = random.Random(seed)
+    fp.write(b'{"_updated":1234567890')
+    for i in range(npackages):
+        name = '-'.join(rand.sample(NAME_PARTS, rand.randint(1, 3))) + '-{}'.format(i)
+        if rand.random() < 0.1:
+            name = '@{}/{}'.format(rand.choice(NAME_PARTS), name)
+        fp.write(b',\n' + dump(name) + b':' + dump(fake_package(rand, name)))
+    fp.write(b'\n}\n')
+
+
+def peak_rss():
+    """Return the peak resident set size of this process, in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux reports KB
+
+
+def measure(func, *args):
+    """Call ``func`` in a child process, so that its peak memory use is its own.
+
+    :returns: a ``(result, seconds, peak_rss)`` tuple
+
+    """
+    receiver, sender = Pipe(duplex=False)
+    def child():
+        start = time.time()
+        result = func(*args)
+        sender.send((result, time.time() - start, peak_rss()))
+    process = Process(target=child)
+    process.start()
+    sender.close()  # so that recv raises EOFError if the child dies
+    try:
+        out = receiver.recv()
+    except EOFError:
+        raise RuntimeError("{} failed; see its traceback above".format(func.__name__))
+    finally:
+        process.join()
+    return out
+
+
+def serialize_to(env, src, dest, jobs, binary):
+    nrows = 0
+    with open(dest, 'wb') as fp:
+        if binary:
+            fp.write(BINARY_HEADER)
+        for serialized, n in iter_serialized(env, src, jobs, binary):
+            fp.write(serialized)
+            nrows += n
+        if binary:
+            fp.write(BINARY_TRAILER)
+    return nrows
+
+
+def upsert_from(env, path, binary):
+    db = wireup.db(env)  # we're in a child process; don't share connections
+    with db.get_cursor() as cursor:
+        counts = load(cursor, io.open(path, 'rb'), binary=binary)
+        cursor.connection.rollback()
+    return counts['ninserted'] + counts['nupdated'] + counts['nunchanged']
+
+
+class SerializeEnv(object):
+    """Stand in for ``env`` when serializing, which only looks at ``require_yajl``.
+    """
+    def __init__(self, require_yajl):
+        self.require_yajl = require_yajl
+
+
+def backends():
+    """Yield ``(label, require_yajl)`` tuples for the ``ijson`` backends we have.
+    """
+    yield 'ijson python', False
+    try:
+        import_ijson(SerializeEnv(require_yajl=True))
+    except Exception as e:
+        log('skipping ijson yajl2_cffi:', e)
+    else:
+        yield 'ijson yajl2_cffi', True
+
+
+def bench(env, args, db):
+    tmpdir = tempfile.mkdtemp(prefix='sync-npm-bench-')
+    try:
+        return _bench(env, args, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _bench(env, args, tmpdir):
+    src = args.path
+    if src is None:
+        src = os.path.join(tmpdir, 'registry.json')
+        with open(src, 'wb') as fp:
+            generate(fp, args.packages)
+        log("generated {} packages ({:.1f} MB)"
+            .format(args.packages, os.path.getsize(src) / 1024 / 1024))
+
+    parsers = [(label, SerializeEnv(require_yajl), 0) for label, require_yajl in backends()]
+    if args.jobs:
+        parsers.append(('json x{}'.format(args.jobs), SerializeEnv(False), args.jobs))
+
+    results = []
+    for fmt, binary in (('csv', False), ('binary', True)):
+        for i, (label, serialize_env, jobs) in enumerate(parsers):
+            dest = os.path.join(tmpdir, '{}.{}'.format(i, fmt))
+            result = measure(serialize_to, serialize_env, src, dest, jobs, binary)
+            results.append(('serialize', label, fmt) + result)
+        result = measure(upsert_from, env, os.path.join(tmpdir, '0.' + fmt), binary)
+        results.append(('upsert', '', fmt) + result)
+
+    print("{:<10} {:<18} {:<7} {:>9} {:>9} {:>11} {:>10}"
+          .format('phase', 'parser', 'format', 'rows', 'seconds', 'rows/sec', 'peak RSS'))
+    for phase, label, fmt, nrows, seconds, rss in results:
+        print("{:<10} {:<18} {:<7} {:>9} {:>9.2f} {:>11.0f} {:>7.0f} MB"
+              .format(phase, label, fmt, nrows, seconds, nrows / seconds if seconds else 0, rss))
+    return results
+
+
+def main(env, args, db):
+    """Generate a synthetic registry dump of ``--packages`` packages (or use
+    the one at ``args.path``), and then time serializing it with each
+    ``ijson`` backend we have (plus the stdlib ``json`` in parallel, with
+    ``--jobs``), and upserting the result, in CSV and binary. Each phase runs
+    in its own process, so that we can report its peak RSS. Upserts are rolled
+    back.
+
+    """
+    with sentry(env):
+        bench(env, args, db)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Subcommand for syncing with npm incrementally, using the registry's changes feed.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import csv
+import io
+import json
+import time
+
+import requests
+
+from . import batches, log, sentry
+from .serialize import package_from_pairs, serialize_one
+from .upsert import load
+
+
+REGISTRY_CHANGES_URL = 'https://replicate.npmjs.com/_changes'
+
+# How long the registry should wait for new changes before ending the feed, in ms.
+FEED_TIMEOUT = 30 * 1000
+
+
+def get_last_seq(db):
+    """Return the sequence number of the last change we processed, or -1.
+    """
+    return db.one("SELECT npm_last_seq FROM worker_coordination", default=-1)
+
+
+def set_last_seq(cursor, seq):
+    cursor.run("""
+        WITH updated AS (
+            UPDATE worker_coordination SET npm_last_seq=%(seq)s RETURNING 1
+        )
+        INSERT INTO worker_coordination (npm_last_seq)
+             SELECT %(seq)s
+              WHERE NOT EXISTS (SELECT 1 FROM updated)
+    """, dict(seq=seq))
+
+
+def open_feed(path, since):
+    """Return an iterable of lines from a CouchDB continuous changes feed.
+
+    :param unicode path: an ``http(s)`` URL for a ``_changes`` endpoint, or the
+        path to a local file containing a feed (which we read in full, relying
+        on the caller to skip what it has already seen)
+    :param int since: the sequence number to start after
+
+    """
+    if path.startswith(('http://', 'https://')):
+        response = requests.get( path
+                               , params=dict( feed='continuous'
+                                            , include_docs='true'
+                                            , since=since
+                                            , timeout=FEED_TIMEOUT
+                                             )
+                               , stream=True
+                                )
+        response.raise_for_status()
+        return response.iter_lines()
+    return open(path)
+
+
+def iter_changes(lines, since):
+    """Given lines from a changes feed, yield ``(seq, name, pairs)`` tuples,
+    where ``pairs`` is the package decoded as a list of ``(key, value)`` pairs,
+    or ``None`` if the package was deleted. For changes that aren't to packages
+    (design docs), ``name`` is ``None``.
+    """
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue  # heartbeat
+        change = dict(json.loads(line, object_pairs_hook=list))
+        if 'seq' not in change:
+            continue  # the last_seq line at the end of the feed
+        seq = change['seq']
+        if seq <= since:
+            continue
+        name = change['id']
+        if name.startswith('_'):
+            yield seq, None, None
+        elif change.get('deleted'):
+            yield seq, name, None
+        else:
+            yield seq, name, change.get('doc') or []
+
+
+def apply_changes(cursor, changes):
+    """Apply a batch of ``(seq, name, pairs)`` changes to ``packages``.
+    """
+    latest = {}
+    for seq, name, pairs in changes:
+        if name is not None:
+            latest[name] = pairs  # later changes to the same package win
+
+    deleted = [name for name, pairs in latest.items() if pairs is None]
+    if deleted:
+        cursor.run( "DELETE FROM packages WHERE package_manager='npm' AND name = ANY(%s)"
+                  , (deleted,)
+                   )
+
+    fp = io.BytesIO()
+    out = csv.writer(fp)
+    n = sum(serialize_one(out, package_from_pairs(name, pairs))
+            for name, pairs in latest.items() if pairs is not None)
+    if n:
+        fp.seek(0)
+        load(cursor, fp)
+
+    set_last_seq(cursor, changes[-1][0])
+    return n, len(deleted)
+
+
+def sync_changes(env, args, db, batch_size=1000):
+    since = get_last_seq(db)
+    log("picking up npm changes after {}".format(since))
+    start = time.time()
+    nchanges = nupserted = ndeleted = 0
+
+    for batch in batches(iter_changes(open_feed(args.path, since), since), batch_size):
+        with db.get_cursor() as cursor:
+            upserted, deleted = apply_changes(cursor, batch)
+        nchanges += len(batch)
+        nupserted += upserted
+        ndeleted += deleted
+
+    log("processed {} changes ({} upserted, {} deleted) in {:3.0f} seconds; now at {}"
+        .format(nchanges, nupserted, ndeleted, time.time() - start, get_last_seq(db)))
+
+
+def main(env, args, db):
+    """Consume npm's changes feed from ``args.path``, a URL or a file, and
+    upsert the packages that changed since the last run. The sequence number of
+    the last change we processed is stored in the ``worker_coordination``
+    table, and each batch of changes is committed along with it, so an
+    interrupted run picks up where it left off.
+
+    """
+    with sentry(env):
+        sync_changes(env, args, db)
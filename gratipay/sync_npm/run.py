@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Subcommand for serializing JSON from npm and upserting it into Postgres in one go.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import time
+
+from . import batches, log, sentry
+from .serialize import BINARY_HEADER, BINARY_TRAILER, CHUNK_SIZE, iter_serialized, log_stats
+from .upsert import delete_missing, load
+
+
+# How many packages to merge into ``packages`` per transaction.
+MERGE_SIZE = 50000
+
+
+def run(env, args, db, merge_size=MERGE_SIZE):
+    start = time.time()
+    nprocessed = 0
+    totals = dict(ninserted=0, nupdated=0, nunchanged=0, ndeleted=0)
+
+    # We hold one connection for the whole run, so that the names we've seen
+    # can pile up in a temporary table while each chunk commits on its own.
+    with db.get_connection() as connection:
+        cursor = connection.cursor()
+        seen = None
+        if args.prune:
+            seen = 'pg_temp.seen_packages'
+            cursor.run("DROP TABLE IF EXISTS {0}; "
+                       "CREATE TEMP TABLE {0} (package_manager text, name text)".format(seen))
+            connection.commit()
+
+        chunks = iter_serialized(env, args.path, args.jobs, args.binary)
+        for group in batches(chunks, max(1, merge_size // CHUNK_SIZE)):
+            nrows = sum(n for serialized, n in group)
+            if not nrows:
+                continue
+            data = b''.join(serialized for serialized, n in group)
+            if args.binary:
+                data = BINARY_HEADER + data + BINARY_TRAILER
+            counts = load(cursor, io.BytesIO(data), binary=args.binary, seen=seen)
+            connection.commit()
+            for key in totals:
+                totals[key] += counts[key]
+            nprocessed += nrows
+            log_stats(nprocessed, start)
+
+        # Only once we've made it through the whole dump, and never on an
+        # empty one, or we'd delete every npm package we have.
+        if seen and nprocessed:
+            cursor.run("ANALYZE {}".format(seen))
+            totals['ndeleted'] = delete_missing(cursor, seen)
+            cursor.run("DROP TABLE {}".format(seen))
+            connection.commit()
+
+    log("inserted {ninserted}, updated {nupdated}, left {nunchanged} unchanged, "
+        "and deleted {ndeleted} packages".format(**totals))
+    return totals
+
+
+def main(env, args, db):
+    """Consume raw JSON from the npm registry via ``args.path``, and merge it
+    into Postgres in chunks of :py:data:`MERGE_SIZE` packages, each in its own
+    transaction. That keeps memory use and transaction size flat, and if we
+    fail partway through, the chunks we've already merged stay merged (and
+    merging them again next time is cheap, since unchanged rows are skipped).
+
+    With ``--prune``, once every chunk is merged, also delete npm packages
+    that weren't anywhere in the dump. We don't prune after a failure, since
+    then we haven't seen the whole registry.
+
+    """
+    with sentry(env):
+        run(env, args, db)
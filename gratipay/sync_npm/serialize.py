@@ -4,10 +4,27 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import csv
+import io
+import json
+import os
+import re
+import shutil
+import struct
 import sys
+import tempfile
 import time
+from functools import partial
+from itertools import izip
+from multiprocessing import Pool
 
-from . import log, sentry
+from . import batches, log, sentry
+
+
+# How much output to buffer before writing to stdout.
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+# How many packages to serialize at a time.
+CHUNK_SIZE = 1000
 
 
 def import_ijson(env):
@@ -33,48 +50,107 @@ def arrayize(seq):
     return b'{' + joined + b'}'
 
 
+# Binary COPY
+# ===========
+# Postgres's binary COPY format saves us escaping values here, and saves
+# Postgres parsing them there. See "Binary Format" in the docs for COPY.
+
+BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack(b'!ii', 0, 0)
+BINARY_TRAILER = struct.pack(b'!h', -1)
+TEXT_OID = 25
+
+
+def encode_text_array(items):
+    """Given a sequence of ``str``, return a ``text[]`` in binary COPY format.
+    """
+    if not items:
+        return struct.pack(b'!iii', 0, 0, TEXT_OID)
+    out = [struct.pack(b'!iiiii', 1, 0, TEXT_OID, len(items), 1)]
+    for item in items:
+        out.append(struct.pack(b'!i', len(item)))
+        out.append(item)
+    return b''.join(out)
+
+
+class BinaryCopyWriter(object):
+    """Write rows in Postgres's binary COPY format, like a ``csv.writer``.
+    Values can be ``str``, ``unicode`` or lists of ``str``, for ``text[]``.
+    We don't write :py:data:`BINARY_HEADER` or :py:data:`BINARY_TRAILER`;
+    that's up to the caller, so that chunks can be concatenated.
+    """
+
+    native_arrays = True
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def writerow(self, row):
+        out = [struct.pack(b'!h', len(row))]
+        for value in row:
+            if isinstance(value, list):
+                value = encode_text_array(value)
+            elif isinstance(value, unicode):
+                value = value.encode('utf8')
+            out.append(struct.pack(b'!i', len(value)))
+            out.append(value)
+        self.fp.write(b''.join(out))
+
+
+def make_writer(fp, binary=False):
+    return BinaryCopyWriter(fp) if binary else csv.writer(fp)
+
+
 def serialize_one(out, package):
     """Take a single package ``dict`` and emit a CSV serialization suitable for
-    Postgres COPY.
+    Postgres COPY (or a binary one, if ``out`` is a :py:class:`BinaryCopyWriter`).
 
     """
-    if not package or package['name'].startswith('_'):
+    if not package or package['name'].startswith(b'_'):
         log('skipping', package)
         return 0
 
+    emails = package['emails']
+    if not getattr(out, 'native_arrays', False):
+        emails = arrayize(emails)
+
     row = ( package['package_manager']
           , package['name']
           , package['description']
-          , arrayize(package['emails'])
+          , emails
            )
 
     out.writerow(row)
     return 1
 
 
-def serialize(env, args, db):
-    ijson = import_ijson(env)
+def open_output():
+    """Return a buffered binary file object for stdout.
+    """
+    return io.open(sys.stdout.fileno(), 'wb', buffering=OUTPUT_BUFFER_SIZE, closefd=False)
+
 
-    path = args.path
+def log_stats(nprocessed, start):
+    elapsed = time.time() - start
+    rate = nprocessed / elapsed if elapsed else 0
+    log("processed {} packages in {:3.0f} seconds ({:.0f} packages/sec)"
+        .format(nprocessed, elapsed, rate))
+
+
+def iter_packages(env, path):
+    """Parse the registry dump at ``path`` with ``ijson``, and yield package
+    ``dict``\ s for :py:func:`serialize_one`.
+    """
+    ijson = import_ijson(env)
     parser = ijson.parse(open(path))
-    start = time.time()
     package = None
-    nprocessed = 0
-    out = csv.writer(sys.stdout)
-
-    def log_stats():
-        log("processed {} packages in {:3.0f} seconds"
-            .format(nprocessed, time.time() - start))
 
     for prefix, event, value in parser:
 
         if not prefix and event == b'map_key':
 
-            # Flush the current package. We count on the first package being garbage.
-            processed = serialize_one(out, package)
-            nprocessed += processed
-            if processed and not(nprocessed % 1000):
-                log_stats()
+            # Flush the current package.
+            if package is not None:
+                yield package
 
             # Start a new package.
             package = { 'package_manager': b'npm'
@@ -83,24 +159,385 @@ def serialize(env, args, db):
                       , 'emails': []
                        }
 
-        key = lambda k: package['name'] + b'.' + k
+            # Work out the prefixes we care about once per package, not once per event.
+            description_key = value + b'.description'
+            email_keys = (value + b'.author.email', value + b'.maintainers.item.email')
 
         if event == b'string':
             assert type(value) is unicode  # Who knew? Seems to decode only for `string`.
             value = value.encode('utf8')
-            if prefix == key(b'description'):
+            if prefix == description_key:
                 package['description'] = value
-            elif prefix in (key(b'author.email'), key(b'maintainers.item.email')):
+            elif prefix in email_keys:
                 package['emails'].append(value)
 
-    nprocessed += serialize_one(out, package)  # Don't forget the last one!
-    log_stats()
+    if package is not None:
+        yield package  # Don't forget the last one!
+
+
+def iter_serialized(env, path, jobs=0, binary=False):
+    """Serialize the registry dump at ``path`` a chunk at a time.
+
+    :param int jobs: the number of worker processes to use; with ``0`` we
+        parse with ``ijson`` in this process
+    :param bool binary: whether to serialize in binary COPY format (without
+        the header and trailer) rather than CSV
+
+    :returns: an iterator of ``(csv, n)`` tuples, where ``csv`` is a ``str`` of
+        CSV for up to :py:data:`CHUNK_SIZE` packages and ``n`` is the number of
+        rows in it
+
+    """
+    if jobs:
+        for chunk in serialize_in_parallel(path, jobs, binary):
+            yield chunk
+        return
+
+    for packages in batches(iter_packages(env, path), CHUNK_SIZE):
+        fp = io.BytesIO()
+        out = make_writer(fp, binary)
+        n = sum(serialize_one(out, package) for package in packages)
+        yield fp.getvalue(), n
+
+
+def serialize(env, args, db):
+    start = time.time()
+    nprocessed = 0
+    fp = open_output()
+    if args.binary:
+        fp.write(BINARY_HEADER)
+
+    for serialized, n in iter_serialized(env, args.path, args.jobs, args.binary):
+        fp.write(serialized)
+        nprocessed, before = nprocessed + n, nprocessed
+        if nprocessed // 10000 > before // 10000:
+            log_stats(nprocessed, start)
+
+    if args.binary:
+        fp.write(BINARY_TRAILER)
+    fp.flush()
+    log_stats(nprocessed, start)
+
+
+# Parallel mode
+# =============
+# The registry dump is one big JSON object mapping package names to package
+# objects, one package per line. In parallel mode we cut the file into byte
+# ranges, and a pool of worker processes each serialize the packages that start
+# in one of them, decoding with the stdlib's C-accelerated ``json``. A raw
+# newline can't be inside a JSON string, so a worker starts reading right after
+# the first newline in its range and assumes it's between packages there. The
+# worker before it tells us where the first package after its own range starts,
+# so we can check that assumption, and when it's wrong (the dump isn't laid out
+# one package per line) we serialize that range again ourselves, starting from
+# where we know a package starts. The output is the same either way.
+
+WHITESPACE = re.compile(br'[ \t\n\r]*')
+STRING = re.compile(br'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+SCALAR = re.compile(br'[^,:{}\[\]" \t\n\r]+')
+NOT_A_BRACKET = re.compile(br'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*', re.S)
+READ_SIZE = 1024 * 1024
+
+# How many bytes of the dump to give each worker at a time.
+RANGE_SIZE = 4 * 1024 * 1024
+
+
+def _compile_value(depth):
+    """Return a regex for an object or array nested at most ``depth`` deep.
+
+    It's unrolled (plain bytes, then any number of strings or nested values
+    each followed by plain bytes), so that when a value runs off the end of
+    our buffer the match fails in linear time rather than backtracking.
+
+    """
+    plain = br'[^"{}\[\]]*'
+    string = STRING.pattern
+    body = br'%s(?:%s%s)*' % (plain, string, plain)
+    for i in range(depth):
+        body = br'%s(?:(?:%s|\{%s\}|\[%s\])%s)*' % (plain, string, body, body, plain)
+    return re.compile(br'\{%s\}|\[%s\]' % (body, body), re.S)
+
+SHALLOW_VALUE = _compile_value(3)
+
+
+def find_value_end(buf, pos, eof):
+    """Given a ``str``, the position of a JSON value in it, and whether it's
+    the end of the input, return where the value ends, or ``None`` if it runs
+    off the end of ``buf``.
+
+    We don't decode or check the value, we only count brackets outside of
+    strings. Most packages match :py:data:`SHALLOW_VALUE` in one go; for the
+    rest we loop in Python once per bracket.
+
+    """
+    c = buf[pos:pos+1]
+    if c == b'"':
+        m = STRING.match(buf, pos)
+        return m.end() if m else None
+    if c in (b'{', b'['):
+        m = SHALLOW_VALUE.match(buf, pos)
+        if m:
+            return m.end()
+        depth = 0
+        while True:
+            pos = NOT_A_BRACKET.match(buf, pos).end()
+            c = buf[pos:pos+1]
+            if c in (b'{', b'['):
+                depth += 1
+            elif c in (b'}', b']'):
+                depth -= 1
+                if depth == 0:
+                    return pos + 1
+            else:
+                return None  # out of input, maybe in the middle of a string
+            pos += 1
+    m = SCALAR.match(buf, pos)
+    if m is None:
+        raise ValueError("expected a value at {}".format(pos))
+    if m.end() == len(buf) and not eof:
+        return None  # a number at the end of what we have may go on
+    return m.end()
+
+
+def iter_members(fp, offset=0, expecting=b'{', read_size=READ_SIZE):
+    """Given a file containing a JSON object, yield ``(start, key, raw)``
+    tuples, where ``start`` is the offset in the file where the key starts,
+    ``key`` is decoded, and ``raw`` is the ``str`` of JSON for the value.
+
+    :param int offset: where in the file ``fp`` is
+    :param str expecting: ``{`` to start at the beginning of the object, ``key``
+        to start at a key, or ``resync`` to start anywhere between members
+
+    We only decode the keys. We find where values end with
+    :py:func:`find_value_end`, reading more whenever one runs off the end of
+    what we have.
+
+    """
+    buf = b''
+    base = offset  # where buf starts in the file
+    pos = 0
+    eof = False
+
+    while True:
+        pos = WHITESPACE.match(buf, pos).end()
+        c = buf[pos:pos+1]
+
+        if c == b'"' and expecting in (b'first key', b'key') or c and expecting == b'value':
+            end = find_value_end(buf, pos, eof)
+            if end is None:
+                c = b''  # read more and try again
+
+        if not c:
+            if eof:
+                raise ValueError("unexpected end of input")
+            chunk = fp.read(read_size)
+            eof = not chunk
+            buf, base, pos = buf[pos:] + chunk, base + pos, 0
+            continue
+
+        if expecting == b'{':
+            if c != b'{':
+                raise ValueError("expected an object at {}".format(base + pos))
+            pos += 1
+            expecting = b'first key'
+        elif expecting == b'resync':
+            if c == b',':
+                pos += 1
+                expecting = b'key'
+            else:
+                expecting = b'first key'
+        elif expecting == b'first key' and c == b'}':
+            return
+        elif expecting in (b'first key', b'key'):
+            if c != b'"':
+                raise ValueError("expected a key at {}".format(base + pos))
+            start, key, pos = base + pos, json.loads(buf[pos:end]), end
+            expecting = b':'
+        elif expecting == b':':
+            if c != b':':
+                raise ValueError("expected ':' at {}".format(base + pos))
+            pos += 1
+            expecting = b'value'
+        elif expecting == b'value':
+            yield start, key, buf[pos:end]
+            pos = end
+            expecting = b','
+        elif c == b',':
+            pos += 1
+            expecting = b'key'
+        elif c == b'}':
+            return
+        else:
+            raise ValueError("expected ',' or '}}' at {}".format(base + pos))
+
+
+def iter_raw_packages(fp, read_size=READ_SIZE):
+    """Given a file containing a JSON object, yield ``(key, raw)`` tuples, where
+    ``key`` is decoded and ``raw`` is the ``str`` of JSON for the value.
+    """
+    for start, key, raw in iter_members(fp, read_size=read_size):
+        yield key, raw
+
+
+def find_line_start(fp, start, end, read_size=READ_SIZE):
+    """Return the offset of the first line that starts in ``[start, end)`` of
+    ``fp``, or ``None`` if there isn't one.
+    """
+    pos = start - 1
+    fp.seek(pos)
+    while pos < end:
+        chunk = fp.read(min(read_size, end - pos))
+        if not chunk:
+            break
+        i = chunk.find(b'\n')
+        if i != -1:
+            return pos + i + 1 if pos + i + 1 < end else None
+        pos += len(chunk)
+    return None
+
+
+def emails_from(pairs):
+    """Given a package as a list of ``(key, value)`` pairs, return the emails
+    of its author and maintainers, in the order they appear.
+    """
+    emails = []
+    for k, v in pairs:
+        if k == 'author' and isinstance(v, list):
+            emails.extend(e for kk, e in v if kk == 'email' and isinstance(e, unicode))
+        elif k == 'maintainers' and isinstance(v, list):
+            for maintainer in v:
+                if isinstance(maintainer, list):
+                    emails.extend(e for kk, e in maintainer
+                                  if kk == 'email' and isinstance(e, unicode))
+    return [e.encode('utf8') for e in emails]
+
+
+def package_from_pairs(name, pairs):
+    """Given a package name and a package decoded as a list of ``(key, value)``
+    pairs, return a package ``dict`` for :py:func:`serialize_one`.
+    """
+    description = b''
+    for k, v in pairs:
+        if k == 'description' and isinstance(v, unicode):
+            description = v.encode('utf8')
+    return { 'package_manager': b'npm'
+           , 'name': name.encode('utf8')
+           , 'description': description
+           , 'emails': emails_from(pairs)
+            }
+
+
+def serialize_chunk(chunk, binary=False):
+    """Take a list of ``(name, raw)`` tuples and return a ``(csv, n)`` tuple.
+
+    Objects are decoded as lists of pairs rather than dicts, so that we see
+    emails in the same order as the streaming serializer does.
+
+    """
+    fp = io.BytesIO()
+    out = make_writer(fp, binary)
+    n = 0
+    for name, raw in chunk:
+        pairs = json.loads(raw, object_pairs_hook=list)
+        if isinstance(pairs, list):
+            n += serialize_one(out, package_from_pairs(name, pairs))
+    return fp.getvalue(), n
+
+
+def serialize_range(path, bounds, binary=False, resync=True):
+    """Serialize the packages whose keys start in one range of bytes of the
+    registry dump at ``path``.
+
+    :param tuple bounds: the ``(start, end)`` of the range
+    :param bool resync: whether to start at the first line in the range and
+        hope that's between packages, rather than at ``start``, which then has
+        to be the start of the dump or of a package's key
+
+    :returns: a ``(first, next, chunks, skipped)`` tuple, where ``first`` is
+        where the first package we found starts (``None`` if we didn't find
+        one), ``next`` is where the first package after the range starts
+        (``None`` if there isn't one), ``chunks`` is a list of ``(csv, n)``
+        tuples of up to :py:data:`CHUNK_SIZE` packages, and ``skipped`` is a
+        list of the keys we skipped
+
+    """
+    start, end = bounds
+    fp = open(path, 'rb')
+    if start == 0:
+        expecting, first = b'{', 0
+    elif resync:
+        expecting, first = b'resync', None
+        start = find_line_start(fp, start, end)
+        if start is None:
+            return None, None, [], []
+    else:
+        expecting, first = b'key', start
+    fp.seek(start)
+
+    next_, packages, skipped = None, [], []
+    try:
+        for offset, key, raw in iter_members(fp, start, expecting):
+            if first is None:
+                first = offset
+            if offset >= end:
+                next_ = offset
+                break
+            if key.startswith('_'):
+                skipped.append(key)
+                continue
+            packages.append((key, raw))
+        chunks = [serialize_chunk(chunk, binary) for chunk in batches(packages, CHUNK_SIZE)]
+    except Exception:
+        if not resync:
+            raise
+        return None, None, [], []  # we started in the middle of a package
+    return first, next_, chunks, skipped
+
+
+def serialize_in_parallel(path, jobs, binary=False, range_size=RANGE_SIZE):
+    """Serialize the registry dump at ``path`` using ``jobs`` worker processes.
+
+    :returns: an iterator of ``(csv, n)`` tuples, in input order
+
+    """
+    if not os.path.isfile(path):
+        # We need to seek, so save a pipe to disk first.
+        with tempfile.NamedTemporaryFile() as fp:
+            shutil.copyfileobj(open(path, 'rb'), fp, READ_SIZE)
+            fp.flush()
+            for chunk in serialize_in_parallel(fp.name, jobs, binary, range_size):
+                yield chunk
+        return
+
+    size = os.path.getsize(path)
+    bounds = list(range(0, size, range_size)) + [size]
+    ranges = list(zip(bounds[:-1], bounds[1:]))
+    pool = Pool(jobs)
+    try:
+        results = pool.imap(partial(serialize_range, path, binary=binary), ranges)
+        expected = 0  # where the next package starts, or None after the last
+        for (start, end), result in izip(ranges, results):
+            if expected is None or expected >= end:
+                continue  # nothing starts in this range
+            if result[0] != expected:
+                result = serialize_range(path, (expected, end), binary, resync=False)
+            first, expected, chunks, skipped = result
+            for key in skipped:
+                log('skipping', key)
+            for chunk in chunks:
+                yield chunk
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 def main(env, args, db):
     """Consume raw JSON from the npm registry via ``args.path``, and spit out
     CSV for Postgres to stdout. Uses ``ijson``, requiring the ``yajl_cffi``
-    backend if ``env.require_yajl`` is ``True``.
+    backend if ``env.require_yajl`` is ``True``. With ``--jobs N``, uses ``N``
+    worker processes and the stdlib ``json`` module instead. With
+    ``--binary``, spits out Postgres's binary COPY format instead of CSV.
 
     """
     with sentry(env):
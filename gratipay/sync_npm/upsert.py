@@ -5,7 +5,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import uuid
 
-from . import sentry
+from . import log, sentry
 
 
 # Coordinate with Postgres on how to say "NULL".
@@ -22,33 +22,112 @@ NULL = uuid.uuid4().hex
 def upsert(env, args, db):
     fp = open(args.path)
     with db.get_cursor() as cursor:
-        assert cursor.connection.encoding == 'UTF8'
-
-        cursor.run("CREATE TEMP TABLE updates (LIKE packages INCLUDING ALL) ON COMMIT DROP")
-        cursor.copy_expert('COPY updates (package_manager, name, description, emails) '
-                           "FROM STDIN WITH (FORMAT csv, NULL '%s')" % NULL, fp)
-        cursor.run("""
-
-            WITH updated AS (
-                UPDATE packages p
-                   SET package_manager = u.package_manager
-                     , description = u.description
-                     , emails = u.emails
-                  FROM updates u
-                 WHERE p.name = u.name
-             RETURNING p.name
-            )
+        counts = load(cursor, fp, prune=args.prune, binary=args.binary)
+    log("inserted {ninserted}, updated {nupdated}, left {nunchanged} unchanged, "
+        "and deleted {ndeleted} packages".format(**counts))
+
+
+def load(cursor, fp, prune=False, binary=False, seen=None):
+    """COPY CSV from ``fp`` into a temporary table and merge it into ``packages``.
+    The temporary table goes away when the transaction ends.
+
+    Rows whose description and emails haven't changed are left alone, so that
+    we don't write a new version of every tuple on every sync.
+
+    :param bool prune: whether to delete npm packages that aren't in ``fp``;
+        only pass this when ``fp`` holds the whole registry!
+    :param bool binary: whether ``fp`` is in binary COPY format rather than CSV
+    :param seen: the name of a table to add the ``(package_manager, name)`` of
+        each package in ``fp`` to, so that a caller loading the registry in
+        chunks can :py:func:`delete_missing` once it's loaded all of them
+
+    :returns: a ``dict`` with counts of packages inserted, updated, left
+        unchanged, and deleted
+
+    """
+    assert cursor.connection.encoding == 'UTF8'
+
+    cursor.run("CREATE TEMP TABLE updates (LIKE packages INCLUDING DEFAULTS) ON COMMIT DROP")
+    options = "FORMAT binary" if binary else "FORMAT csv, NULL '%s'" % NULL
+    cursor.copy_expert('COPY updates (package_manager, name, description, emails) '
+                       'FROM STDIN WITH (%s)' % options, fp)
+
+    # A package can show up more than once (a dump that's shifting under us,
+    # say), and merging both copies would trip packages' unique constraint or
+    # count it twice. The id default numbers rows in COPY order, so keep the
+    # last copy, like changes.apply_changes does.
+    cursor.run("""
+
+        DELETE FROM updates u
+         USING updates later
+         WHERE later.package_manager = u.package_manager
+           AND later.name = u.name
+           AND later.id > u.id
+
+    """)
+    cursor.run("ANALYZE updates")
+    counts = cursor.one("""
+
+        WITH updated AS (
+            UPDATE packages p
+               SET description = u.description
+                 , emails = u.emails
+              FROM updates u
+             WHERE p.package_manager = u.package_manager
+               AND p.name = u.name
+               AND (p.description, p.emails) IS DISTINCT FROM (u.description, u.emails)
+         RETURNING p.id
+        )
+           , inserted AS (
             INSERT INTO packages(package_manager, name, description, emails)
                  SELECT package_manager, name, description, emails
-                   FROM updates u LEFT JOIN updated USING(name)
-                  WHERE updated.name IS NULL
-               GROUP BY u.package_manager, u.name, u.description, u.emails
+                   FROM updates u
+                  WHERE NOT EXISTS ( SELECT 1
+                                       FROM packages p
+                                      WHERE p.package_manager = u.package_manager
+                                        AND p.name = u.name
+                                    )
+              RETURNING id
+        )
+        SELECT ( SELECT count(*) FROM inserted ) AS ninserted
+             , ( SELECT count(*) FROM updated ) AS nupdated
+             , ( SELECT count(*) FROM updates ) AS nseen
+
+    """)._asdict()
+    counts['nunchanged'] = counts.pop('nseen') - counts['ninserted'] - counts['nupdated']
+
+    if seen:
+        cursor.run("INSERT INTO {} (package_manager, name) "
+                   "SELECT package_manager, name FROM updates".format(seen))
+
+    counts['ndeleted'] = delete_missing(cursor, 'updates') if prune else 0
+
+    return counts
+
+
+def delete_missing(cursor, seen):
+    """Delete npm packages that aren't in the table named ``seen``.
+
+    :returns: how many packages we deleted
+
+    """
+    return len(cursor.all("""
+
+        DELETE FROM packages p
+         WHERE package_manager = 'npm'
+           AND NOT EXISTS ( SELECT 1
+                              FROM {} s
+                             WHERE s.package_manager = p.package_manager
+                               AND s.name = p.name
+                           )
+     RETURNING id
 
-        """)
+    """.format(seen)))
 
 
 def main(env, args, db):
     """Take a CSV file from stdin and load it into Postgres using an `ingenious algorithm`_.
+    With ``--prune``, also delete packages that aren't in the file.
 
     .. _ingenious algorithm:  http://tapoueh.org/blog/2013/03/15-batch-update.html
 
@@ -10,12 +10,15 @@ class _AbstractEmailHarness(Harness):
 
     def setUp(self):
         Harness.setUp(self)
-        self.__sleep_for = self.app.email_queue.sleep_for
-        self.app.email_queue.sleep_for = 0
+        self.__rate = self.app.email_queue.rate_limiter.rate
+        self.__threads = self.app.email_queue.threads
+        self.app.email_queue.rate_limiter.rate = 0
+        self.app.email_queue.threads = 1  # so that "last email" means something
 
     def tearDown(self):
         Harness.tearDown(self)
-        self.app.email_queue.sleep_for = self.__sleep_for
+        self.app.email_queue.rate_limiter.rate = self.__rate
+        self.app.email_queue.threads = self.__threads
 
     def _get_last_email(self):
         raise NotImplementedError
@@ -58,9 +61,6 @@ class SentEmailHarness(_AbstractEmailHarness):
         self.mailer_patcher = mock.patch.object(self.app.email_queue._mailer, 'send_email')
         self.mailer = self.mailer_patcher.start()
         self.addCleanup(self.mailer_patcher.stop)
-        sleep_patcher = mock.patch('gratipay.application.email.sleep')
-        sleep_patcher.start()
-        self.addCleanup(sleep_patcher.stop)
 
     def _get_last_email(self):
         return self.mailer.call_args[1]
@@ -121,6 +121,7 @@ class Harness(unittest.TestCase):
 
     def tearDown(self):
         resources.__cache__ = {}  # Clear the simplate cache.
+        self.app.cache.clear()
         self.clear_tables()
 
 
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""A cache with pluggable backends.
+
+A :py:class:`Cache` keeps hit and miss counters and hands storage off to one of
+these backends:
+
+ - :py:class:`LRUBackend` keeps entries in a dict in this process.
+ - :py:class:`SharedMemoryBackend` keeps entries in files on a tmpfs, so that
+   every worker process on a node shares them.
+ - :py:class:`MemcacheBackend` keeps entries in memcached (or in
+   :py:class:`LocalMemcache`, a stand-in for development and tests), so that
+   every node shares them.
+
+Every entry has its own TTL. Backends drop expired entries when they come
+across them, and evict entries to stay under ``max_entries``.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import errno
+import hashlib
+import os
+import pickle
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+MISSING = object()
+
+
+class UnsafeCacheDirectory(Exception):
+    """We unpickle what's in the cache directory, so we won't use one that
+    anyone else could write to.
+    """
+
+    def __str__(self):
+        return "{} isn't a directory that only we can write to.".format(*self.args)
+
+
+def hash_key(key):
+    """Given a picklable key, return a hex digest ``str`` for it.
+    """
+    return hashlib.sha1(pickle.dumps(key, 2)).hexdigest()
+
+
+class LRUBackend(object):
+    """Keep entries in this process, evicting the least recently used.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            expires, value = self.entries.pop(key, (None, MISSING))
+            if value is MISSING:
+                return MISSING
+            if expires <= time.time():
+                return MISSING
+            self.entries[key] = (expires, value)  # most recently used goes last
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SharedMemoryBackend(object):
+    """Keep entries as pickle files in a directory, in ``/dev/shm`` by default.
+
+    Processes that point at the same directory share entries. We create the
+    directory readable by us alone, and since we unpickle what's in it, we
+    raise :py:exc:`UnsafeCacheDirectory` for one that's already there if
+    anyone else owns it or could write to it. Writes are atomic
+    renames, so readers never see half an entry. We only count entries every
+    ``check_every`` writes, so the size bound is a soft one; when we're over
+    it we evict the least recently written entries.
+
+    """
+
+    def __init__(self, path=None, max_entries=1000, check_every=100):
+        if path is None:
+            shm = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            path = os.path.join(shm, 'gratipay-cache-{}'.format(os.getuid()))
+        self.path = path
+        self.max_entries = max_entries
+        self.check_every = check_every
+        self.nsets = 0
+        self.evictions = 0
+        try:
+            os.makedirs(path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        st = os.lstat(path)  # not stat, so that we don't follow a symlink
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o022:
+            raise UnsafeCacheDirectory(path)
+
+    def _filename(self, key):
+        return os.path.join(self.path, hash_key(key))
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def get(self, key):
+        try:
+            with open(self._filename(key), 'rb') as fp:
+                stored_key, expires, value = pickle.load(fp)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return MISSING
+        if stored_key != key or expires <= time.time():
+            return MISSING
+        return value
+
+    def set(self, key, value, ttl):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.')
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump((key, time.time() + ttl, value), fp, 2)
+        os.rename(tmp, self._filename(key))
+        self.nsets += 1
+        if self.nsets % self.check_every == 0:
+            self.evict()
+
+    def evict(self):
+        """Drop the least recently written entries until we're under
+        ``max_entries``.
+        """
+        filenames = [os.path.join(self.path, f) for f in os.listdir(self.path)
+                     if not f.startswith('.')]
+        noverflow = len(filenames) - self.max_entries
+        if noverflow <= 0:
+            return
+        mtimes = []
+        for filename in filenames:
+            try:
+                mtimes.append((os.stat(filename).st_mtime, filename))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        for mtime, filename in sorted(mtimes)[:noverflow]:
+            self._remove(filename)
+            self.evictions += 1
+
+    def delete(self, key):
+        self._remove(self._filename(key))
+
+    def clear(self):
+        for f in os.listdir(self.path):
+            if not f.startswith('.'):  # leave other processes' writes in flight alone
+                self._remove(os.path.join(self.path, f))
+
+    def __len__(self):
+        return len([f for f in os.listdir(self.path) if not f.startswith('.')])
+
+
+class MemcacheBackend(object):
+    """Keep entries in memcached, given a client with the ``python-memcached``
+    API (``get``, ``set``, ``delete``, and ``flush_all``).
+
+    Memcached does its own eviction, so size it with ``memcached -m``. Keys are
+    hashed to fit memcached's rules, and prefixed with ``namespace`` so that
+    more than one app can share a server.
+
+    """
+
+    def __init__(self, client, namespace='gratipay'):
+        self.client = client
+        self.namespace = namespace
+
+    def _key(self, key):
+        return str('{}:{}'.format(self.namespace, hash_key(key)))
+
+    def get(self, key):
+        stored = self.client.get(self._key(key))
+        if stored is None:
+            return MISSING
+        stored_key, value = stored
+        return value if stored_key == key else MISSING
+
+    def set(self, key, value, ttl):
+        # memcached takes whole seconds, and 0 means "never expire"
+        self.client.set(self._key(key), (key, value), time=max(1, int(round(ttl))))
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        self.client.flush_all()
+
+
+class LocalMemcache(object):
+    """Stand in for a ``python-memcached`` client, in this process.
+
+    Values are pickled on the way in, like they would be on their way to a real
+    server, so that code that mutates what it gets back doesn't pass here and
+    fail in production.
+
+    """
+
+    def __init__(self, max_entries=1000):
+        self.lru = LRUBackend(max_entries)
+
+    def get(self, key):
+        value = self.lru.get(key)
+        return None if value is MISSING else pickle.loads(value)
+
+    def set(self, key, value, time=0):
+        self.lru.set(key, pickle.dumps(value, 2), time or float('inf'))
+        return True
+
+    def delete(self, key):
+        self.lru.delete(key)
+        return True
+
+    def flush_all(self):
+        self.lru.clear()
+
+
+class Cache(object):
+    """Cache values under picklable keys, with a default TTL in seconds.
+
+    :param backend: one of the backends in this module
+    :param ttl: how long entries live unless :py:meth:`set` says otherwise
+
+    """
+
+    def __init__(self, backend, ttl=60):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        value = self.backend.get(key)
+        with self.lock:
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return default if value is MISSING else value
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(key, value, self.ttl if ttl is None else ttl)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+
+    def get_or_set(self, key, compute, ttl=None):
+        """Return the value for ``key``, calling ``compute`` and storing what
+        it returns on a miss.
+        """
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            value = compute()
+            self.set(key, value, ttl)
+        return value
+
+    def stats(self):
+        """Return a ``dict`` of counters: ``hits``, ``misses``, and, if the
+        backend counts them, ``evictions``.
+        """
+        out = dict(hits=self.hits, misses=self.misses)
+        if hasattr(self.backend, 'evictions'):
+            out['evictions'] = self.backend.evictions
+        return out
+
+
+def make_backend(name, max_entries=1000, memcache_servers=''):
+    """Given a backend name from the environment, return a backend.
+
+    ``memcache`` with no servers gives you a :py:class:`LocalMemcache`. With
+    servers, it needs ``python-memcached``, which we don't otherwise require.
+
+    """
+    if name == 'lru':
+        return LRUBackend(max_entries)
+    elif name == 'shm':
+        return SharedMemoryBackend(max_entries=max_entries)
+    elif name == 'memcache':
+        if not memcache_servers:
+            return MemcacheBackend(LocalMemcache(max_entries))
+        import memcache
+        return MemcacheBackend(memcache.Client(memcache_servers.split()))
+    raise ValueError("unknown cache backend: {}".format(name))
@@ -1,8 +1,24 @@
-from datetime import datetime
+import csv
+from datetime import datetime, timedelta
 from decimal import Decimal
+from io import BytesIO
 
-from aspen import Response
-from psycopg2 import IntegrityError
+from aspen import Response, json
+from postgres.cursors import SimpleNamedTupleCursor
+
+from gratipay.billing.ledger import get_balance_at, get_delta
+
+
+def year_bounds(year):
+    """Return the first instants of ``year`` and the year after.
+
+    Filter with ``timestamp >= start AND timestamp < end``, not with ``extract(year
+    from timestamp)``, so that Postgres can use an index on ``timestamp``. Like
+    the filter it replaces, this takes the year as a string too.
+
+    """
+    year = int(year)
+    return datetime(year, 1, 1), datetime(year+1, 1, 1)
 
 
 def get_end_of_year_balance(db, participant, year, current_year):
@@ -11,108 +27,131 @@ def get_end_of_year_balance(db, participant, year, current_year):
     start = participant.claimed_time or participant.ctime
     if year < start.year:
         return Decimal('0.00')
+    return get_balance_at(db, participant, year_bounds(year)[1])
 
-    balance = db.one("""
-        SELECT balance
-          FROM balances_at
-         WHERE participant = %s
-           AND "at" = %s
-    """, (participant.id, datetime(year+1, 1, 1)))
-    if balance is not None:
-        return balance
 
-    username = participant.username
-    start_balance = get_end_of_year_balance(db, participant, year-1, current_year)
-    delta = db.one("""
-        SELECT (
-                  SELECT COALESCE(sum(amount), 0) AS a
-                    FROM exchanges
-                   WHERE participant = %(username)s
-                     AND extract(year from timestamp) = %(year)s
-                     AND amount > 0
-                     AND (status is null OR status = 'succeeded')
-               ) + (
-                  SELECT COALESCE(sum(amount-fee), 0) AS a
-                    FROM exchanges
-                   WHERE participant = %(username)s
-                     AND extract(year from timestamp) = %(year)s
-                     AND amount < 0
-                     AND (status is null OR status <> 'failed')
-               ) + (
-                  SELECT COALESCE(sum(-amount), 0) AS a
-                    FROM transfers
-                   WHERE tipper = %(username)s
-                     AND extract(year from timestamp) = %(year)s
-               ) + (
-                  SELECT COALESCE(sum(amount), 0) AS a
-                    FROM transfers
-                   WHERE tippee = %(username)s
-                     AND extract(year from timestamp) = %(year)s
-               ) AS delta
-    """, locals())
-    balance = start_balance + delta
-    try:
-        db.run("""
-            INSERT INTO balances_at
-                        (participant, at, balance)
-                 VALUES (%s, %s, %s)
-        """, (participant.id, datetime(year+1, 1, 1), balance))
-    except IntegrityError:
-        pass
-    return balance
-
-
-def iter_payday_events(db, participant, year=None):
+# Everything that moved money in or out of a participant's balance in
+# [start, end), newest first, with the number of the payday (if any) on the
+# same day. Each arm is ordered and limited on its own so that it can walk the
+# (participant, timestamp) indexes backwards. A NULL limit means no limit.
+TIMELINE = """
+    SELECT e.*, pd.number AS payday_number
+      FROM (
+            ( SELECT 'exchange' AS source, id, timestamp, amount, fee, status, note, recorder
+                   , NULL::payment_direction AS direction, NULL AS team
+                   , NULL AS tipper, NULL AS tippee, NULL::context_type AS context
+                FROM exchanges
+               WHERE participant = %(username)s
+                 AND timestamp >= %(start)s AND timestamp < %(end)s
+            ORDER BY timestamp DESC
+               LIMIT %(limit)s
+            )
+         UNION ALL
+            ( SELECT 'payment', id, timestamp, amount, NULL, NULL, NULL, NULL
+                   , direction, team, NULL, NULL, NULL
+                FROM payments
+               WHERE participant = %(username)s
+                 AND timestamp >= %(start)s AND timestamp < %(end)s
+            ORDER BY timestamp DESC
+               LIMIT %(limit)s
+            )
+         UNION ALL
+            ( SELECT 'transfer', id, timestamp, amount, NULL, NULL, NULL, NULL
+                   , NULL, NULL, tipper, tippee, context
+                FROM transfers
+               WHERE tipper = %(username)s
+                 AND timestamp >= %(start)s AND timestamp < %(end)s
+            ORDER BY timestamp DESC
+               LIMIT %(limit)s
+            )
+         UNION ALL
+            ( SELECT 'transfer', id, timestamp, amount, NULL, NULL, NULL, NULL
+                   , NULL, NULL, tipper, tippee, context
+                FROM transfers
+               WHERE tippee = %(username)s
+                 AND tipper <> %(username)s
+                 AND timestamp >= %(start)s AND timestamp < %(end)s
+            ORDER BY timestamp DESC
+               LIMIT %(limit)s
+            )
+           ) e
+ LEFT JOIN ( SELECT ts_start::date AS date, max(number) AS number
+               FROM ( SELECT ts_start, row_number() OVER (ORDER BY ts_start) - 1 AS number
+                        FROM paydays
+                    ) _
+           GROUP BY ts_start::date
+           ) pd ON pd.date = e.timestamp::date
+  ORDER BY e.timestamp DESC, e.source, e.id DESC
+     LIMIT %(limit)s
+"""
+
+
+def _get_timeline(db, username, start, end, limit=None):
+    params = dict(username=username, start=start, end=end, limit=limit)
+    return db.all(TIMELINE, params, back_as=dict)
+
+
+def iter_payday_events(db, participant, year=None, before=None, limit=None):
     """Yields payday events for the given participant.
+
+    Pass ``limit`` to get about that many money movements, the latest ones
+    before the date ``before`` (by default, the end of ``year``). We always
+    yield whole days, so if there are more to get the last event is a
+    ``next-page`` one, with the ``before`` to ask for next. Totals only come
+    with the first page.
+
     """
     current_year = datetime.utcnow().year
     year = year or current_year
 
     username = participant.username
-    exchanges = db.all("""
-        SELECT *
-          FROM exchanges
-         WHERE participant=%(username)s
-           AND extract(year from timestamp) = %(year)s
-    """, locals(), back_as=dict)
-    payments = db.all("""
-        SELECT *
-          FROM payments
-         WHERE participant=%(username)s
-           AND extract(year from timestamp) = %(year)s
-    """, locals(), back_as=dict)
-    transfers = db.all("""
-        SELECT *
-          FROM transfers
-         WHERE (tipper=%(username)s OR tippee=%(username)s)
-           AND extract(year from timestamp) = %(year)s
-    """, locals(), back_as=dict)
-
-    if not (exchanges or payments or transfers):
+    start, end = year_bounds(year)
+    year_end = end
+    if before is not None:
+        end = min(end, datetime(before.year, before.month, before.day))
+
+    events = _get_timeline(db, username, start, end, None if limit is None else limit + 1)
+    if not events:
         return
 
-    if payments or transfers:
-        payments_given = sum([p['amount'] for p in payments if p['direction'] == 'to-team'])
-        payments_received = sum([p['amount'] for p in payments \
-                                                            if p['direction'] == 'to-participant'])
-        transfers_given = sum(t['amount'] for t in transfers \
-                                             if t['tipper'] == username and t['context'] != 'take')
-        transfers_received = sum(t['amount'] for t in transfers if t['tippee'] == username)
-        yield dict( kind='totals'
-                  , given=payments_given + transfers_given
-                  , received=payments_received + transfers_received
-                   )
-
-    payday_dates = db.all("""
-        SELECT ts_start::date
-          FROM paydays
-      ORDER BY ts_start ASC
-    """)
+    next_before = None
+    if limit is not None and len(events) > limit:
+        # We probably got only part of the oldest day. Leave it for the next
+        # page, unless it's the only day we got, in which case get all of it.
+        oldest = events[-1]['timestamp'].date()
+        if events[0]['timestamp'].date() == oldest:
+            day_start = datetime(oldest.year, oldest.month, oldest.day)
+            events = _get_timeline(db, username, day_start, end)
+            next_before = oldest
+        else:
+            events = [e for e in events if e['timestamp'].date() != oldest]
+            next_before = oldest + timedelta(days=1)
+
+    if before is None:
+        totals = db.one("""
+            SELECT count(*), COALESCE(sum(given), 0), COALESCE(sum(received), 0)
+              FROM ( SELECT CASE WHEN direction = 'to-team' THEN amount ELSE 0 END AS given
+                          , CASE WHEN direction = 'to-participant' THEN amount ELSE 0 END AS received
+                       FROM payments
+                      WHERE participant = %(username)s
+                        AND timestamp >= %(start)s AND timestamp < %(end)s
+                  UNION ALL
+                     SELECT CASE WHEN tipper = %(username)s AND context <> 'take' THEN amount
+                                 ELSE 0 END
+                          , CASE WHEN tippee = %(username)s THEN amount ELSE 0 END
+                       FROM transfers
+                      WHERE (tipper = %(username)s OR tippee = %(username)s)
+                        AND timestamp >= %(start)s AND timestamp < %(end)s
+                   ) _
+        """, dict(username=username, start=start, end=end), back_as=tuple)
+        n, given, received = totals
+        if n:
+            yield dict(kind='totals', given=given, received=received)
 
     balance = get_end_of_year_balance(db, participant, year, current_year)
+    if end < year_end:
+        balance -= get_delta(db, username, end, year_end)
     prev_date = None
-    get_timestamp = lambda e: e['timestamp']
-    events = sorted(exchanges+payments+transfers, key=get_timestamp, reverse=True)
     for event in events:
 
         event['balance'] = balance
@@ -122,16 +161,12 @@ def iter_payday_events(db, participant, year=None):
             if prev_date:
                 yield dict(kind='day-close', balance=balance)
             day_open = dict(kind='day-open', date=event_date, balance=balance)
-            if payday_dates:
-                while payday_dates and payday_dates[-1] > event_date:
-                    payday_dates.pop()
-                payday_date = payday_dates[-1] if payday_dates else None
-                if event_date == payday_date:
-                    day_open['payday_number'] = len(payday_dates) - 1
+            if event['payday_number'] is not None:
+                day_open['payday_number'] = event['payday_number']
             yield day_open
             prev_date = event_date
 
-        if 'fee' in event:
+        if event['source'] == 'exchange':
             if event['amount'] > 0:
                 kind = 'charge'
                 if event['status'] in (None, 'succeeded'):
@@ -140,7 +175,7 @@ def iter_payday_events(db, participant, year=None):
                 kind = 'credit'
                 if event['status'] != 'failed':
                     balance -= event['amount'] - event['fee']
-        elif 'direction' in event:
+        elif event['source'] == 'payment':
             kind = 'payment'
             if event['direction'] == 'to-participant':
                 balance -= event['amount']
@@ -158,66 +193,164 @@ def iter_payday_events(db, participant, year=None):
         yield event
 
     yield dict(kind='day-close', balance=balance)
+    if next_before:
+        yield dict(kind='next-page', before=next_before)
 
 
-def export_history(participant, year, mode, key, back_as='namedtuple', require_key=False):
-    db = participant.db
-    params = dict(username=participant.username, year=year)
-    out = {}
-    if mode == 'aggregate':
-        out['given'] = lambda: db.all("""
+EXPORTS = {
+    'aggregate': {
+        'given': """
             SELECT tippee, sum(amount) AS amount
               FROM transfers
              WHERE tipper = %(username)s
-               AND extract(year from timestamp) = %(year)s
+               AND timestamp >= %(start)s AND timestamp < %(end)s
           GROUP BY tippee
-        """, params, back_as=back_as)
-        out['taken'] = lambda: db.all("""
+        """,
+        'taken': """
             SELECT tipper AS team, sum(amount) AS amount
               FROM transfers
              WHERE tippee = %(username)s
                AND context = 'take'
-               AND extract(year from timestamp) = %(year)s
+               AND timestamp >= %(start)s AND timestamp < %(end)s
           GROUP BY tipper
-        """, params, back_as=back_as)
-    else:
-        out['exchanges'] = lambda: db.all("""
+        """,
+    },
+    'full': {
+        'exchanges': """
             SELECT timestamp, amount, fee, status, note
               FROM exchanges
              WHERE participant = %(username)s
-               AND extract(year from timestamp) = %(year)s
+               AND timestamp >= %(start)s AND timestamp < %(end)s
           ORDER BY timestamp ASC
-        """, params, back_as=back_as)
-        out['given'] = lambda: db.all("""
+        """,
+        'given': """
             SELECT timestamp, tippee, amount, context
               FROM transfers
              WHERE tipper = %(username)s
-               AND extract(year from timestamp) = %(year)s
+               AND timestamp >= %(start)s AND timestamp < %(end)s
           ORDER BY timestamp ASC
-        """, params, back_as=back_as)
-        out['taken'] = lambda: db.all("""
+        """,
+        'taken': """
             SELECT timestamp, tipper AS team, amount
               FROM transfers
              WHERE tippee = %(username)s
                AND context = 'take'
-               AND extract(year from timestamp) = %(year)s
+               AND timestamp >= %(start)s AND timestamp < %(end)s
           ORDER BY timestamp ASC
-        """, params, back_as=back_as)
-        out['received'] = lambda: db.all("""
+        """,
+        'received': """
             SELECT timestamp, amount, context
               FROM transfers
              WHERE tippee = %(username)s
                AND context NOT IN ('take', 'take-over')
-               AND extract(year from timestamp) = %(year)s
+               AND timestamp >= %(start)s AND timestamp < %(end)s
           ORDER BY timestamp ASC
-        """, params, back_as=back_as)
+        """,
+    },
+}
+
+STREAM_ITERSIZE = 1000      # rows to fetch from the server-side cursor at a time
+STREAM_CHUNK_SIZE = 65536   # bytes to buffer before sending them on
+STREAM_STATEMENT_TIMEOUT = 60 * 1000        # [ms] per fetch from the cursor
+STREAM_IDLE_TIMEOUT = 10 * 60 * 1000        # [ms] between fetches, for a slow client
 
+
+def _get_export(participant, year, end_year, mode, key, require_key):
+    """Validate an export request, and return the queries for it and their
+    parameters.
+    """
+    queries = EXPORTS['aggregate' if mode == 'aggregate' else 'full']
     if key:
-        try:
-            return out[key]()
-        except KeyError:
+        if key not in queries:
             raise Response(400, "bad key `%s`" % key)
+        queries = {key: queries[key]}
     elif require_key:
         raise Response(400, "missing `key` parameter")
-    else:
-        return {k: v() for k, v in out.items()}
+    start, end = year_bounds(year)[0], year_bounds(end_year or year)[1]
+    params = dict(username=participant.username, start=start, end=end)
+    return queries, params
+
+
+def export_history(participant, year, mode, key, back_as='namedtuple', require_key=False,
+                   end_year=None):
+    db = participant.db
+    queries, params = _get_export(participant, year, end_year, mode, key, require_key)
+    out = {k: db.all(sql, params, back_as=back_as) for k, sql in queries.items()}
+    return out[key] if key else out
+
+
+def stream_history(participant, year, mode, key, format, end_year=None):
+    """Return an iterator over the chunks of a CSV or JSON export of the years
+    from ``year`` through ``end_year``.
+
+    This is :py:func:`export_history` for big exports. Rows come out of a
+    server-side cursor :py:data:`STREAM_ITERSIZE` at a time, and go out in
+    chunks of about :py:data:`STREAM_CHUNK_SIZE` bytes, so memory use doesn't
+    grow with the size of the export. We check the request before we return,
+    so that a bad one is still a 400. CSV needs a ``key``.
+
+    """
+    queries, params = _get_export(participant, year, end_year, mode, key, format == 'csv')
+    if format == 'csv':
+        return _stream_csv(participant.db, queries[key], params)
+    return _stream_json(participant.db, queries, params, key)
+
+
+def _iter_rows(db, sql, params):
+    """Yield the rows of a query from a server-side cursor.
+
+    The cursor's transaction stays open for as long as the client takes to
+    download the export, so we run it on a connection of our own rather than
+    one from the pool, and time it out if the client stalls.
+
+    """
+    with db.get_dedicated_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SET statement_timeout = %s", (STREAM_STATEMENT_TIMEOUT,))
+            if connection.server_version >= 90600:
+                cursor.execute( "SET idle_in_transaction_session_timeout = %s"
+                              , (STREAM_IDLE_TIMEOUT,)
+                               )
+        cursor = connection.cursor('export', cursor_factory=SimpleNamedTupleCursor)
+        cursor.itersize = STREAM_ITERSIZE
+        try:
+            cursor.execute(sql, params)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
+
+def _stream_csv(db, sql, params):
+    f = BytesIO()
+    w = csv.writer(f)
+    for i, row in enumerate(_iter_rows(db, sql, params)):
+        if i == 0:
+            w.writerow(row._fields)
+        w.writerow(row)
+        if f.tell() >= STREAM_CHUNK_SIZE:
+            yield f.getvalue()
+            f.seek(0)
+            f.truncate()
+    yield f.getvalue()
+
+
+def _stream_json(db, queries, params, key):
+    chunk, size = [], 0
+    if not key:
+        chunk.append('{')
+    for i, k in enumerate(sorted(queries)):
+        if not key:
+            chunk.append('%s%s: ' % (',' if i else '', json.dumps(k)))
+        chunk.append('[')
+        for j, row in enumerate(_iter_rows(db, queries[k], params)):
+            s = (',' if j else '') + json.dumps(row._asdict(), indent=None)
+            chunk.append(s)
+            size += len(s)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk, size = [], 0
+        chunk.append(']')
+    if not key:
+        chunk.append('}')
+    yield ''.join(chunk)
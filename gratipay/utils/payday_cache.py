@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from gratipay.utils.query_cache import QueryCache
+
+
+GENERATION_KEY = ('payday-cache', 'generation')
+
+
+class PaydayCache(object):
+    """Cache values that only change at payday, like our public stats.
+
+    Keys include the id of the last payday that finished, so the moment a
+    payday ends, everything we cached for the one before it misses. We look
+    that id up at most every ``recheck_every`` seconds, and
+    :py:meth:`invalidate`, which :py:meth:`Payday.end` calls, makes the next
+    read look it up again right away. With the ``lru`` cache backend each
+    worker process keeps its own copy of the id, so other workers can lag a
+    finished payday by up to ``recheck_every`` seconds.
+
+    Values go through a :py:class:`~gratipay.utils.query_cache.QueryCache`, so
+    when a payday ends only one thread per worker computes each of them, while
+    the others wait for its result instead of all hitting the database at once.
+
+    Values have to be picklable for the shared cache backends, so give us
+    plain tuples, lists, and dicts, not records.
+
+    """
+
+    recheck_every = 60          # how often to look up the last payday [seconds]
+    ttl = 8 * 24 * 60 * 60      # how long to keep values around [seconds]
+
+    def __init__(self, db, cache):
+        self.db = db
+        self.cache = cache
+        self.query_cache = QueryCache(db, threshold=self.ttl, cache=cache)
+
+    def generation(self):
+        """Return the id of the last payday that finished, or 0.
+        """
+        return self.cache.get_or_set(GENERATION_KEY, self._last_payday_id, self.recheck_every)
+
+    def _last_payday_id(self):
+        return self.db.one("""
+            SELECT id
+              FROM paydays
+             WHERE ts_end > ts_start
+          ORDER BY id DESC
+             LIMIT 1
+        """, default=0)
+
+    def get(self, name, compute):
+        """Return the value cached under ``name`` for the last payday, calling
+        ``compute`` for it if we haven't yet.
+        """
+        return self.query_cache.get(('payday-cache', name, self.generation()), compute)
+
+    def invalidate(self):
+        self.cache.delete(GENERATION_KEY)
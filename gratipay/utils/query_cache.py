@@ -1,8 +1,11 @@
-import sys
+import math
+import random
 import threading
 import time
 import traceback
 
+from .cache import MISSING, Cache, LRUBackend, hash_key
+
 
 # Define a query cache.
 # ==========================
@@ -16,33 +19,43 @@ class Entry(object):
     """An entry in a QueryCache.
     """
 
-    timestamp = None    # The timestamp of the last query run [datetime.datetime]
-    lock = None         # Access control for this record [threading.Lock]
-    exc = None          # Any exception in query or formatting [Exception]
+    __slots__ = ('result', 'exc', 'timestamp', 'delta', 'ttl')
 
-    def __init__(self, timestamp=0, lock=None, result=None):
-        """Populate with dummy data or an actual db entry.
-        """
-        self.timestamp = timestamp
-        self.lock = lock or threading.Lock()
-        self.result = result
+    def __init__(self, result, exc, timestamp, delta, ttl):
+        self.result = result        # The processed query result
+        self.exc = exc              # Any exception in query or formatting [FormattingError]
+        self.timestamp = timestamp  # When we computed the result [seconds since the epoch]
+        self.delta = delta          # How long that took [seconds]
+        self.ttl = ttl              # How long the result is fresh for [seconds]
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    @property
+    def is_negative(self):
+        return self.exc is not None or self.result is None
 
 
 class QueryCache(object):
     """Implement a caching SQL post-processor.
 
-    Instances of this object are callables that take two or more arguments. The
-    first argument is a callback function; subsequent arguments are strings of
-    SQL. The callback function will be given one result set per SQL query, and
-    in the same order. These result sets are lists of dictionaries. The
-    callback function may return any Python data type; this is the query
-    result, post-processed for your application.
+    Instances of this object have ``one`` and ``all`` methods that take a SQL
+    string, a tuple of parameters, and an optional ``process`` callback. The
+    callback will be given the result of ``db.one`` or ``db.all`` and may
+    return any Python data type; this is the query result, post-processed for
+    your application. For results that don't come from one query, ``get``
+    takes any key and a function that computes the result.
 
-    The results of the callback are cached for <self.threshold> seconds
-    (default: 5), keyed to the given SQL queries. NB: the cache is *not* keyed
-    to the callback function, so cache entries with different callbacks will
-    collide when operating on identical SQL queries. In this case cache entries
-    can be differentiated by adding comments to the SQL statements.
+    The results of the callback are fresh for <self.threshold> seconds
+    (default: 5), keyed to the given SQL query and parameters. NB: the cache is
+    *not* keyed to the callback function, so cache entries with different
+    callbacks will collide when operating on identical SQL queries. In this
+    case cache entries can be differentiated by adding comments to the SQL
+    statements.
 
     This so-called micro-caching helps greatly when under load, while keeping
     pages more or less fresh. For relatively static page elements like
@@ -52,13 +65,27 @@ class QueryCache(object):
     setting (1 or 2 seconds): the page will appear dynamic to any given user,
     but 100 requests in the same second will only result in one database call.
 
-    This object also features a pruning thread, which removes stale cache
-    entries on a more relaxed schedule (default: 60 seconds). It keeps the
-    cache clean without interfering too much with actual usage.
+    Entries are stored in a :py:class:`~gratipay.utils.cache.Cache`, which
+    by default keeps up to 1000 of them in this process. Pass a ``cache``
+    with a shared backend to have all of the workers on a node (or all of the
+    nodes) share results.
+
+    Nobody waits on an expensive query that we've run before. For
+    <self.stale_for> seconds after an entry goes stale we keep serving it,
+    while one background thread (per process) runs the query again. To spread
+    those refreshes out, each read may also start one a little *before* the
+    entry goes stale, more likely the closer it is to going stale and the
+    longer the query took last time (this is the "XFetch" algorithm; set
+    <self.beta> higher to refresh earlier, or to 0 to turn it off). Only when
+    there's no entry at all does a caller run the query itself, and then only
+    one thread at a time per query; the others wait for its result.
 
     If the actual database call or the formatting callback raise an Exception,
-    then that is cached as well, and will be raised on further calls until the
-    cache expires as usual.
+    or if ``one`` comes back with ``None``, then that is a negative result.
+    Negative results are cached for <self.negative_ttl> seconds (default: 1;
+    0 turns that off), and are never served stale. An error while refreshing
+    doesn't replace a good entry: we keep serving the stale one until it runs
+    out, and then raise.
 
     And yes, Virginia, QueryCache is thread-safe (as long as you don't invoke
     the same instance again within your formatting callback).
@@ -66,28 +93,26 @@ class QueryCache(object):
     """
 
     db = None               # PostgresManager object
-    cache = None            # the query cache [dictionary]
-    locks = None            # access controls for self.cache [Locks]
-    threshold = 5           # maximum life of a cache entry [seconds as int]
-    threshold_prune = 60    # time between pruning runs [seconds as int]
+    cache = None            # the query cache [gratipay.utils.cache.Cache]
+    threshold = 5           # how long an entry is fresh [seconds]
+    stale_for = 60          # how long to serve an entry after that, while refreshing [seconds]
+    negative_ttl = 1        # how long to cache errors and Nones [seconds]
+    beta = 1.0              # how eagerly to refresh before entries go stale
+    nlocks = 64             # how many locks to stripe queries across
 
 
-    def __init__(self, db, threshold=5, threshold_prune=60):
+    def __init__(self, db, threshold=5, cache=None, stale_for=60, negative_ttl=1, beta=1.0):
         """
         """
         self.db = db
         self.threshold = threshold
-        self.threshold_prune = threshold_prune
-        self.cache = {}
-
-        class Locks:
-            checkin = threading.Lock()
-            checkout = threading.Lock()
-        self.locks = Locks()
-
-        self.pruner = threading.Thread(target=self.prune)
-        self.pruner.setDaemon(True)
-        self.pruner.start()
+        self.stale_for = stale_for
+        self.negative_ttl = negative_ttl
+        self.beta = beta
+        self.cache = cache or Cache(LRUBackend(), ttl=threshold)
+        self.locks = [threading.Lock() for i in range(self.nlocks)]
+        self.refreshing = set()
+        self.refreshing_lock = threading.Lock()
 
 
     def one(self, query, params, process=None):
@@ -99,144 +124,87 @@ class QueryCache(object):
         return self._do_query(self.db.all, query, params, process)
 
     def _do_query(self, fetchfunc, query, params, process):
-        """Given a function, a SQL string, a tuple, and a function, return ???.
+        """Given a function, a SQL string, a tuple, and a function, return the
+        processed result, from the cache if we can.
         """
-
-        # Compute a cache key.
-        # ====================
-
-        key = (query, params)
-
-
-        # Check out an entry.
-        # ===================
-        # Each entry has its own lock, and "checking out" an entry means
-        # acquiring that lock. If a queryset isn't yet in our cache, we first
-        # "check in" a new dummy entry for it (and prevent other threads from
-        # adding the same query), which will be populated presently.
-
-        #thread_id = threading.currentThread().getName()[-1:] # for debugging
-        #call_id = ''.join([random.choice(string.letters) for i in range(5)])
-
-        self.locks.checkout.acquire()
-        try:  # critical section
-            if key in self.cache:
-
-                # Retrieve an already cached query.
-                # =================================
-                # The cached entry may be a dummy. The best way to guarantee we
-                # will catch this case is to simply refresh our entry after we
-                # acquire its lock.
-
-                entry = self.cache[key]
-                entry.lock.acquire()
-                entry = self.cache[key]
-
-            else:
-
-                # Add a new entry to our cache.
-                # =============================
-
-                dummy = Entry()
-                dummy.lock.acquire()
-                self.locks.checkin.acquire()
-                try:  # critical section
-                    if key in self.cache:
-                        # Someone beat us to it. XXX: can this actually happen?
-                        entry = self.cache[key]
-                    else:
-                        self.cache[key] = dummy
-                        entry = dummy
-                finally:
-                    self.locks.checkin.release()
-
-        finally:
-            self.locks.checkout.release() # Now that we've checked out our
-                                          # queryset, other threads are free to
-                                          # check out other queries.
-
-
-        # Process the query.
-        # ==================
-
-        try:  # critical section
-
-            # Decide whether it's a hit or miss.
-            # ==================================
-
-            if time.time() - entry.timestamp < self.threshold:  # cache hit
-                if entry.exc is not None:
-                    raise entry.exc
-                return entry.result
-
-            else:                                               # cache miss
-                try:                    # XXX uses postgres.py api, not dbapi2!
-                    entry.result = fetchfunc(query, params)
-                    if process is not None:
-                        entry.result = process(entry.result)
-                    entry.exc = None
-                except:
-                    entry.result = None
-                    entry.exc = ( FormattingError(traceback.format_exc())
-                                , sys.exc_info()[2]
-                                 )
-
-
-            # Check the queryset back in.
-            # ===========================
-
-            self.locks.checkin.acquire()
-            try:  # critical section
-                entry.timestamp = time.time()
-                self.cache[key] = entry
-                if entry.exc is not None:
-                    raise entry.exc[0]
-                else:
-                    return entry.result
-            finally:
-                self.locks.checkin.release()
-
-        finally:
-            entry.lock.release()
-
-
-    def prune(self):
-        """Periodically remove any stale queries in our cache.
+        def compute():                  # XXX uses postgres.py api, not dbapi2!
+            result = fetchfunc(query, params)
+            if process is not None:
+                result = process(result)
+            return result
+        return self.get(('query', query, params), compute)
+
+    def get(self, key, compute):
+        """Given a key and a function, return the result of calling the
+        function, from the cache if we can. This is :py:meth:`one` and
+        :py:meth:`all` for results that don't come from a single query.
         """
+        key = hash_key(key)  # params may be a dict
+
+        entry = self.cache.get(key, MISSING)
+        if entry is MISSING:                                    # cache miss
+            # Keys that hash to the same lock wait on each other, and then
+            # on whoever got there first.
+            with self.locks[int(key, 16) % self.nlocks]:
+                entry = self.cache.backend.get(key)  # don't count a second miss
+                if entry is MISSING:
+                    entry = self._compute(compute)
+                    self._store(key, entry)
+        elif self._should_refresh(entry):                       # stale hit
+            self._refresh_in_background(key, entry, compute)
+
+        if entry.exc is not None:
+            raise entry.exc
+        return entry.result
+
+
+    def _compute(self, compute):
+        start = time.time()
+        result, exc = None, None
+        try:
+            result = compute()
+        except:
+            result, exc = None, FormattingError(traceback.format_exc())
+        end = time.time()
+        entry = Entry(result, exc, end, end - start, self.threshold)
+        if entry.is_negative:
+            entry.ttl = self.negative_ttl
+        return entry
+
+    def _store(self, key, entry, previous=None):
+        if entry.exc is not None and previous is not None and not previous.is_negative:
+            return  # keep serving the stale result instead
+        ttl = entry.ttl if entry.is_negative else entry.ttl + self.stale_for
+        if ttl > 0:
+            self.cache.set(key, entry, ttl)
+
+    def _should_refresh(self, entry):
+        """XFetch: refresh with rising probability as ``entry`` nears its
+        expiry, and always once it's past it.
+        """
+        now = time.time()
+        expires = entry.timestamp + entry.ttl
+        early = entry.delta * self.beta * -math.log(1 - random.random())
+        return now + early >= expires
+
+    def _refresh_in_background(self, key, previous, compute):
+        with self.refreshing_lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        def refresh():
+            try:
+                self._store(key, self._compute(compute), previous)
+            finally:
+                with self.refreshing_lock:
+                    self.refreshing.discard(key)
+        self._spawn(refresh)
 
-        last = 0  # timestamp of last pruning run
-
-        while 1:
-
-            if time.time() < last + self.threshold_prune:
-                # Not time to prune yet.
-                time.sleep(0.2)
-                continue
-
-            self.locks.checkout.acquire()
-            try:  # critical section
-
-                for key, entry in tuple(self.cache.items()):
-
-                    # Check out the entry.
-                    # ====================
-                    # If the entry is currently in use, skip it.
-
-                    available = entry.lock.acquire(False)
-                    if not available:
-                        continue
-
-
-                    # Remove the entry if it is too old.
-                    # ==================================
-
-                    try:  # critical section
-                        if time.time() - entry.timestamp > self.threshold_prune:
-                            del self.cache[key]
-                    finally:
-                        entry.lock.release()
+    def _spawn(self, func):
+        thread = threading.Thread(target=func)
+        thread.daemon = True
+        thread.start()
 
-            finally:
-                self.locks.checkout.release()
 
-            last = time.time()
+    def stats(self):
+        return self.cache.stats()
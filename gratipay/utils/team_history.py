@@ -3,6 +3,9 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 from itertools import groupby
 
+from gratipay.utils.history import year_bounds
+
+
 def get_end_of_year_totals(db, team, year):
     """Gets the year end received and distributed for a team
 
@@ -11,23 +14,26 @@ def get_end_of_year_totals(db, team, year):
        year -- The integer year of the totals being returned.
     """
 
+    start, end = year_bounds(year)
+    params = dict(team=team.slug, start=start, end=end)
+
     received = db.one("""
         SELECT COALESCE(sum(amount), 0) AS Received
           FROM payments
          WHERE team = %(team)s
-           AND extract(year from timestamp) = %(year)s
+           AND timestamp >= %(start)s AND timestamp < %(end)s
            AND amount > 0
            AND direction='to-team';
-    """, dict(team=team.slug, year=year) )
+    """, params)
 
     distributed = db.one("""
         SELECT COALESCE(sum(amount), 0) AS Distributed
           FROM payments
          WHERE team = %(team)s
-           AND extract(year from timestamp) = %(year)s
+           AND timestamp >= %(start)s AND timestamp < %(end)s
            AND amount > 0
            AND direction='to-participant';
-    """, dict(team=team.slug, year=year) )
+    """, params)
 
     return received, distributed
 
@@ -40,15 +46,16 @@ def iter_team_payday_events(db, team, year):
        year -- The integer year for the events being iterated.
     """
 
+    start, end = year_bounds(year)
     payments = db.all("""
         SELECT payments.*, paydays.ts_start as payday_start
           FROM payments
           JOIN paydays
             ON payments.payday = paydays.id
            AND team=%(team)s
-           AND extract(year from timestamp) = %(year)s
+           AND timestamp >= %(start)s AND timestamp < %(end)s
          ORDER BY payments.payday DESC, direction, amount DESC
-       """, dict(team=team.slug, year=year), back_as=dict)
+       """, dict(team=team.slug, start=start, end=end), back_as=dict)
 
     events = []
 
@@ -1,6 +1,9 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import traceback
 from multiprocessing.dummy import Pool as ThreadPool
+from Queue import Queue
+from threading import Thread
 
 
 class ExceptionWrapped(Exception):
@@ -24,3 +27,59 @@ def threaded_map(func, iterable, threads=5):
     pool.close()
     pool.join()
     return r
+
+
+def threaded_pipeline(func, iterable, threads=5, maxsize=None):
+    """Call ``func`` on each item of ``iterable`` using a pool of threads.
+
+    Unlike :py:func:`threaded_map`, which consumes the whole iterable up front,
+    this hands items to the workers through a bounded queue as the iterable
+    produces them. That lets a slow producer (a paginated API search, say)
+    overlap with the work done on its results, while keeping memory flat.
+
+    :param int threads: the number of worker threads
+    :param int maxsize: the number of items allowed to wait in the queue;
+        defaults to four per thread
+
+    :returns: a list of the return values of ``func``, in no particular order
+
+    If ``func`` raises, we stop feeding the queue, let the workers finish what
+    they've already picked up, and then re-raise the first exception.
+
+    """
+    maxsize = threads * 4 if maxsize is None else maxsize
+    queue = Queue(maxsize)
+    results, errors = [], []
+    done = object()
+
+    def work():
+        while True:
+            item = queue.get()
+            if item is done:
+                break
+            if errors:
+                continue  # drain the queue so the producer can finish
+            try:
+                results.append(func(item))
+            except Exception as e:
+                errors.append((e, traceback.format_exc()))
+
+    workers = [Thread(target=work) for i in range(threads)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    try:
+        for item in iterable:
+            if errors:
+                break
+            queue.put(item)
+    finally:
+        for worker in workers:
+            queue.put(done)
+        for worker in workers:
+            worker.join()
+
+    if errors:
+        print(errors[0][1])
+        raise errors[0][0]
+    return results
@@ -1,4 +1,11 @@
+from __future__ import division
+
 import time
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+
+from psycopg2 import IntegrityError
 
 def start():
     return {'start_time': time.time()}
@@ -8,3 +15,128 @@ def end(start_time, website):
         print("count#requests=1")
         response_time = time.time() - start_time
         print("measure#response_time={}ms".format(response_time * 1000))
+
+
+class Latencies(object):
+    """Collect the durations of named calls, from any number of threads.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples = defaultdict(list)
+
+    @contextmanager
+    def timing(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.samples[name].append(seconds)
+
+    def summarize(self):
+        """Return a list of lines describing the calls recorded so far.
+        """
+        lines = []
+        with self.lock:
+            for name, samples in sorted(self.samples.items()):
+                samples = sorted(samples)
+                n = len(samples)
+                p95 = samples[min(n - 1, int(n * 0.95))]
+                lines.append( "{}: {} calls, mean {:.0f}ms, p95 {:.0f}ms, max {:.0f}ms".format(
+                              name, n, sum(samples) / n * 1000, p95 * 1000, samples[-1] * 1000
+                               ))
+        return lines
+
+
+class TokenBucket(object):
+    """Pace calls from any number of threads to a steady rate.
+
+    :param rate: how many calls to allow per second; zero or less means no limit
+    :param int burst: how many calls to allow back to back after a quiet spell;
+        defaults to one second's worth
+
+    """
+
+    def __init__(self, rate, burst=None):
+        self.lock = Lock()
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def take(self):
+        """Block until the caller may go ahead.
+
+        A caller that finds the bucket empty reserves the next token before
+        sleeping, so callers waiting in other threads queue up behind it rather
+        than all waking up at once.
+
+        """
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SharedTokenBucket(object):
+    """Pace calls from any number of processes to a steady rate overall.
+
+    This is :py:class:`TokenBucket` kept in the ``token_buckets`` table, so
+    that every process with the same ``name`` shares one rate. Each call
+    reserves the next free slot with one short transaction (which is the
+    "generic cell rate algorithm"), and then sleeps until its slot comes up.
+
+    :param db: a :py:class:`~postgres.Postgres` instance
+    :param unicode name: which bucket to take from
+    :param rate: as for :py:class:`TokenBucket`
+    :param int burst: as for :py:class:`TokenBucket`
+
+    """
+
+    def __init__(self, db, name, rate, burst=None):
+        self.db = db
+        self.name = name
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+
+    def take(self):
+        """Block until the caller may go ahead.
+        """
+        if self.rate <= 0:
+            return
+        params = dict(name=self.name, interval=1 / self.rate, allowance=(self.burst - 1) / self.rate)
+        wait = self._reserve(params)
+        if wait is None:
+            try:
+                self.db.run("INSERT INTO token_buckets (name) VALUES (%(name)s)", params)
+            except IntegrityError:
+                pass  # someone else just made it
+            wait = self._reserve(params)
+        if wait > 0:
+            time.sleep(wait)
+
+    def _reserve(self, params):
+        # The slot is when the next call may go; a bucket that's been idle
+        # lets a burst through right away.
+        return self.db.one("""
+            UPDATE token_buckets
+               SET next_slot = greatest( next_slot
+                                       , now() - %(allowance)s * interval '1 second'
+                                        ) + %(interval)s * interval '1 second'
+             WHERE name = %(name)s
+         RETURNING extract(epoch from next_slot - %(interval)s * interval '1 second' - now())::float8
+        """, params)
@@ -34,6 +34,7 @@ from gratipay.models.participant import Participant, Identity
 from gratipay.models.team import Team
 from gratipay.security.crypto import EncryptingPacker
 from gratipay.utils import find_files
+from gratipay.utils.cache import Cache, make_backend
 from gratipay.utils.http_caching import asset_etag
 from gratipay.utils.i18n import (
     ALIASES, ALIASES_R, COUNTRIES, LANGUAGES_2, LOCALES,
@@ -46,6 +47,10 @@ def base_url(website, env):
 def secure_cookies(env):
     gratipay.use_secure_cookies = env.base_url.startswith('https')
 
+def cache(env):
+    backend = make_backend(env.cache_backend, env.cache_max_entries, env.cache_memcache_servers)
+    return Cache(backend)
+
 def db(env):
 
     # Instantiating Application calls the rest of these wireup functions, and
@@ -340,8 +345,22 @@ def other_stuff(website, env):
     website.log_metrics = env.log_metrics
 
 
+def fill_in_fallbacks(environ):
+    """Given an environment mapping, return a copy with values for envvars that
+    deployments configured before we added them won't have.
+    """
+    environ = dict(environ)
+    if 'EMAIL_QUEUE_SEND_RATE' not in environ:
+        # This replaced EMAIL_QUEUE_SLEEP_FOR, how long to sleep after each send.
+        sleep_for = float(environ.get('EMAIL_QUEUE_SLEEP_FOR') or 1)
+        environ['EMAIL_QUEUE_SEND_RATE'] = str(1 / sleep_for if sleep_for > 0 else 0)
+    environ.setdefault('EMAIL_QUEUE_THREADS', '1')
+    return environ
+
+
 def env():
     env = Environment(
+        environ=fill_in_fallbacks(os.environ),
         AWS_SES_ACCESS_KEY_ID           = unicode,
         AWS_SES_SECRET_ACCESS_KEY       = unicode,
         AWS_SES_DEFAULT_REGION          = unicode,
@@ -386,9 +405,17 @@ def env():
         OPENSTREETMAP_AUTH_URL          = unicode,
         UPDATE_CTA_EVERY                = int,
         CHECK_DB_EVERY                  = int,
+        RECONCILE_COUNTERS_EVERY        = int,
         EMAIL_QUEUE_FLUSH_EVERY         = int,
-        EMAIL_QUEUE_SLEEP_FOR           = int,
+        EMAIL_QUEUE_SEND_RATE           = float,
+        EMAIL_QUEUE_THREADS             = int,
         EMAIL_QUEUE_ALLOW_UP_TO         = int,
+        PAYDAY_THREADS                  = int,
+        PAYDAY_SET_BASED                = is_yesish,
+        LEDGER_MONTHLY                  = is_yesish,
+        CACHE_BACKEND                   = unicode,
+        CACHE_MAX_ENTRIES               = int,
+        CACHE_MEMCACHE_SERVERS          = unicode,
         OPTIMIZELY_ID                   = unicode,
         SENTRY_DSN                      = unicode,
         LOG_METRICS                     = is_yesish,
@@ -13,6 +13,7 @@ setup( name='gratipay'
                         , 'queue-branch-email=gratipay.cli.queue_branch_email:main'
                         ,  'flush-email-queue=gratipay.cli.flush_email_queue:main'
                         ,   'list-email-queue=gratipay.cli.list_email_queue:main'
+                        , 'bench-email-render=gratipay.cli.bench_email_render:main'
                          ]
                        }
       )
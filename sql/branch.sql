@@ -0,0 +1,53 @@
+-- Record how far payin got, so a crashed payday can pick up where it left off.
+ALTER TABLE paydays ADD COLUMN payin_step text NOT NULL DEFAULT '';
+
+-- Remember how far we've gotten through npm's changes feed.
+CREATE TABLE worker_coordination (npm_last_seq bigint NOT NULL DEFAULT -1);
+INSERT INTO worker_coordination DEFAULT VALUES;
+
+-- Search npm packages by name and description.
+CREATE INDEX packages_name_trgm_idx ON packages USING gin(name gin_trgm_ops);
+CREATE INDEX packages_description_trgm_idx ON packages USING gin(description gin_trgm_ops);
+CREATE INDEX packages_lower_name_idx ON packages (package_manager, (lower(name)) COLLATE "C");
+
+-- Per-team payday series for %team/charts.json, maintained by payday.
+CREATE TABLE payday_team_stats
+( payday            int             NOT NULL REFERENCES paydays
+                                        ON UPDATE RESTRICT ON DELETE RESTRICT
+, team_id           bigint          NOT NULL REFERENCES teams (id)
+                                        ON UPDATE RESTRICT ON DELETE RESTRICT
+, nreceiving_from   int             NOT NULL
+, receipts          numeric(35,2)   NOT NULL
+, PRIMARY KEY (team_id, payday)
+ );
+
+INSERT INTO payday_team_stats (payday, team_id, nreceiving_from, receipts)
+     SELECT pd.id, t.id, count(*), sum(p.amount)
+       FROM ( SELECT id
+                   , ts_start
+                   , lead(ts_start) OVER (ORDER BY id) AS ts_next
+                FROM paydays
+            ) pd
+       JOIN payments p ON p.timestamp >= pd.ts_start
+                      AND (pd.ts_next IS NULL OR p.timestamp < pd.ts_next)
+       JOIN teams t ON t.slug = p.team
+      WHERE p.direction = 'to-team'
+   GROUP BY pd.id, t.id;
+
+-- Boundaries for which balances_at has everyone's balance (see gratipay.billing.ledger).
+CREATE TABLE balances_at_closings (at timestamptz PRIMARY KEY);
+
+-- Look up history by participant (or team) and timestamp range.
+CREATE INDEX exchanges_participant_timestamp_idx ON exchanges (participant, timestamp);
+CREATE INDEX payments_participant_timestamp_idx ON payments (participant, timestamp);
+CREATE INDEX payments_team_timestamp_idx ON payments (team, timestamp);
+CREATE INDEX transfers_tipper_timestamp_idx ON transfers (tipper, timestamp);
+CREATE INDEX transfers_tippee_timestamp_idx ON transfers (tippee, timestamp);
+DROP INDEX transfers_tipper_idx;
+DROP INDEX transfers_tippee_idx;
+
+-- Pace calls across processes (see gratipay.utils.timer.SharedTokenBucket).
+CREATE TABLE token_buckets
+( name          text            PRIMARY KEY
+, next_slot     timestamptz     NOT NULL DEFAULT '-infinity'
+ );
@@ -57,7 +57,7 @@ CREATE TABLE payday_payments_done AS
 
 DROP TABLE IF EXISTS payday_payment_instructions;
 CREATE TABLE payday_payment_instructions AS
-    SELECT s.id, participant_id, team_id, amount, due
+    SELECT s.id, participant_id, team_id, amount, due, s.ctime
       FROM ( SELECT DISTINCT ON (participant_id, team_id) *
                FROM payment_instructions
               WHERE mtime < (SELECT ts_start FROM current_payday())
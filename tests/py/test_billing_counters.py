@@ -0,0 +1,102 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from gratipay.billing import counters
+from gratipay.testing import Harness, D, P, T
+
+
+class TestCounters(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.alice = self.make_participant('alice', claimed_time='now', last_bill_result='')
+        self.enterprise = self.make_team(is_approved=True)
+
+    def test_set_payment_instruction_adds_to_counters(self):
+        self.alice.set_payment_instruction(self.enterprise, '5.00')
+        self.alice.set_payment_instruction(self.enterprise, '3.00')
+        assert self.alice.giving == P('alice').giving == D('3.00')
+        assert P('alice').ngiving_to == 1
+        assert self.enterprise.receiving == T('TheEnterprise').receiving == D('3.00')
+        assert T('TheEnterprise').nreceiving_from == 1
+        assert P('picard').taking == D('3.00')
+        assert counters.find_drift(self.db) == []
+
+    def test_set_payment_instruction_subtracts_from_counters(self):
+        bob = self.make_participant('bob', claimed_time='now', last_bill_result='')
+        self.alice.set_payment_instruction(self.enterprise, '5.00')
+        bob.set_payment_instruction(self.enterprise, '2.00')
+        self.alice.set_payment_instruction(self.enterprise, '0.00')
+        assert P('alice').giving == D('0.00')
+        assert P('alice').ngiving_to == 0
+        assert T('TheEnterprise').receiving == D('2.00')
+        assert T('TheEnterprise').nreceiving_from == 1
+        assert P('picard').taking == D('2.00')
+        assert counters.find_drift(self.db) == []
+
+    def test_unfunded_instructions_dont_count(self):
+        bob = self.make_participant('bob', claimed_time='now')
+        bob.set_payment_instruction(self.enterprise, '5.00')
+        assert P('bob').giving == D('0.00')
+        assert T('TheEnterprise').receiving == D('0.00')
+
+    def test_unapproved_teams_dont_count_toward_giving(self):
+        team = self.make_team('The Stargazer', is_approved=False)
+        self.alice.set_payment_instruction(team, '5.00')
+        assert P('alice').giving == D('0.00')
+        assert T('TheStargazer').receiving == D('5.00')
+        assert counters.find_drift(self.db) == []
+
+    def test_suspicious_participants_dont_count_toward_receiving(self):
+        self.db.run("UPDATE participants SET is_suspicious=true WHERE username='alice'")
+        self.alice.set_payment_instruction(self.enterprise, '5.00')
+        assert P('alice').giving == D('5.00')
+        assert T('TheEnterprise').receiving == D('0.00')
+
+    def test_a_card_change_we_missed_recomputes_everything(self):
+        stargazer = self.make_team('The Stargazer', is_approved=True)
+        self.alice.set_payment_instruction(self.enterprise, '5.00')
+        self.alice.set_payment_instruction(stargazer, '3.00')
+        self.db.run("UPDATE exchange_routes SET error='Card expired'")
+        self.alice.set_payment_instruction(self.enterprise, '4.00')
+        assert P('alice').giving == D('0.00')
+        assert T('TheStargazer').receiving == D('0.00')
+        assert T('TheEnterprise').receiving == D('0.00')
+        assert counters.find_drift(self.db) == []
+
+
+class TestReconcile(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        alice = self.make_participant('alice', claimed_time='now', last_bill_result='')
+        self.enterprise = self.make_team(is_approved=True)
+        alice.set_payment_instruction(self.enterprise, '5.00')
+
+    def test_finds_nothing_when_nothing_drifted(self):
+        assert counters.find_drift(self.db) == []
+        assert counters.reconcile(self.db) == 0
+
+    def test_finds_drift(self):
+        self.db.run("UPDATE participants SET giving=1, ngiving_to=2 WHERE username='alice'")
+        drift = counters.find_drift(self.db)
+        assert drift == [( 'participants'
+                         , P('alice').id
+                         , {'giving': (D('1.00'), D('5.00')), 'ngiving_to': (2, 1)}
+                          )]
+
+    def test_fixes_drift(self):
+        self.db.run("UPDATE participants SET giving=1 WHERE username='alice'")
+        self.db.run("UPDATE teams SET receiving=0, nreceiving_from=0, distributing=0")
+        self.db.run("UPDATE participants SET taking=7 WHERE username='picard'")
+        assert counters.reconcile(self.db) == 3
+        assert counters.find_drift(self.db) == []
+        assert P('alice').giving == D('5.00')
+        assert T('TheEnterprise').receiving == T('TheEnterprise').distributing == D('5.00')
+        assert T('TheEnterprise').nreceiving_from == 1
+        assert P('picard').taking == D('5.00')
+
+    def test_fixes_taking_from_fixed_receiving(self):
+        self.db.run("UPDATE teams SET receiving=9")
+        self.db.run("UPDATE participants SET taking=9 WHERE username='picard'")
+        assert counters.reconcile(self.db) == 2
+        assert P('picard').taking == D('5.00')
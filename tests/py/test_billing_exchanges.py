@@ -6,8 +6,12 @@ import mock
 import pytest
 
 from aspen.utils import typecheck
+from braintree.exceptions import DownForMaintenanceError, ServerError
+from gratipay.billing import exchanges
 from gratipay.billing.exchanges import (
     _prep_hit,
+    braintree_latencies,
+    call_braintree,
     cancel_card_hold,
     capture_card_hold,
     create_card_hold,
@@ -388,3 +392,44 @@ class TestsWithoutBillingHarness(Harness):
         assert alice.balance == D('4.00')
         record_exchange_result(self.db, e_id, 'succeeded', None, alice)
         assert P('alice').balance == D('35.59')
+
+
+    # cb - call_braintree
+
+    @mock.patch('gratipay.billing.exchanges.time.sleep')
+    def test_cb_retries_when_braintree_is_down(self, sleep):
+        func = mock.Mock(side_effect=[DownForMaintenanceError, DownForMaintenanceError, 'ok'])
+        assert call_braintree('sale', func, 'foo') == 'ok'
+        assert func.call_args_list == [mock.call('foo')] * 3
+        assert sleep.call_args_list == [mock.call(exchanges.BRAINTREE_BACKOFF),
+                                        mock.call(exchanges.BRAINTREE_BACKOFF * 2)]
+
+    @mock.patch('gratipay.billing.exchanges.time.sleep')
+    def test_cb_gives_up_eventually(self, sleep):
+        func = mock.Mock(side_effect=DownForMaintenanceError)
+        with self.assertRaises(DownForMaintenanceError):
+            call_braintree('sale', func)
+        assert func.call_count == exchanges.BRAINTREE_TRIES
+
+    @mock.patch('gratipay.billing.exchanges.time.sleep')
+    def test_cb_doesnt_retry_errors_that_arent_safe_to_retry(self, sleep):
+        func = mock.Mock(side_effect=ServerError)
+        with self.assertRaises(ServerError):
+            call_braintree('sale', func)
+        assert func.call_count == 1
+        assert not sleep.called
+
+    @mock.patch('gratipay.billing.exchanges.time.sleep')
+    def test_cb_retries_idempotent_calls_on_more_errors(self, sleep):
+        func = mock.Mock(side_effect=[ServerError, 'ok'])
+        assert call_braintree('void', func, retry_on=exchanges.SAFE_TO_RETRY_IDEMPOTENT) == 'ok'
+
+    def test_cb_records_latencies(self):
+        braintree_latencies.reset()
+        call_braintree('sale', lambda: None)
+        call_braintree('sale', lambda: None)
+        call_braintree('void', lambda: None)
+        summary = braintree_latencies.summarize()
+        assert len(summary) == 2
+        assert summary[0].startswith('sale: 2 calls')
+        assert summary[1].startswith('void: 1 calls')
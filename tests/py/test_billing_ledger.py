@@ -0,0 +1,75 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from datetime import datetime
+
+from aspen.utils import utc
+
+from gratipay.billing import ledger
+from gratipay.testing import Harness, D
+from gratipay.testing.billing import PaydayMixin
+from gratipay.utils.history import get_end_of_year_balance
+
+from test_history import make_history
+
+
+class TestBoundaries(Harness):
+
+    def test_yields_years(self):
+        actual = list(ledger.boundaries(datetime(2014, 6, 1), datetime(2016, 1, 1)))
+        assert actual == [datetime(2015, 1, 1), datetime(2016, 1, 1)]
+
+    def test_yields_months(self):
+        actual = list(ledger.boundaries(datetime(2015, 11, 15), datetime(2016, 2, 1), True))
+        assert actual == [datetime(2015, 12, 1), datetime(2016, 1, 1), datetime(2016, 2, 1)]
+
+    def test_yields_nothing_within_a_year(self):
+        assert list(ledger.boundaries(datetime(2015, 1, 1), datetime(2015, 12, 31))) == []
+
+
+class TestLedger(Harness, PaydayMixin):
+
+    def setUp(self):
+        Harness.setUp(self)
+        make_history(self)
+        self.this_year = datetime(self.past_year + 1, 1, 1)
+        self.this_year_utc = self.this_year.replace(tzinfo=utc)
+
+    def balances(self):
+        return self.db.all("SELECT participant, at, balance FROM balances_at ORDER BY at",
+                           back_as=tuple)
+
+    def test_backfill_closes_every_year(self):
+        closed = ledger.backfill(self.db)
+        assert closed == [self.this_year]
+        assert self.balances() == [(self.alice.id, self.this_year_utc, 10)]
+
+    def test_backfill_counts_payments(self):
+        self.make_participant('picard', claimed_time='now')
+        team = self.make_team(is_approved=True)
+        self.make_payment(self.alice, team, '3.00', 'to-team', None,
+                          datetime(self.past_year, 6, 1))
+        ledger.backfill(self.db)
+        assert self.balances() == [(self.alice.id, self.this_year_utc, 7)]
+
+    def test_backfill_can_go_monthly(self):
+        ledger.backfill(self.db, monthly=True)
+        assert self.db.one("SELECT count(*) FROM balances_at_closings") >= 12
+
+    def test_history_reads_closed_balances(self):
+        ledger.backfill(self.db)
+        self.db.run("UPDATE balances_at SET balance = 1234")
+        balance = get_end_of_year_balance(self.db, self.alice, self.past_year, datetime.now().year)
+        assert balance == 1234
+
+    def test_history_reads_missing_rows_for_closed_boundaries_as_zero(self):
+        ledger.backfill(self.db)
+        self.db.run("DELETE FROM balances_at")
+        balance = get_end_of_year_balance(self.db, self.alice, self.past_year, datetime.now().year)
+        assert balance == D('0.00')
+
+    def test_payday_closes_the_latest_boundary(self):
+        self.run_payday()
+        assert self.db.all("SELECT at FROM balances_at_closings") == [self.this_year_utc]
+        assert self.balances() == [(self.alice.id, self.this_year_utc, 10)]
+        self.run_payday()
+        assert self.db.one("SELECT count(*) FROM balances_at_closings") == 1
@@ -1,6 +1,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import os
+import tempfile
 
 import braintree
 import mock
@@ -8,6 +9,9 @@ import pytest
 
 from gratipay.billing.exchanges import create_card_hold, MINIMUM_CHARGE
 from gratipay.billing.payday import NoPayday, Payday
+from gratipay.billing.simulation import PaydayInProgress
+from gratipay.cli import payday as payday_cli
+from gratipay.email import decode_context
 from gratipay.exceptions import NegativeBalance
 from gratipay.models.participant import Participant
 from gratipay.testing import Foobar, D,P
@@ -304,6 +308,25 @@ class TestPayin(BillingHarness):
         assert self.start_payday().fetch_card_holds([]) == {}
 
 
+    @mock.patch('gratipay.billing.payday.cancel_card_hold')
+    @mock.patch('braintree.Transaction.search')
+    def test_fch_reuses_holds_it_needs_and_cancels_the_rest(self, search, cancel):
+        def hold(participant_id):
+            return braintree.Transaction(None, { 'amount': D('10.00')
+                                               , 'tax_amount': 0
+                                               , 'custom_fields': {'participant_id': participant_id}
+                                                })
+        keep, drop = hold(self.obama.id), [hold(i) for i in range(1000, 1100)]
+        search.return_value.items = iter([keep] + drop)
+
+        payday = self.start_payday()
+        payday.threads = 3
+        holds = payday.fetch_card_holds(set([self.obama.id]))
+
+        assert holds == {self.obama.id: keep}
+        assert sorted(c[0][0].custom_fields['participant_id'] for c in cancel.call_args_list) \
+            == list(range(1000, 1100))
+
     @mock.patch.object(Payday, 'fetch_card_holds')
     @mock.patch('gratipay.billing.payday.create_card_hold')
     def test_hold_amount_includes_negative_balance(self, cch, fch):
@@ -500,9 +523,209 @@ class TestPayin(BillingHarness):
                 self.start_payday().payin()
         filename = open_.call_args_list[-1][0][0]
         assert filename.endswith('_payments.csv')
+        assert os.path.dirname(filename) == tempfile.gettempdir()
         os.unlink(filename)
 
 
+class TestPayinCheckpoints(BillingHarness):
+
+    tearDownClass = None
+
+    def setUp(self):
+        super(TestPayinCheckpoints, self).setUp()
+        self.alice = self.make_participant('alice', claimed_time='now')
+        self.make_exchange('braintree-cc', 100, 0, self.alice)
+        picard = self.make_participant('picard', claimed_time='now', last_paypal_result='')
+        self.enterprise = self.make_team('The Enterprise', picard, is_approved=True)
+        self.alice.set_payment_instruction(self.enterprise, 80)
+
+    def get_payin_step(self):
+        return self.db.one("SELECT payin_step FROM paydays")
+
+    @mock.patch.object(Payday, 'fetch_card_holds')
+    def test_payin_records_each_step(self, fch):
+        fch.return_value = {}
+        self.start_payday().payin()
+        assert self.get_payin_step() == 'balances'
+
+    @mock.patch.object(Payday, 'fetch_card_holds')
+    def test_payin_resumes_at_the_step_that_failed(self, fch):
+        fch.return_value = {}
+        with mock.patch.object(Payday, 'process_takes') as process_takes:
+            process_takes.side_effect = Foobar
+            with self.assertRaises(Foobar):
+                self.start_payday().payin()
+        assert self.get_payin_step() == 'payment_instructions'
+        assert P('alice').balance == D('100.00')
+
+        with mock.patch.object(Payday, 'prepare') as prepare:
+            with mock.patch.object(Payday, 'process_payment_instructions') as ppi:
+                self.start_payday().payin()
+        assert not prepare.called
+        assert not ppi.called
+        assert self.get_payin_step() == 'balances'
+
+        assert P('alice').balance == D('20.00')
+        assert P('picard').balance == D('80.00')
+        assert self.db.all("SELECT amount, direction FROM payments ORDER BY id") == \
+               [(D('80.00'), 'to-team'), (D('80.00'), 'to-participant')]
+
+    @mock.patch.object(Payday, 'fetch_card_holds')
+    def test_payin_refetches_holds_when_resuming_before_settle(self, fch):
+        fch.return_value = {}
+        with mock.patch.object(Payday, 'process_remainder') as process_remainder:
+            process_remainder.side_effect = Foobar
+            with self.assertRaises(Foobar):
+                self.start_payday().payin()
+        self.db.run("UPDATE payday_participants SET card_hold_ok = true WHERE username='alice'")
+        fch.reset_mock()
+
+        self.start_payday().payin()
+        assert fch.call_args[0][0] == set([self.alice.id])
+
+    def test_payin_step_done(self):
+        payday = self.start_payday()
+        assert not payday.payin_step_done('prepare')
+        payday.payin_step = 'takes'
+        assert payday.payin_step_done('prepare')
+        assert payday.payin_step_done('takes')
+        assert not payday.payin_step_done('remainder')
+
+
+class TestSimulatedPayday(BillingHarness):
+
+    tearDownClass = None
+
+    def setUp(self):
+        super(TestSimulatedPayday, self).setUp()
+        alice = self.make_participant('alice', claimed_time='now')
+        self.make_exchange('braintree-cc', 100, 0, alice)
+        self.enterprise = self.make_team(owner=self.homer, is_approved=True)
+        alice.set_payment_instruction(self.enterprise, 80)
+        self.obama.set_payment_instruction(self.enterprise, 20)
+
+    @mock.patch('braintree.Transaction.search')
+    @mock.patch('braintree.Transaction.sale')
+    def test_simulation_reports_what_payday_would_do(self, sale, search):
+        report = self.app.payday_runner.simulate_payday()
+
+        assert [step for step, seconds in report['timings']] == \
+               ['prepare', 'holds', 'payment_instructions', 'takes', 'remainder', 'settle',
+                'balances', 'check_db']
+        counts = report['counts']
+        assert counts['ninstructions'] == counts['nfunded'] == 2
+        assert counts['nholds'] == counts['ncaptures'] == 1
+        assert counts['capture_volume'] == D('20.91')
+        assert counts['volume_to_teams'] == counts['volume_to_participants'] == D('100.00')
+        assert not sale.called
+        assert not search.called
+
+    def test_simulation_doesnt_leave_a_trace(self):
+        self.app.payday_runner.simulate_payday(set_based=True)
+        assert P('alice').balance == D('100.00')
+        assert P('homer').balance == 0
+        assert self.db.one("SELECT count(*) FROM paydays") == 0
+        assert self.db.one("SELECT count(*) FROM payments") == 0
+        assert self.db.one("SELECT count(*) FROM exchanges") == 1
+
+    def test_simulation_refuses_to_run_during_a_real_payday(self):
+        self.start_payday()
+        with self.assertRaises(PaydayInProgress):
+            self.app.payday_runner.simulate_payday()
+
+
+class TestSetBasedPayin(BillingHarness):
+
+    tearDownClass = None
+
+    def process(self, set_based):
+        """Run payin's money-moving steps with the given engine, capture the
+        results, and roll everything back.
+        """
+        payday = self.start_payday()
+        payday.set_based = set_based
+        out = {}
+        with self.assertRaises(Foobar):
+            with self.db.get_cursor() as cursor:
+                payday.prepare(cursor)
+                payday.process_payment_instructions(cursor)
+                payday.process_takes(cursor, payday.ts_start)
+                payday.process_remainder(cursor)
+                out['payments'] = cursor.all("SELECT participant, team, amount, direction "
+                                             "FROM payday_payments")
+                out['events'] = cursor.all("SELECT payload FROM events "
+                                           "WHERE type='payday' ORDER BY id")
+                out['balances'] = cursor.all("SELECT username, new_balance "
+                                             "FROM payday_participants ORDER BY id")
+                out['teams'] = cursor.all("SELECT slug, balance, available_today, is_drained "
+                                          "FROM payday_teams ORDER BY id")
+                out['dues'] = cursor.all("SELECT participant_id, team_id, due "
+                                         "FROM current_payment_instructions "
+                                         "ORDER BY participant_id, team_id")
+                raise Foobar
+        return out
+
+    def test_set_based_engine_matches_triggers(self):
+        alice = self.make_participant('alice', claimed_time='now', balance=100)
+        picard = self.make_participant('picard', claimed_time='now', last_paypal_result='',
+                                       verified_in='TT', email_address='picard@x.y')
+        shelby = self.make_participant('shelby', claimed_time='now', last_paypal_result='')
+        enterprise = self.make_team('The Enterprise', picard, is_approved=True, available=15)
+        trident = self.make_team('The Trident', shelby, is_approved=True)
+        for username in ('crusher', 'bruiser'):
+            member = self.make_participant(username, claimed_time='now', verified_in='TT',
+                                           email_address=username+'@x.y')
+            enterprise.add_member(member, picard)
+            enterprise.set_take_for(member, 10, member)
+
+        alice.set_payment_instruction(enterprise, 80)
+        alice.set_payment_instruction(trident, 40)  # doesn't fit, no card to park it on
+        alice.set_payment_instruction(enterprise, 65)
+        self.obama.set_payment_instruction(trident, '5.00')  # has a card, so it's parked
+
+        triggers = self.process(set_based=False)
+        set_based = self.process(set_based=True)
+
+        assert set_based == triggers
+        assert [e['action'] for e in set_based['events']] == ['due', 'pay']
+        assert [(p.participant, p.amount) for p in set_based['payments']] == \
+               [('alice', 65), ('crusher', 10), ('bruiser', 5), ('picard', 50)]
+
+    def test_set_based_payday_moves_money(self):
+        alice = self.make_participant('alice', claimed_time='now')
+        self.make_exchange('braintree-cc', 100, 0, alice)
+        picard = self.make_participant('picard', claimed_time='now', last_paypal_result='')
+        enterprise = self.make_team('The Enterprise', picard, is_approved=True)
+        alice.set_payment_instruction(enterprise, 80)
+
+        with mock.patch.dict(self.app.env.parsed, payday_set_based=True):
+            self.run_payday()
+
+        assert P('alice').balance == D('20.00')
+        assert P('picard').balance == D('80.00')
+        assert self.db.all("SELECT amount, direction FROM payments ORDER BY id") == \
+               [(D('80.00'), 'to-team'), (D('80.00'), 'to-participant')]
+
+    def test_set_based_engine_is_off_by_default(self):
+        assert self.start_payday().set_based is False
+
+    def test_set_based_engine_follows_the_environment(self):
+        with mock.patch.dict(self.app.env.parsed, payday_set_based=True):
+            assert self.start_payday().set_based is True
+
+    @mock.patch('gratipay.cli.payday.Application')
+    def test_payday_script_takes_set_based(self, Application):
+        runner = Application.return_value.payday_runner
+        payday_cli.main(['payday', '--set-based'])
+        runner.run_payday.assert_called_once_with(set_based=True)
+
+    @mock.patch('gratipay.cli.payday.Application')
+    def test_payday_script_leaves_the_engine_to_the_environment(self, Application):
+        runner = Application.return_value.payday_runner
+        payday_cli.main(['payday'])
+        runner.run_payday.assert_called_once_with(set_based=None)
+
+
 class TestTakes(BillingHarness):
 
     tearDownClass = None
@@ -637,3 +860,29 @@ class TestNotifyParticipants(SentEmailHarness, PaydayMixin):
             assert self.get_last_email()['to'] == 'kalel <kalel@example.net>'
             assert 'Gratiteam' in self.get_last_email()['body_text']
             assert 'Gratiteam' in self.get_last_email()['body_html']
+
+    def test_it_counts_teams_for_each_participant(self):
+        alice = self.make_participant('alice', claimed_time='now', email_address='alice@x.y',
+                                      notify_charge=3)
+        bob = self.make_participant('bob', claimed_time='now', email_address='bob@x.y',
+                                    notify_charge=3)
+        picard = self.make_participant('picard', claimed_time='now', last_paypal_result='')
+        enterprise = self.make_team('The Enterprise', picard, is_approved=True)
+        trident = self.make_team('The Trident', picard, is_approved=True)
+        alice.set_payment_instruction(enterprise, 10)
+        alice.set_payment_instruction(trident, 20)
+        bob.set_payment_instruction(enterprise, 10)
+
+        payday = self.start_payday()
+        self.make_exchange('braintree-cc', 30, 0, alice)
+        self.make_exchange('braintree-cc', 10, 0, bob, 'failed')
+        payday.end()
+        payday.notify_participants()
+
+        queued = self.db.all("SELECT participant, spt_name, context FROM email_queue "
+                             "ORDER BY participant")
+        contexts = [(p, spt, decode_context(c)) for p, spt, c in queued]
+        assert [(p, spt, c['nteams'], c['top_team']) for p, spt, c in contexts] == \
+               [ (alice.id, 'charge_succeeded', 2, 'TheTrident')
+               , (bob.id, 'charge_failed', 1, 'TheEnterprise')
+                ]
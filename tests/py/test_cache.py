@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+
+import mock
+import pytest
+
+from gratipay.testing import Harness
+from gratipay.utils.cache import ( MISSING, Cache, LocalMemcache, LRUBackend, MemcacheBackend
+                                 , SharedMemoryBackend, UnsafeCacheDirectory, make_backend
+                                  )
+from gratipay.utils.query_cache import Entry, FormattingError, QueryCache
+
+
+class BackendTests(object):
+
+    def test_gets_what_was_set(self):
+        self.backend.set('foo', {'bar': 1}, 60)
+        assert self.backend.get('foo') == {'bar': 1}
+
+    def test_misses_missing_keys(self):
+        assert self.backend.get('foo') is MISSING
+
+    def test_misses_expired_keys(self):
+        with mock.patch('time.time', return_value=1000):
+            self.backend.set('foo', 'bar', 60)
+        with mock.patch('time.time', return_value=1061):
+            assert self.backend.get('foo') is MISSING
+
+    def test_takes_tuple_keys(self):
+        self.backend.set(('query', 'SELECT 1', (2,)), 3, 60)
+        assert self.backend.get(('query', 'SELECT 1', (2,))) == 3
+
+    def test_deletes(self):
+        self.backend.set('foo', 'bar', 60)
+        self.backend.delete('foo')
+        self.backend.delete('foo')  # no-op
+        assert self.backend.get('foo') is MISSING
+
+    def test_clears(self):
+        self.backend.set('foo', 'bar', 60)
+        self.backend.clear()
+        assert self.backend.get('foo') is MISSING
+
+
+class TestLRUBackend(BackendTests, Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.backend = LRUBackend(max_entries=2)
+
+    def test_evicts_least_recently_used(self):
+        self.backend.set('a', 1, 60)
+        self.backend.set('b', 2, 60)
+        self.backend.get('a')
+        self.backend.set('c', 3, 60)
+        assert self.backend.get('b') is MISSING
+        assert self.backend.get('a') == 1
+        assert self.backend.evictions == 1
+        assert len(self.backend) == 2
+
+
+class TestSharedMemoryBackend(BackendTests, Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.path = tempfile.mkdtemp()
+        self.backend = SharedMemoryBackend(self.path, max_entries=2, check_every=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        Harness.tearDown(self)
+
+    def test_is_shared_between_instances(self):
+        self.backend.set('foo', 'bar', 60)
+        assert SharedMemoryBackend(self.path).get('foo') == 'bar'
+
+    def test_evicts_oldest_entries(self):
+        for i, key in enumerate('abc'):
+            with mock.patch('time.time', return_value=1000 + i):
+                self.backend.set(key, i, 3600)
+        assert len(self.backend) == 2
+        assert self.backend.evictions == 1
+
+    def test_clear_leaves_writes_in_flight_alone(self):
+        self.backend.set('foo', 'bar', 60)
+        in_flight = os.path.join(self.path, '.in-flight')
+        open(in_flight, 'w').close()
+        self.backend.clear()
+        assert len(self.backend) == 0
+        assert os.path.exists(in_flight)
+
+    def test_creates_its_directory_for_us_alone(self):
+        path = os.path.join(self.path, 'cache')
+        SharedMemoryBackend(path)
+        assert os.stat(path).st_mode & 0o777 == 0o700
+
+    def test_refuses_a_directory_others_can_write_to(self):
+        os.chmod(self.path, 0o777)
+        with pytest.raises(UnsafeCacheDirectory):
+            SharedMemoryBackend(self.path)
+
+    def test_refuses_a_directory_someone_else_owns(self):
+        with mock.patch('os.getuid', return_value=os.getuid() + 1):
+            with pytest.raises(UnsafeCacheDirectory):
+                SharedMemoryBackend(self.path)
+
+    def test_refuses_a_symlink(self):
+        link = os.path.join(self.path, 'link')
+        os.symlink(self.path, link)
+        with pytest.raises(UnsafeCacheDirectory):
+            SharedMemoryBackend(link)
+
+
+class TestMemcacheBackend(BackendTests, Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.backend = MemcacheBackend(LocalMemcache())
+
+    def test_copies_values(self):
+        value = ['bar']
+        self.backend.set('foo', value, 60)
+        self.backend.get('foo').append('baz')
+        assert self.backend.get('foo') == ['bar']
+
+    def test_rounds_ttls_up_to_a_second(self):
+        client = mock.Mock()
+        MemcacheBackend(client).set('foo', 'bar', 0.2)
+        assert client.set.call_args[1]['time'] == 1
+
+
+class TestCache(Harness):
+
+    def test_counts_hits_and_misses(self):
+        cache = Cache(LRUBackend())
+        cache.get('foo')
+        cache.set('foo', 'bar')
+        assert cache.get('foo') == 'bar'
+        assert cache.stats() == dict(hits=1, misses=1, evictions=0)
+
+    def test_get_or_set_computes_on_a_miss_only(self):
+        cache = Cache(LRUBackend())
+        compute = mock.Mock(return_value=42)
+        assert cache.get_or_set('foo', compute) == 42
+        assert cache.get_or_set('foo', compute) == 42
+        assert compute.call_count == 1
+
+    def test_make_backend_makes_backends(self):
+        assert isinstance(make_backend('lru'), LRUBackend)
+        assert isinstance(make_backend('memcache').client, LocalMemcache)
+        with pytest.raises(ValueError):
+            make_backend('floppy')
+
+
+class TestQueryCache(Harness):
+
+    def test_caches_query_results(self):
+        query_cache = QueryCache(self.db, threshold=60)
+        self.make_participant('alice')
+        assert query_cache.one("SELECT count(*) FROM participants", ()) == 1
+        self.make_participant('bob')
+        assert query_cache.one("SELECT count(*) FROM participants", ()) == 1
+        assert query_cache.stats()['hits'] == 1
+
+    def test_caches_exceptions(self):
+        query_cache = QueryCache(self.db, threshold=60)
+        process = mock.Mock(side_effect=ValueError)
+        for i in range(2):
+            with pytest.raises(FormattingError):
+                query_cache.one("SELECT 1", (), process)
+        assert process.call_count == 1
+
+    def test_can_share_a_cache(self):
+        cache = Cache(MemcacheBackend(LocalMemcache()))
+        assert QueryCache(self.db, cache=cache).all("SELECT 1", ()) == [1]
+        assert QueryCache(self.db, cache=cache).all("SELECT 1", ()) == [1]
+        assert cache.stats()['hits'] == 1
+
+
+class TestQueryCacheStampedes(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.db_ = mock.Mock()
+        self.query_cache = QueryCache(self.db_, threshold=5, stale_for=60)
+        self.spawned = []
+        self.query_cache._spawn = self.spawned.append
+
+    def one(self, now):
+        with mock.patch('time.time', return_value=now):
+            return self.query_cache.one("SELECT 1", ())
+
+    def test_serves_stale_results_while_refreshing_in_the_background(self):
+        self.db_.one.side_effect = [1, 2]
+        assert self.one(1000) == 1
+        assert self.one(1010) == 1
+        assert self.one(1010) == 1
+        assert len(self.spawned) == 1       # only one refresh at a time
+        with mock.patch('time.time', return_value=1010):
+            self.spawned[0]()
+        assert self.one(1011) == 2
+
+    def test_runs_the_query_when_entries_are_too_stale(self):
+        self.db_.one.side_effect = [1, 2]
+        assert self.one(1000) == 1
+        assert self.one(1066) == 2
+        assert self.spawned == []
+
+    def test_keeps_serving_stale_results_when_a_refresh_fails(self):
+        self.db_.one.side_effect = [1, ValueError]
+        assert self.one(1000) == 1
+        assert self.one(1010) == 1
+        with mock.patch('time.time', return_value=1010):
+            self.spawned[0]()
+        assert self.one(1011) == 1
+
+    def test_caches_negative_results_for_negative_ttl(self):
+        self.db_.one.side_effect = [None, None, 1]
+        assert self.one(1000) is None
+        assert self.one(1000.5) is None
+        assert self.one(1001.5) is None
+        assert self.one(1003) == 1
+        assert self.db_.one.call_count == 3
+
+    def test_negative_ttl_of_0_turns_off_negative_caching(self):
+        self.query_cache.negative_ttl = 0
+        self.db_.one.side_effect = [ValueError, 1]
+        with pytest.raises(FormattingError):
+            self.one(1000)
+        assert self.one(1000) == 1
+
+
+    # _should_refresh
+
+    def should_refresh(self, now, random, beta=1.0):
+        entry = Entry(result=1, exc=None, timestamp=1000, delta=1, ttl=5)
+        self.query_cache.beta = beta
+        with mock.patch('time.time', return_value=now), \
+             mock.patch('random.random', return_value=random):
+            return self.query_cache._should_refresh(entry)
+
+    def test_sr_refreshes_stale_entries(self):
+        assert self.should_refresh(1005, 0)
+
+    def test_sr_sometimes_refreshes_early(self):
+        assert not self.should_refresh(1004, 0.5)
+        assert self.should_refresh(1004, 0.9)
+
+    def test_sr_refreshes_earlier_for_a_higher_beta(self):
+        assert self.should_refresh(1004, 0.5, beta=2)
+
+    def test_sr_never_refreshes_early_for_a_beta_of_0(self):
+        assert not self.should_refresh(1004, 0.99999, beta=0)
@@ -4,6 +4,7 @@ import datetime
 import json
 
 import pytest
+from aspen.utils import utc
 from mock import patch
 
 from gratipay.billing.payday import Payday
@@ -171,3 +172,70 @@ class TestChartsJson(Harness):
         actual = json.loads(self.client.GET('/about/charts.json').body)[0]
 
         assert actual == expected
+
+
+class TestTeamChartsJson(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.alice = self.make_participant('alice', claimed_time='now')
+        self.bob = self.make_participant('bob', claimed_time='now')
+        self.make_participant('picard', claimed_time='now')
+        self.team = self.make_team(is_approved=True)
+        self.t0 = datetime.datetime(2016, 6, 2, 12, tzinfo=utc)
+
+    def make_payday(self, id, days):
+        ts_start = self.t0 + datetime.timedelta(days=days)
+        self.db.run( "INSERT INTO paydays (id, ts_start, ts_end) VALUES (%s, %s, %s)"
+                   , (id, ts_start, ts_start + datetime.timedelta(hours=1))
+                    )
+
+    def pay(self, participant, amount, days, payday=None):
+        timestamp = self.t0 + datetime.timedelta(days=days, minutes=1)
+        self.make_payment(participant, self.team, amount, 'to-team', payday, timestamp)
+
+    def update_team_stats(self, payday_id):
+        payday = Payday(self.app.payday_runner)
+        payday.id = payday_id
+        payday.update_team_stats()
+
+    def charts(self, **kw):
+        return self.client.GET('/TheEnterprise/charts.json', raise_immediately=False, **kw)
+
+
+    def test_never_received_gives_empty_array(self):
+        self.make_payday(199, 0)
+        self.update_team_stats(199)
+        assert json.loads(self.charts().body) == []
+
+    def test_reads_totals_per_payday(self):
+        self.make_payday(199, 0)
+        self.pay(self.alice, '1.00', 0, payday=199)
+        self.pay(self.bob, '3.00', 0, payday=199)
+        self.update_team_stats(199)
+        self.pay(self.alice, '0.50', 3)  # out of band, lands on #199
+        self.make_payday(200, 7)
+        self.pay(self.alice, '2.00', 7, payday=200)
+        self.update_team_stats(200)
+        assert json.loads(self.charts().body) == [
+            {"date": "2016-06-09", "xText": 155, "nreceiving_from": 1, "receipts": 2.0},
+            {"date": "2016-06-02", "xText": 154, "nreceiving_from": 3, "receipts": 4.5},
+        ]
+
+    def test_zero_fills_paydays_the_team_sat_out(self):
+        self.make_payday(199, 0)
+        self.make_payday(200, 7)
+        self.pay(self.alice, '2.00', 7, payday=200)
+        self.update_team_stats(200)
+        assert json.loads(self.charts().body)[1] == \
+            {"date": "2016-06-02", "xText": 154, "nreceiving_from": 0, "receipts": 0.0}
+
+    def test_serves_304_for_a_matching_etag(self):
+        self.make_payday(199, 0)
+        self.pay(self.alice, '1.00', 0, payday=199)
+        self.update_team_stats(199)
+        etag = self.charts().headers['ETag']
+        assert self.charts(HTTP_IF_NONE_MATCH=etag).code == 304
+        self.pay(self.bob, '1.00', 0, payday=199)
+        self.update_team_stats(199)
+        assert self.charts(HTTP_IF_NONE_MATCH=etag).code == 200
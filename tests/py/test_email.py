@@ -1,16 +1,21 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import json
+import pickle
 import sys
+from datetime import date, datetime
 
+import mock
 from pytest import raises
 
+from gratipay.email import decode_context, encode_context, reencode_pickled_contexts
 from gratipay.exceptions import CannotRemovePrimaryEmail, EmailTaken, EmailNotVerified
 from gratipay.exceptions import TooManyEmailAddresses, Throttled
-from gratipay.testing import P
+from gratipay.testing import D, P
 from gratipay.testing.email import QueuedEmailHarness, SentEmailHarness
-from gratipay.models.participant import email as _email
-from gratipay.utils import encode_for_querystring
+from gratipay.models.participant import Participant, email as _email
+from gratipay.utils import encode_for_querystring, i18n
+from gratipay.cli import bench_email_render as _bench_email_render
 from gratipay.cli import queue_branch_email as _queue_branch_email
 
 
@@ -285,6 +290,53 @@ class TestFunctions(Alice):
         self.app.email_queue.put(self.alice, "verification_notice")
 
 
+    def test_put_all_queues_a_batch(self):
+        bob = self.make_participant('bob', claimed_time='now')
+        n = self.app.email_queue.put_all([ (self.alice, 'verification', {'foo': 'bar'})
+                                         , (bob, 'branch', {})
+                                          ])
+        assert n == 2
+        queued = self.db.all("SELECT participant, spt_name FROM email_queue ORDER BY id")
+        assert queued == [(self.alice.id, 'verification'), (bob.id, 'branch')]
+
+    def test_put_all_drops_messages_over_the_throttling_limit(self):
+        bob = self.make_participant('bob', claimed_time='now')
+        self.app.email_queue.put(self.alice, "verification")
+        self.app.email_queue.put(self.alice, "verification")
+        n = self.app.email_queue.put_all([ (self.alice, 'branch', {})
+                                         , (self.alice, 'branch', {})
+                                         , (bob, 'branch', {})
+                                          ])
+        assert n == 2
+        assert self.db.one("SELECT count(*) FROM email_queue WHERE participant=%s",
+                           (self.alice.id,)) == 3
+
+    def test_put_all_doesnt_throttle_system_messages(self):
+        self.app.email_queue.put_all([(self.alice, 'branch', {})] * 5, _user_initiated=False)
+        assert self.count_email_messages() == 5
+
+
+    def test_put_many_queues_the_same_message_for_everyone(self):
+        bob = self.make_participant('bob', claimed_time='now')
+        n = self.app.email_queue.put_many([self.alice, bob], 'branch', include_unsubscribe=False)
+        assert n == 2
+        queued = self.db.all("SELECT participant, spt_name, context FROM email_queue ORDER BY id")
+        assert [(q.participant, q.spt_name) for q in queued] == \
+               [(self.alice.id, 'branch'), (bob.id, 'branch')]
+        assert queued[0].context == queued[1].context
+
+    def test_put_many_drops_messages_over_the_throttling_limit(self):
+        bob = self.make_participant('bob', claimed_time='now')
+        for i in range(3):
+            self.app.email_queue.put(self.alice, "verification")
+        assert self.app.email_queue.put_many([self.alice, bob], 'branch') == 1
+        assert self.db.one("SELECT participant FROM email_queue WHERE spt_name='branch'") == bob.id
+
+    def test_put_many_is_fine_with_no_participants(self):
+        assert self.app.email_queue.put_many([], 'branch') == 0
+        assert self.count_email_messages() == 0
+
+
 class FlushEmailQueue(SentEmailHarness):
 
     def put_message(self, email_address='larry@example.com'):
@@ -333,6 +385,122 @@ class FlushEmailQueue(SentEmailHarness):
         assert self.count_email_messages() == 0  # nothing sent
         assert self.db.one("SELECT dead FROM email_queue")
 
+    def test_flushes_batches_with_many_threads(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        for i in range(7):
+            self.app.email_queue.put(larry, "verification", _user_initiated=False)
+        self.app.email_queue.threads = 3
+        assert self.app.email_queue.flush(batch_size=2) == 7
+        assert self.count_email_messages() == 7
+        assert self.db.one("SELECT count(*) FROM email_queue") == 0
+
+    def test_one_failure_doesnt_stop_the_rest_of_the_batch(self):
+        self.put_message()
+        self.make_participant('moe', email_address='moe@example.com')
+        self.app.email_queue.put(P('moe'), "verification")
+        class SomeProblem(Exception): pass
+        def send_email(**message):
+            if 'larry' in message['Destination']['ToAddresses'][0]:
+                raise SomeProblem()
+        self.mailer.side_effect = send_email
+
+        raises(SomeProblem, self.app.email_queue.flush)
+        assert self.count_email_messages() == 2  # both tried
+        assert self.db.all("SELECT participant FROM email_queue WHERE dead") == [P('larry').id]
+        assert self.db.one("SELECT count(*) FROM email_queue") == 1
+
+    def test_messages_claimed_by_another_flusher_are_skipped(self):
+        self.put_message()
+        with self.db.get_cursor() as cursor:
+            assert len(self.app.email_queue._claim(cursor, 60)) == 1
+            assert self.app.email_queue.flush() == 0
+        assert self.count_email_messages() == 0
+        assert self.app.email_queue.flush() == 1
+
+    def test_flush_loads_recipients_for_the_whole_batch(self):
+        self.put_message()
+        self.app.email_queue.put(P('larry'), "verification")
+        with mock.patch.object(Participant, 'from_id') as from_id:
+            assert self.app.email_queue.flush() == 2
+        assert not from_id.called
+
+    def test_flush_reuses_helpers_and_base_renderings(self):
+        queue = self.app.email_queue
+        queue.clear_render_caches()
+        self.put_message()
+        self.make_participant('moe', email_address='moe@example.com', email_lang='fr')
+        queue.put(P('moe'), "verification")
+        queue.put(P('moe'), "verification")
+        assert queue.flush() == 3
+        assert len(queue._helpers) == 4          # (en, fr) x (text, html)
+        assert len(queue._rendered_base) == 4    # (en, fr) x (text, html)
+
+    def test_cached_renderings_match_fresh_ones(self):
+        queue = self.app.email_queue
+        self.put_message()
+        rec = self.db.one("SELECT * FROM email_queue")
+        queue.clear_render_caches()
+        fresh = queue._prepare_email_message_for_ses(rec)
+        assert queue._prepare_email_message_for_ses(rec) == fresh
+
+    def test_ngettext_tells_sentry_about_the_message_being_rendered(self):
+        queue = self.app.email_queue
+        context = {'email': 'alice@example.com'}
+        queue._add_helpers(context, i18n.LOCALE_EN, html=False)
+        broken = mock.Mock(string=())
+        with mock.patch.object(i18n.LOCALE_EN.catalog, 'get', return_value=broken), \
+             mock.patch.object(queue, 'tell_sentry') as tell_sentry:
+            assert context['ngettext']('{n} thing', '{n} things', 2) == '2 things'
+        assert tell_sentry.call_args[0][1] is context
+
+    def test_bench_email_render_reports_messages_per_second(self):
+        self.put_message()
+        self.app.email_queue.put(P('larry'), "verification")
+        output = []
+        _bench_email_render.main(['', '--cold'], output.append, self.app)
+        assert output[0].startswith('Rendered 2 messages in ')
+        assert output[0].endswith(' messages/sec).')
+        assert self.count_email_messages() == 0  # nothing sent
+
+
+class TestContexts(QueuedEmailHarness):
+
+    def roundtrip(self, context):
+        return decode_context(self.db.one("SELECT %s::bytea", (encode_context(context),)))
+
+    def test_contexts_roundtrip_through_the_database(self):
+        context = { 'name': '\u00dcnicode', 'n': 3, 'ok': True, 'nothing': None
+                  , 'exchange': {'amount': D('9.41'), 'fee': D('0.59')}
+                  , 'when': datetime(2016, 11, 3, 12, 30, 5)
+                  , 'day': date(2016, 11, 3)
+                  , 'teams': ['TheEnterprise', 'TheTrident']
+                   }
+        assert self.roundtrip(context) == context
+
+    def test_decimals_stay_decimals(self):
+        assert type(self.roundtrip({'amount': D('1.00')})['amount']) is type(D('1.00'))
+
+    def test_unknown_types_are_refused(self):
+        raises(TypeError, encode_context, {'participant': object()})
+
+    def test_contexts_are_versioned(self):
+        assert self.db.one("SELECT get_byte(%s::bytea, 0)", (encode_context({}),)) == 1
+
+    def test_pickled_contexts_still_decode(self):
+        assert decode_context(pickle.dumps({'amount': D('1.00')})) == {'amount': D('1.00')}
+
+    def test_reencode_converts_pickled_contexts(self):
+        alice = self.make_participant('alice', email_address='alice@example.com')
+        self.app.email_queue.put(alice, 'verification', link='https://example.com/')
+        self.db.run( "UPDATE email_queue SET context=%s::bytea"
+                   , (pickle.dumps({'link': 'https://example.com/'}),)
+                    )
+        assert reencode_pickled_contexts(self.db) == 1
+        assert reencode_pickled_contexts(self.db) == 0
+        context = self.db.one("SELECT context FROM email_queue")
+        assert bytes(context)[:1] == b'\x01'
+        assert decode_context(context) == {'link': 'https://example.com/'}
+
 
 class TestGetRecentlyActiveParticipants(QueuedEmailHarness):
 
@@ -384,10 +552,20 @@ class TestQueueBranchEmail(QueuedEmailHarness):
     def test_is_fine_with_no_participants(self):
         retcode, output, errors = self.queue_branch_email('all')
         assert retcode == 0
-        assert output == ['Okay, you asked for it!', '0']
+        assert output == ['Okay, you asked for it!', '0', 'Queued 0 of 0.']
         assert errors == []
         assert self.count_email_messages() == 0
 
+    def test_logs_nothing_if_queuing_fails(self):
+        self.make_participant_with_exchange('alice')
+        printed = []
+        _print = lambda string, file=None: printed.append((str(string), file))
+        with mock.patch.object(self.app.email_queue, '_insert', side_effect=ZeroDivisionError):
+            with raises(ZeroDivisionError):
+                _queue_branch_email.main(['', 'all'], lambda prompt: 'y', _print, self.app)
+        assert [string for string, file in printed if file is sys.stderr] == []
+        assert self.count_email_messages() == 0
+
     def test_queues_for_one_participant(self):
         alice = self.make_participant_with_exchange('alice')
         retcode, output, errors = self.queue_branch_email('all')
@@ -395,8 +573,9 @@ class TestQueueBranchEmail(QueuedEmailHarness):
         assert output == [ 'Okay, you asked for it!'
                          , '1'
                          , 'spotcheck: alice@example.com (alice={})'.format(alice.id)
+                         , 'Queued 1 of 1.'
                           ]
-        assert errors == ['   1 queuing for alice@example.com (alice={})'.format(alice.id)]
+        assert errors == ['   1 queued for alice@example.com (alice={})'.format(alice.id)]
         assert self.count_email_messages() == 1
 
     def test_queues_for_two_participants(self):
@@ -405,8 +584,9 @@ class TestQueueBranchEmail(QueuedEmailHarness):
         retcode, output, errors = self.queue_branch_email('all')
         assert retcode == 0
         assert output[:2] == ['Okay, you asked for it!', '2']
-        assert errors == [ '   1 queuing for alice@example.com (alice={})'.format(alice.id)
-                         , '   2 queuing for bob@example.com (bob={})'.format(bob.id)
+        assert output[-1] == 'Queued 2 of 2.'
+        assert errors == [ '   1 queued for alice@example.com (alice={})'.format(alice.id)
+                         , '   2 queued for bob@example.com (bob={})'.format(bob.id)
                           ]
         assert self.count_email_messages() == 2
 
@@ -418,8 +598,9 @@ class TestQueueBranchEmail(QueuedEmailHarness):
         assert output == [ 'Okay, just bob.'
                          , '1'
                          , 'spotcheck: bob@example.com (bob={})'.format(bob.id)
+                         , 'Queued 1 of 1.'
                           ]
-        assert errors == ['   1 queuing for bob@example.com (bob={})'.format(bob.id)]
+        assert errors == ['   1 queued for bob@example.com (bob={})'.format(bob.id)]
         assert self.count_email_messages() == 1
 
     def test_bails_if_told_to(self):
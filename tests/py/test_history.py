@@ -1,6 +1,6 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from datetime import datetime
+from datetime import date, datetime
 import json
 
 from mock import patch
@@ -8,7 +8,7 @@ from mock import patch
 from gratipay.billing.payday import Payday
 from gratipay.testing import Harness, D,P
 from gratipay.testing.billing import BillingHarness
-from gratipay.utils.history import get_end_of_year_balance, iter_payday_events
+from gratipay.utils.history import _iter_rows, get_end_of_year_balance, iter_payday_events
 
 
 def make_history(harness):
@@ -114,6 +114,49 @@ class TestHistory(BillingHarness):
         assert events[4]['kind'] == 'day-close'
         assert events[4]['balance'] == 0
 
+    def test_iter_payday_events_splits_years_at_midnight_on_new_years(self):
+        alice = self.make_participant('alice', claimed_time=datetime(2010, 6, 1))
+        self.make_exchange('braintree-cc', 50, 0, alice)
+        self.make_exchange('braintree-cc', 20, 0, alice)
+        self.db.run("UPDATE exchanges SET timestamp = %s WHERE amount = 50",
+                    (datetime(2014, 12, 31, 23, 59, 59),))
+        self.db.run("UPDATE exchanges SET timestamp = %s WHERE amount = 20",
+                    (datetime(2015, 1, 1),))
+        events = [e for e in iter_payday_events(self.db, alice, 2014) if e['kind'] == 'charge']
+        assert [e['amount'] for e in events] == [50]
+        events = [e for e in iter_payday_events(self.db, alice, 2015) if e['kind'] == 'charge']
+        assert [e['amount'] for e in events] == [20]
+
+    def test_iter_payday_events_pages_by_day(self):
+        alice = self.make_participant('alice', claimed_time=datetime(2010, 6, 1))
+        for amount, timestamp in [ (10, datetime(2014, 3, 1, 12))
+                                 , (20, datetime(2014, 3, 2, 11))
+                                 , (30, datetime(2014, 3, 2, 12))
+                                 , (40, datetime(2014, 3, 3, 12))
+                                  ]:
+            e_id = self.make_exchange('braintree-cc', amount, 0, alice)
+            self.db.run("UPDATE exchanges SET timestamp=%s WHERE id=%s", (timestamp, e_id))
+
+        def page(before=None):
+            events = list(iter_payday_events(self.db, alice, 2014, before, limit=2))
+            charges = [(e['amount'], e['balance']) for e in events if e['kind'] == 'charge']
+            nexts = [e['before'] for e in events if e['kind'] == 'next-page']
+            return charges, nexts and nexts[0], events[-2 if nexts else -1]['balance']
+
+        assert page() == ([(40, 100)], date(2014, 3, 3), 60)
+        assert page(date(2014, 3, 3)) == ([(30, 60), (20, 30)], date(2014, 3, 2), 10)
+        assert page(date(2014, 3, 2)) == ([(10, 10)], [], 0)
+
+    def test_iter_payday_events_gets_whole_days(self):
+        alice = self.make_participant('alice', claimed_time=datetime(2010, 6, 1))
+        for amount in (10, 20, 30):
+            e_id = self.make_exchange('braintree-cc', amount, 0, alice)
+            self.db.run("UPDATE exchanges SET timestamp=%s WHERE id=%s",
+                        (datetime(2014, 3, 1, amount // 10), e_id))
+        events = list(iter_payday_events(self.db, alice, 2014, limit=2))
+        assert [e['amount'] for e in events if e['kind'] == 'charge'] == [30, 20, 10]
+        assert events[-1] == dict(kind='next-page', before=date(2014, 3, 1))
+
     def test_get_end_of_year_balance(self):
         make_history(self)
         balance = get_end_of_year_balance(self.db, self.alice, self.past_year, datetime.now().year)
@@ -137,6 +180,10 @@ class TestHistoryPage(Harness):
         response = self.client.GET('/~alice/history/?year=%s' % self.past_year, auth_as='bob')
         assert "automatic charge" in response.body
 
+    def test_bad_before_is_400(self):
+        r = self.client.GxT('/~alice/history/?before=yesterday', auth_as='alice')
+        assert r.code == 400
+
 class TestExport(Harness):
 
     def setUp(self):
@@ -155,6 +202,69 @@ class TestExport(Harness):
         r = self.client.GET('/~alice/history/export.json?year=%s' % self.past_year, auth_as='alice')
         assert len(json.loads(r.body)['exchanges']) == 4
 
+    def test_export_json_bad_year(self):
+        r = self.client.GxT('/~alice/history/export.json?year=0', auth_as='alice')
+        assert r.code == 400
+
     def test_export_csv(self):
         r = self.client.GET('/~alice/history/export.csv?key=exchanges', auth_as='alice')
         assert r.body.count('\n') == 5
+
+    def test_export_json_year_range(self):
+        path = '/~alice/history/export.json?year=%s-%s' % (self.past_year, self.past_year + 1)
+        r = self.client.GET(path, auth_as='alice')
+        assert len(json.loads(r.body)['exchanges']) == 8
+
+
+class TestStreamingExport(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        make_history(self)
+
+    def stream(self, path):
+        r = self.client.GET(path, auth_as='alice', raise_immediately=False)
+        assert r.code == 200
+        return b''.join(r.body)
+
+    def test_streams_the_same_csv(self):
+        path = '/~alice/history/export.csv?key=exchanges'
+        assert self.stream(path + '&stream=yes') == self.client.GET(path, auth_as='alice').body
+
+    def test_streams_json(self):
+        path = '/~alice/history/export.json?year=%s' % self.past_year
+        expected = json.loads(self.client.GET(path, auth_as='alice').body)
+        assert json.loads(self.stream(path + '&stream=yes')) == expected
+
+    def test_streams_json_for_a_key(self):
+        body = self.stream('/~alice/history/export.json?key=exchanges&stream=yes')
+        assert len(json.loads(body)) == 4
+
+    def test_streams_a_year_range(self):
+        path = '/~alice/history/export.csv?key=exchanges&stream=yes&year=%s-%s'
+        body = self.stream(path % (self.past_year, self.past_year + 1))
+        assert body.count('\n') == 9
+
+    def test_streams_in_chunks(self):
+        with patch('gratipay.utils.history.STREAM_CHUNK_SIZE', 1):
+            r = self.client.GET( '/~alice/history/export.csv?key=exchanges&stream=yes'
+                               , auth_as='alice'
+                               , raise_immediately=False
+                                )
+            chunks = list(r.body)
+        assert len(chunks) == 5
+
+    def test_streams_from_a_connection_outside_the_pool_with_timeouts(self):
+        sql = "SELECT current_setting('statement_timeout') AS timeout, %(n)s AS n"
+        with patch.object(self.db, 'get_connection') as get_connection:
+            rows = list(_iter_rows(self.db, sql, dict(n=1)))
+        assert not get_connection.called
+        assert [tuple(row) for row in rows] == [('1min', 1)]
+
+    def test_streaming_csv_needs_a_key(self):
+        r = self.client.GxT('/~alice/history/export.csv?stream=yes', auth_as='alice')
+        assert r.code == 400
+
+    def test_streaming_with_a_bad_key_is_400(self):
+        r = self.client.GxT('/~alice/history/export.json?stream=yes&key=foo', auth_as='alice')
+        assert r.code == 400
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+
+from gratipay.models.package import NPM, Package, escape_like
+from gratipay.testing import Harness
+
+
+class TestPackage(Harness):
+
+    def make_package(self, name, description=''):
+        self.db.run("INSERT INTO packages (package_manager, name, description, emails) "
+                    "VALUES ('npm', %s, %s, ARRAY[]::text[])", (name, description))
+        return Package.from_names(NPM, name)
+
+    def search(self, query, **kw):
+        return [p.name for p in Package.search(query, **kw)]
+
+
+    def test_from_names_finds_a_package(self):
+        foo = self.make_package('foo')
+        assert Package.from_names(NPM, 'foo') == foo
+
+    def test_from_names_returns_None_for_missing_packages(self):
+        assert Package.from_names(NPM, 'foo') is None
+
+    def test_escape_like_escapes_wildcards(self):
+        assert escape_like(r'a_b%c\d') == r'a\_b\%c\\d'
+
+
+    # search
+
+    def test_search_finds_by_prefix(self):
+        self.make_package('express')
+        self.make_package('express-session')
+        self.make_package('koa')
+        assert self.search('expr') == ['express', 'express-session']
+
+    def test_search_puts_exact_matches_first(self):
+        self.make_package('react-dom')
+        self.make_package('react')
+        self.make_package('preact')
+        assert self.search('react')[:2] == ['react', 'react-dom']
+
+    def test_search_is_fuzzy_on_names(self):
+        self.make_package('lodash')
+        assert self.search('lodahs') == ['lodash']
+
+    def test_search_finds_by_description(self):
+        self.make_package('left-pad', 'String left pad')
+        self.make_package('koa', 'Koa web app framework')
+        assert self.search('left pad') == ['left-pad']
+        assert self.search('WEB APP') == ['koa']
+
+    def test_search_only_matches_name_prefixes_for_short_queries(self):
+        self.make_package('foo')
+        self.make_package('Fob')
+        self.make_package('of', 'Has fo in it')
+        assert self.search('FO') == ['Fob', 'foo']
+
+    def test_search_returns_nothing_for_blank_queries(self):
+        self.make_package('foo')
+        assert self.search('  ') == []
+
+    def test_search_respects_limit(self):
+        for i in range(5):
+            self.make_package('foo-{}'.format(i))
+        assert self.search('foo', limit=2) == ['foo-0', 'foo-1']
+
+
+    # search.json
+
+    def test_search_json_returns_packages(self):
+        self.make_package('foo', 'Foo!')
+        response = self.client.GET('/on/npm/search.json?q=fo')
+        assert json.loads(response.body) == [{ 'package_manager': 'npm'
+                                              , 'name': 'foo'
+                                              , 'description': 'Foo!'
+                                              , 'url': 'https://npmjs.com/package/foo'
+                                               }]
+
+    def test_search_json_without_query_is_400(self):
+        assert self.client.GxT('/on/npm/search.json').code == 400
+
+    def test_search_json_with_bad_limit_is_400(self):
+        assert self.client.GxT('/on/npm/search.json?q=foo&limit=1000').code == 400
+        assert self.client.GxT('/on/npm/search.json?q=foo&limit=lots').code == 400
@@ -1,11 +1,15 @@
 from __future__ import print_function, unicode_literals
 
 import datetime
+import threading
+import time
 
+import mock
 import pytest
 
 from gratipay import fake_data
 from gratipay.testing import Harness, D
+from gratipay.testing.billing import PaydayMixin
 
 
 class DateTime(datetime.datetime): pass
@@ -84,3 +88,36 @@ class TestHtml(Harness):
         fake_data.populate_db(self.db, 5, 5, 1)
         response = self.client.GET('/about/stats')
         assert response.code == 200
+
+
+class TestPaydayCache(Harness, PaydayMixin):
+
+    def test_caches_until_a_payday_ends(self):
+        compute = mock.Mock(side_effect=[1, 2])
+        get = lambda: self.app.payday_cache.get('foo', compute)
+        assert get() == 1
+        assert get() == 1
+        self.run_payday()
+        assert get() == 2
+
+    def test_computes_once_for_concurrent_misses(self):
+        def compute():
+            time.sleep(0.1)
+            return 1
+        compute = mock.Mock(side_effect=compute)
+        threads = [threading.Thread(target=self.app.payday_cache.get, args=('foo', compute))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert compute.call_count == 1
+
+    def test_about_stats_are_cached_between_paydays(self):
+        alice = self.make_participant('alice', claimed_time='now')
+        self.make_exchange('braintree-cc', 10, 0, alice)
+        assert '$10.00' in self.client.GET('/about/stats').body
+        self.make_exchange('braintree-cc', 10, 0, alice)
+        assert '$10.00' in self.client.GET('/about/stats').body
+        self.run_payday()
+        assert '$20.00' in self.client.GET('/about/stats').body
@@ -1,23 +1,55 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import json
+from collections import OrderedDict
+from io import BytesIO
 from subprocess import Popen, PIPE
+from tempfile import NamedTemporaryFile
 
+import mock
 import pytest
 
 from gratipay import sync_npm
+from gratipay.sync_npm import bench, changes, run, upsert
+from gratipay.sync_npm.serialize import (
+    encode_text_array, iter_raw_packages, serialize_chunk, serialize_in_parallel,
+)
 from gratipay.testing import Harness
 
 
-def load(raw):
-    serialized = Popen( ('env/bin/sync-npm', 'serialize', '/dev/stdin')
+def load(raw, *args):
+    serialized = Popen( ('env/bin/sync-npm', 'serialize', '/dev/stdin') + args
                       , stdin=PIPE, stdout=PIPE
                        ).communicate(raw)[0]
-    Popen( ('env/bin/sync-npm', 'upsert', '/dev/stdin')
+    Popen( ('env/bin/sync-npm', 'upsert', '/dev/stdin') + args
          , stdin=PIPE, stdout=PIPE
           ).communicate(serialized)[0]
 
 
+def feed(*changes):
+    fp = NamedTemporaryFile()
+    for change in changes:
+        fp.write(json.dumps(change) + b'\n')
+    fp.write(b'\n')  # heartbeat
+    fp.write(json.dumps({'last_seq': changes[-1]['seq'] if changes else 0}) + b'\n')
+    fp.flush()
+    return fp
+
+
+def change(seq, name, description='', emails=(), deleted=False):
+    out = {'seq': seq, 'id': name, 'changes': [{'rev': '1-abc'}]}
+    if deleted:
+        out['deleted'] = True
+    else:
+        out['doc'] = { '_id': name
+                     , 'name': name
+                     , 'description': description
+                     , 'maintainers': [{'email': email} for email in emails]
+                      }
+    return out
+
+
 class FailCollector:
 
     def __init__(self):
@@ -97,6 +129,291 @@ class Tests(Harness):
         assert package.emails == []
 
 
+    def test_sn_in_parallel_handles_quoting(self):
+        load(br'''
+        { "_updated": 1234567890
+        , "testi\\\"ng-pa\\\"ckage":
+            { "name":"testi\\\"ng-pa\\\"ckage"
+            , "description":"A package for \"testing\""
+            , "maintainers":[{"email":"alice@\"example\".com"}]
+            , "author": {"email":"\\\\\"bob\\\\\"@example.com"}
+            , "time":{"modified":"2015-09-12T03:03:03.135Z"}
+             }
+        , "empty-description":
+            { "name":"empty-description"
+            , "description":""
+             }
+         }
+        ''', '--jobs', '2')
+
+        packages = self.db.all('select * from packages order by name')
+        assert [p.name for p in packages] == ['empty-description', r'testi\"ng-pa\"ckage']
+        assert packages[0].description == ''
+        assert packages[0].emails == []
+        assert packages[1].description == 'A package for "testing"'
+        assert packages[1].emails == ['alice@"example".com', r'\\"bob\\"@example.com']
+
+
+    def test_sn_in_binary_handles_quoting(self):
+        load(br'''
+        { "_updated": 1234567890
+        , "testi\\\"ng-pa\\\"ckage":
+            { "name":"testi\\\"ng-pa\\\"ckage"
+            , "description":"A package for \"testing\" \u00e9"
+            , "maintainers":[{"email":"alice@\"example\".com"}]
+            , "author": {"email":"\\\\\"bob\\\\\"@example.com"}
+             }
+        , "empty-description": { "description":"" }
+         }
+        ''', '--binary', '--jobs', '2')
+
+        packages = self.db.all('select * from packages order by name')
+        assert [p.name for p in packages] == ['empty-description', r'testi\"ng-pa\"ckage']
+        assert packages[0].description == ''
+        assert packages[0].emails == []
+        assert packages[1].description == 'A package for "testing" \u00e9'
+        assert packages[1].emails == ['alice@"example".com', r'\\"bob\\"@example.com']
+
+
+    # encode_text_array
+
+    def test_eta_encodes_empty_arrays(self):
+        assert encode_text_array([]) == b'\0\0\0\0' b'\0\0\0\0' b'\0\0\0\x19'
+
+    def test_eta_encodes_arrays(self):
+        assert encode_text_array([b'ab', b'c']) == ( b'\0\0\0\x01' b'\0\0\0\0' b'\0\0\0\x19'
+                                                   b'\0\0\0\x02' b'\0\0\0\x01'
+                                                   b'\0\0\0\x02ab' b'\0\0\0\x01c'
+                                                    )
+
+
+    # iter_raw_packages
+
+    def test_irp_finds_package_boundaries_across_reads(self):
+        raw = br'''{"_updated": 1, "a": {"description": "{[\",:]}"}, "b": [], "c": {"x": {}}}'''
+        expected = [ ('_updated', b'1')
+                   , ('a', br'{"description": "{[\",:]}"}')
+                   , ('b', b'[]')
+                   , ('c', b'{"x": {}}')
+                    ]
+        for read_size in (1, 2, 3, 5, 1024):
+            assert list(iter_raw_packages(BytesIO(raw), read_size)) == expected
+
+    def test_irp_handles_escapes_in_keys_and_values(self):
+        raw = br'''{"caf\u00e9": {"a\\": "b\\", "c": ["}\\\""]}, "d": "\\"}'''
+        expected = [ ('caf\xe9', br'{"a\\": "b\\", "c": ["}\\\""]}')
+                   , ('d', br'"\\"')
+                    ]
+        for read_size in (1, 4, 1024):
+            assert list(iter_raw_packages(BytesIO(raw), read_size)) == expected
+
+    def test_irp_chokes_on_unterminated_strings(self):
+        with pytest.raises(ValueError):
+            list(iter_raw_packages(BytesIO(b'{"a": {"description": "oops')))
+
+
+    # serialize_chunk
+
+    def test_sc_keeps_emails_in_document_order(self):
+        raw = br'''{ "author": {"email": "bob@example.com"}
+                   , "maintainers": [{"email": "alice@example.com"}, {"name": "carl"}]
+                   , "description": null
+                    }'''
+        assert serialize_chunk([('foo', raw)]) == \
+               (b'npm,foo,,"{""bob@example.com"", ""alice@example.com""}"\r\n', 1)
+
+
+    # serialize_in_parallel
+
+    def serialize_in_parallel(self, dump, range_size):
+        with NamedTemporaryFile() as fp:
+            fp.write(dump)
+            fp.flush()
+            chunks = list(serialize_in_parallel(fp.name, 2, range_size=range_size))
+            return b''.join(csv for csv, n in chunks), sum(n for csv, n in chunks)
+
+    def test_sip_matches_serial_output_however_the_dump_is_laid_out(self):
+        fp = BytesIO()
+        bench.generate(fp, 50)
+        one_per_line = fp.getvalue()
+        decoded = json.loads(one_per_line, object_pairs_hook=OrderedDict)
+        pretty = json.dumps(decoded, indent=2)
+        one_line = json.dumps(decoded)
+        expected = serialize_chunk([(k, json.dumps(v)) for k, v in decoded.items() if k[0] != '_'])
+
+        for dump in (one_per_line, pretty, one_line):
+            for range_size in (37, 1000, 10**6):
+                csv, n = self.serialize_in_parallel(dump, range_size)
+                assert (csv, n) == expected
+
+    def test_sip_chokes_on_truncated_dumps(self):
+        fp = BytesIO()
+        bench.generate(fp, 5)
+        with pytest.raises(ValueError):
+            self.serialize_in_parallel(fp.getvalue()[:-10], 100)
+
+
+    # bench.generate
+
+    def test_generate_generates_a_parseable_dump(self):
+        fp = BytesIO()
+        bench.generate(fp, 50)
+        fp.seek(0)
+        dump = json.load(fp)
+        assert len(dump) == 51
+        fp.seek(0)
+        assert len(list(iter_raw_packages(fp))) == 51
+
+
+    # upsert.load
+
+    def load_csv(self, csv, prune=False):
+        with self.db.get_cursor() as cursor:
+            return upsert.load(cursor, BytesIO(csv), prune)
+
+    def test_upsert_reports_counts(self):
+        self.load_csv(b'npm,foo,Foo!,{}\nnpm,bar,Bar?,{}\n')
+        counts = self.load_csv(b'npm,foo,Foo!,{}\nnpm,bar,Bar!,{}\nnpm,baz,Baz.,{}\n')
+        assert counts == dict(ninserted=1, nupdated=1, nunchanged=1, ndeleted=0)
+
+    def test_upsert_leaves_unchanged_rows_alone(self):
+        self.load_csv(b'npm,foo,Foo!,{alice@example.com}\nnpm,bar,Bar?,{}\n')
+        xmins = lambda: dict(self.db.all("SELECT name, xmin::text FROM packages"))
+        before = xmins()
+        self.load_csv(b'npm,foo,Foo!,{alice@example.com}\nnpm,bar,Bar?,{bob@example.com}\n')
+        after = xmins()
+        assert after['foo'] == before['foo']
+        assert after['bar'] != before['bar']
+        assert self.db.one("SELECT emails FROM packages WHERE name='bar'") == ['bob@example.com']
+
+    def test_upsert_keeps_the_last_of_duplicate_packages(self):
+        self.load_csv(b'npm,foo,Foo!,{}\n')
+        counts = self.load_csv(b'npm,foo,Foo?,{}\nnpm,bar,Bar?,{}\nnpm,foo,Foo.,{}\nnpm,bar,Bar!,{}\n')
+        assert counts == dict(ninserted=1, nupdated=1, nunchanged=0, ndeleted=0)
+        packages = self.db.all('select name, description from packages order by name')
+        assert [tuple(p) for p in packages] == [('bar', 'Bar!'), ('foo', 'Foo.')]
+
+    def test_upsert_only_prunes_when_asked(self):
+        self.load_csv(b'npm,foo,Foo!,{}\nnpm,bar,Bar?,{}\n')
+        assert self.load_csv(b'npm,foo,Foo!,{}\n')['ndeleted'] == 0
+        assert self.load_csv(b'npm,foo,Foo!,{}\n', prune=True)['ndeleted'] == 1
+        assert self.db.all('select name from packages') == ['foo']
+
+
+    # run
+
+    def run_sync(self, raw, jobs=0, binary=False, prune=False):
+        class env: require_yajl = False
+        class args: pass
+        with NamedTemporaryFile() as fp:
+            fp.write(raw)
+            fp.flush()
+            args.path, args.jobs, args.binary, args.prune = fp.name, jobs, binary, prune
+            return run.run(env, args, self.db, merge_size=1)
+
+    RAW = br'''{ "_updated": 1234567890
+               , "alpha": {"description": "Alpha", "maintainers": [{"email": "a@example.com"}]}
+               , "beta": {"description": "Beta"}
+               , "gamma": {"description": "Gamma"}
+                }'''
+
+    @mock.patch('gratipay.sync_npm.run.CHUNK_SIZE', 1)
+    @mock.patch('gratipay.sync_npm.serialize.CHUNK_SIZE', 1)
+    def test_run_serializes_and_merges(self):
+        assert self.run_sync(self.RAW) == dict(ninserted=3, nupdated=0, nunchanged=0, ndeleted=0)
+        packages = self.db.all('select name, description, emails from packages order by name')
+        assert [tuple(p) for p in packages] == [ ('alpha', 'Alpha', ['a@example.com'])
+                                               , ('beta', 'Beta', [])
+                                               , ('gamma', 'Gamma', [])
+                                                ]
+        assert self.run_sync(self.RAW, jobs=2)['nunchanged'] == 3
+        assert self.run_sync(self.RAW, binary=True)['nunchanged'] == 3
+
+    @mock.patch('gratipay.sync_npm.run.CHUNK_SIZE', 1)
+    @mock.patch('gratipay.sync_npm.serialize.CHUNK_SIZE', 1)
+    def test_run_keeps_chunks_merged_before_a_failure(self):
+        calls = []
+        def load(cursor, fp, **kw):
+            calls.append(fp)
+            if len(calls) == 2:
+                raise Heck
+            return upsert.load(cursor, fp, **kw)
+        with mock.patch('gratipay.sync_npm.run.load', load):
+            with pytest.raises(Heck):
+                self.run_sync(self.RAW)
+        assert self.db.all('select name from packages') == ['alpha']
+
+    @mock.patch('gratipay.sync_npm.run.CHUNK_SIZE', 1)
+    @mock.patch('gratipay.sync_npm.serialize.CHUNK_SIZE', 1)
+    def test_run_prunes_across_chunks_when_asked(self):
+        self.load_csv(b'npm,delta,Delta,{}\nnpm,beta,Beta,{}\n')
+        assert self.run_sync(self.RAW)['ndeleted'] == 0
+        assert self.run_sync(self.RAW, prune=True)['ndeleted'] == 1
+        assert self.db.all('select name from packages order by name') == ['alpha', 'beta', 'gamma']
+
+    @mock.patch('gratipay.sync_npm.run.CHUNK_SIZE', 1)
+    @mock.patch('gratipay.sync_npm.serialize.CHUNK_SIZE', 1)
+    def test_run_doesnt_prune_after_a_failure(self):
+        self.load_csv(b'npm,delta,Delta,{}\n')
+        calls = []
+        def load(cursor, fp, **kw):
+            calls.append(fp)
+            if len(calls) == 3:
+                raise Heck
+            return upsert.load(cursor, fp, **kw)
+        with mock.patch('gratipay.sync_npm.run.load', load):
+            with pytest.raises(Heck):
+                self.run_sync(self.RAW, prune=True)
+        assert self.db.all('select name from packages order by name') == ['alpha', 'beta', 'delta']
+        assert self.run_sync(self.RAW, prune=True)['ndeleted'] == 1
+
+
+    # changes
+
+    def sync_changes(self, *changes_):
+        class args: pass
+        with feed(*changes_) as fp:
+            args.path = fp.name
+            changes.sync_changes(None, args, self.db)
+
+    def test_changes_upserts_packages_and_records_seq(self):
+        self.sync_changes( change(1, 'foo', 'Foo!', ['alice@example.com'])
+                         , change(2, 'bar', 'Bar?')
+                         , change(3, 'foo', 'Foo.', ['bob@example.com'])
+                          )
+        packages = self.db.all('select name, description, emails from packages order by name')
+        assert [tuple(p) for p in packages] == [ ('bar', 'Bar?', [])
+                                               , ('foo', 'Foo.', ['bob@example.com'])
+                                                ]
+        assert changes.get_last_seq(self.db) == 3
+
+    def test_changes_picks_up_where_it_left_off(self):
+        self.sync_changes(change(1, 'foo', 'Foo!'))
+        self.db.run("UPDATE packages SET description='Tampered'")
+        self.sync_changes(change(1, 'foo', 'Foo!'), change(2, 'bar', 'Bar?'))
+        assert self.db.one("select description from packages where name='foo'") == 'Tampered'
+        assert self.db.one("select description from packages where name='bar'") == 'Bar?'
+        assert changes.get_last_seq(self.db) == 2
+
+    def test_changes_deletes_packages(self):
+        self.sync_changes(change(1, 'foo', 'Foo!'), change(2, 'bar', 'Bar?'))
+        self.sync_changes(change(3, 'foo', deleted=True))
+        assert self.db.all('select name from packages') == ['bar']
+
+    def test_changes_skips_design_docs_but_advances_past_them(self):
+        self.sync_changes(change(1, '_design/app'))
+        assert self.db.all('select name from packages') == []
+        assert changes.get_last_seq(self.db) == 1
+
+    def test_changes_commits_in_batches(self):
+        class args: pass
+        with feed(change(1, 'foo'), change(2, 'bar'), change(3, 'baz')) as fp:
+            args.path = fp.name
+            changes.sync_changes(None, args, self.db, batch_size=2)
+        assert self.db.all('select name from packages order by name') == ['bar', 'baz', 'foo']
+        assert changes.get_last_seq(self.db) == 3
+
+
     # with sentry(env)
 
     def test_with_sentry_logs_to_sentry_and_raises(self):
@@ -3,12 +3,15 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 from datetime import datetime, timedelta
 
+import mock
 import pytest
 from aspen.http.response import Response
 from gratipay import utils
 from gratipay.testing import Harness, D
 from gratipay.utils import i18n, pricing, encode_for_querystring, decode_from_querystring, \
                                                                     truncate, get_featured_projects
+from gratipay.utils.threaded_map import threaded_pipeline
+from gratipay.utils.timer import SharedTokenBucket, TokenBucket
 from gratipay.utils.username import safely_reserve_a_username, FailedToReserveUsername, \
                                                                            RanOutOfUsernameAttempts
 from psycopg2 import IntegrityError
@@ -300,3 +303,89 @@ class TestGetFeaturedProjects(Harness):
 
     def test_deals_with_some_but_too_few_of_both(self):
         assert self.get_and_count(range(4), list('A')) == (4, 1)
+
+
+class TestThreadedPipeline(Harness):
+
+    def test_calls_func_on_every_item(self):
+        assert sorted(threaded_pipeline(lambda x: x * 2, iter(range(100)), threads=3)) == \
+               [x * 2 for x in range(100)]
+
+    def test_only_pulls_from_the_iterable_as_workers_keep_up(self):
+        pulled = []
+        def items():
+            for i in range(50):
+                pulled.append(i)
+                yield i
+        def func(i):
+            # The producer can't get more than a queue's worth ahead of us.
+            assert len(pulled) <= i + 1 + 2 + 2
+        threaded_pipeline(func, items(), threads=1, maxsize=2)
+        assert len(pulled) == 50
+
+    def test_reraises_exceptions(self):
+        def func(i):
+            if i == 3:
+                raise ZeroDivisionError
+        with pytest.raises(ZeroDivisionError):
+            threaded_pipeline(func, iter(range(10)), threads=2)
+
+
+class TestTokenBucket(Harness):
+
+    def take(self, bucket, n, now):
+        """Take ``n`` tokens at time ``now`` and return how long we slept in all.
+        """
+        slept = []
+        with mock.patch('time.time', return_value=now), \
+             mock.patch('time.sleep', side_effect=slept.append):
+            for i in range(n):
+                bucket.take()
+        return sum(slept)
+
+    def test_lets_a_burst_through_without_waiting(self):
+        with mock.patch('time.time', return_value=100):
+            bucket = TokenBucket(5)
+        assert self.take(bucket, 5, now=100) == 0
+
+    def test_paces_calls_past_the_burst(self):
+        with mock.patch('time.time', return_value=100):
+            bucket = TokenBucket(5)
+        assert self.take(bucket, 10, now=100) == sum(i / 5 for i in range(1, 6))
+
+    def test_refills_over_time(self):
+        with mock.patch('time.time', return_value=100):
+            bucket = TokenBucket(5)
+        self.take(bucket, 5, now=100)
+        assert self.take(bucket, 5, now=101) == 0
+
+    def test_zero_rate_means_no_limit(self):
+        assert self.take(TokenBucket(0), 1000, now=100) == 0
+
+
+class TestSharedTokenBucket(Harness):
+
+    def take(self, bucket, n):
+        """Take ``n`` tokens and return how long we slept in all.
+        """
+        slept = []
+        with mock.patch('time.sleep', side_effect=slept.append):
+            for i in range(n):
+                bucket.take()
+        return sum(slept)
+
+    def test_lets_a_burst_through_without_waiting(self):
+        assert self.take(SharedTokenBucket(self.db, 'foo', 5), 5) == 0
+
+    def test_paces_calls_past_the_burst(self):
+        slept = self.take(SharedTokenBucket(self.db, 'foo', 5), 10)
+        assert sum(i / 5 for i in range(1, 6)) - 0.5 < slept <= sum(i / 5 for i in range(1, 6))
+
+    def test_is_shared_by_every_bucket_with_the_same_name(self):
+        self.take(SharedTokenBucket(self.db, 'foo', 5), 5)
+        assert self.take(SharedTokenBucket(self.db, 'bar', 5), 1) == 0
+        assert 0.1 < self.take(SharedTokenBucket(self.db, 'foo', 5), 1) <= 0.2
+
+    def test_zero_rate_means_no_limit(self):
+        assert self.take(SharedTokenBucket(self.db, 'foo', 0), 1000) == 0
+        assert self.db.all("SELECT * FROM token_buckets") == []
@@ -0,0 +1,27 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from gratipay.testing import Harness
+from gratipay.wireup import fill_in_fallbacks
+
+
+class TestFillInFallbacks(Harness):
+
+    def test_leaves_values_that_are_set_alone(self):
+        environ = {'EMAIL_QUEUE_SEND_RATE': '14', 'EMAIL_QUEUE_THREADS': '4'}
+        assert fill_in_fallbacks(environ) == environ
+
+    def test_derives_send_rate_from_sleep_for(self):
+        environ = fill_in_fallbacks({'EMAIL_QUEUE_SLEEP_FOR': '2'})
+        assert environ['EMAIL_QUEUE_SEND_RATE'] == '0.5'
+        assert environ['EMAIL_QUEUE_THREADS'] == '1'
+
+    def test_sleeping_for_zero_means_no_limit(self):
+        assert fill_in_fallbacks({'EMAIL_QUEUE_SLEEP_FOR': '0'})['EMAIL_QUEUE_SEND_RATE'] == '0'
+
+    def test_defaults_to_one_a_second(self):
+        assert fill_in_fallbacks({})['EMAIL_QUEUE_SEND_RATE'] == '1.0'
+
+    def test_doesnt_change_what_its_given(self):
+        environ = {}
+        fill_in_fallbacks(environ)
+        assert environ == {}